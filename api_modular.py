@@ -6,15 +6,31 @@ FastAPI Server cho RAG Chatbot với Unified Service
 API endpoint sử dụng luồng xử lý mới với thông tin chi tiết
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, Response
+from starlette.background import BackgroundTask
+
+# orjson serialize nhanh hơn json chuẩn nhiều lần; fallback về JSONResponse nếu chưa cài
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:
+    FastJSONResponse = JSONResponse
 from pydantic import BaseModel
 from typing import Optional, Dict, Any, List
 import uvicorn
 import logging
+import asyncio
+import json
 import time
 from contextlib import asynccontextmanager
 from services.unified_rag_service import UnifiedRAGService
+from services.admission_control import AdmissionController, AdmissionRejected
+from services.metrics import metrics, render_stats_as_gauges
+from services.deadline import create_deadline
+from config.settings import settings
 
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +39,20 @@ logger = logging.getLogger(__name__)
 # Global service
 rag_service = None
 
+# Trạng thái warmup: "pending" -> "running" -> "done" (hoặc "disabled")
+warmup_state: Dict[str, Any] = {"status": "pending"}
+
+# Chu kỳ kiểm tra client còn kết nối trong lúc /chat đang xử lý (giây)
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# Giới hạn số request đồng thời + hàng chờ cho các endpoint chat
+admission = AdmissionController(
+    max_concurrent=settings.ADMISSION_MAX_CONCURRENT,
+    max_queue=settings.ADMISSION_MAX_QUEUE,
+    queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT,
+    retry_after=settings.ADMISSION_RETRY_AFTER
+)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -38,10 +68,37 @@ async def lifespan(app: FastAPI):
         logger.error(f"Lỗi khởi tạo RAG Service: {str(e)}")
         raise e
     
+    # Warmup chạy nền để server vẫn trả lời /health (503 cho tới khi warmup xong)
+    warmup_task = None
+    if settings.WARMUP_ENABLED:
+        warmup_task = asyncio.create_task(run_warmup())
+    else:
+        warmup_state["status"] = "disabled"
+    
     yield
     
     # Shutdown
     logger.info("Đang dừng RAG Service...")
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+    if rag_service is not None:
+        rag_service.shutdown()
+
+
+async def run_warmup():
+    """Warmup encoder, Qdrant, reranker (và Gemini nếu bật) trước khi báo ready"""
+    warmup_state["status"] = "running"
+    start_time = time.time()
+    logger.info("Đang warmup...")
+    try:
+        result = await rag_service.awarmup(settings.WARMUP_QUERIES, llm_ping=settings.WARMUP_LLM_PING)
+        warmup_state.update(result)
+    except Exception as e:
+        logger.error(f"Lỗi warmup: {str(e)}")
+        warmup_state["errors"] = {"warmup": str(e)}
+    warmup_state["duration_ms"] = (time.time() - start_time) * 1000
+    warmup_state["status"] = "done"
+    logger.info(f"Warmup hoàn thành sau {warmup_state['duration_ms']:.0f}ms")
 
 
 # Khởi tạo FastAPI app với lifespan
@@ -49,7 +106,8 @@ app = FastAPI(
     title="Hasaki RAG Chatbot API",
     description="API cho chatbot tư vấn mỹ phẩm với luồng xử lý mới",
     version="5.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
 # Cấu hình CORS
@@ -61,12 +119,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Nén response lớn (bỏ qua text/event-stream để không làm chậm streaming)
+app.add_middleware(GZipMiddleware, minimum_size=settings.RESPONSE_GZIP_MIN_SIZE)
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """Quá tải -> trả 429/503 ngay kèm Retry-After"""
+    logger.warning(f"Từ chối request {request.url.path}: {exc.reason}")
+    metrics.record_request(request.url.path, str(exc.status_code))
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"success": False, "detail": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 
 class ChatRequest(BaseModel):
     """Model cho request chat"""
     message: str
     session_id: Optional[str] = "default"
-    show_details: Optional[bool] = True  # Hiển thị thông tin chi tiết
+    show_details: Optional[bool] = False  # Hiển thị thông tin chi tiết (chunks, context, query transform)
+    fields: Optional[List[str]] = None  # Chỉ trả về các field này (success và answer luôn có)
+    show_timings: Optional[bool] = False  # Thời gian từng stage và độ dài/số token của từng prompt
+    deadline_ms: Optional[float] = None  # Latency budget của request (mặc định REQUEST_DEADLINE_MS)
 
 
 class ChatResponse(BaseModel):
@@ -88,9 +164,33 @@ class ChatResponse(BaseModel):
     chunks_info: Optional[List[Dict[str, Any]]] = None
     context_info: Optional[Dict[str, Any]] = None
     
+    # Thời gian từng stage (step1, encode, Qdrant, rerank tokenize/forward, context, LLM) và thông tin prompt
+    timings: Optional[Dict[str, Any]] = None
+    
+    # Các mức giảm chất lượng đã áp dụng vì sắp hết deadline
+    degradations: Optional[List[str]] = None
+    
     error: Optional[str] = None
 
 
+class BatchChatRequest(BaseModel):
+    """Model cho request chat batch - mỗi message có session riêng"""
+    messages: List[ChatRequest]
+
+
+class BatchChatResponse(BaseModel):
+    """Model cho response chat batch"""
+    success: bool
+    results: List[ChatResponse]
+    processing_time: Optional[float] = None
+    error: Optional[str] = None
+
+
+# Các field của ChatResponse và nhóm field chi tiết (nặng, chỉ tính khi được yêu cầu)
+CHAT_RESPONSE_FIELDS = list(ChatResponse.model_fields.keys())
+DETAIL_FIELDS = {"query_transform_info", "chunks_info", "context_info"}
+
+
 class MemoryResponse(BaseModel):
     """Model cho memory response"""
     success: bool
@@ -130,14 +230,27 @@ async def health_check():
             "message": "RAG Service chưa được khởi tạo"
         }
     
+    # Chưa warmup xong -> 503 để load balancer chưa chuyển traffic tới
+    if warmup_state["status"] in ("pending", "running"):
+        return JSONResponse(
+            status_code=503,
+            content={
+                "status": "warming_up",
+                "message": "RAG Service đang warmup",
+                "warmup": warmup_state
+            }
+        )
+    
     try:
-        memory_stats = rag_service.get_memory_stats()
+        session_stats = rag_service.get_session_store_stats()
         return {
             "status": "healthy",
             "message": "Tất cả dịch vụ đang hoạt động bình thường",
             "rag_service": "ready",
             "unified": "enabled",
-            "memory_stats": memory_stats
+            "warmup": warmup_state,
+            "session_stats": session_stats,
+            "admission": admission.get_stats()
         }
     except Exception as e:
         return {
@@ -146,16 +259,21 @@ async def health_check():
         }
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+@app.post("/chat", response_model=ChatResponse, response_model_exclude_none=True)
+async def chat(request: ChatRequest, http_request: Request):
     """
-    Endpoint chính để chat với bot - bao gồm thông tin chi tiết
+    Endpoint chính để chat với bot
+    
+    Mặc định trả về response gọn (không có chunks_info, context_info, query_transform_info);
+    bật show_details hoặc liệt kê các field đó trong fields để lấy thông tin chi tiết.
+    Client ngắt kết nối trước khi có câu trả lời thì xử lý (kể cả lời gọi Gemini) bị hủy.
     
     Args:
-        request: ChatRequest chứa message, session_id và show_details
+        request: ChatRequest chứa message, session_id, show_details và fields
+        http_request: Request gốc, dùng để phát hiện client ngắt kết nối
         
     Returns:
-        ChatResponse với câu trả lời và thông tin chi tiết
+        ChatResponse với câu trả lời (và thông tin chi tiết nếu được yêu cầu)
     """
     global rag_service
     
@@ -166,63 +284,292 @@ async def chat(request: ChatRequest):
         )
     
     start_time = time.time()
+    # Deadline tính từ lúc request tới, gồm cả thời gian chờ trong hàng đợi
+    deadline = create_deadline(request.deadline_ms)
     
     try:
         user_input = request.message.strip()
         
         if not user_input:
-            return ChatResponse(
-                success=False,
-                answer="Vui lòng nhập câu hỏi của bạn!",
-                error="Empty message"
-            )
+            return FastJSONResponse(_build_chat_payload({
+                "success": False,
+                "answer": "Vui lòng nhập câu hỏi của bạn!",
+                "error": "Empty message"
+            }, None, request.fields))
         
         logger.info(f"Nhận câu hỏi: {user_input}")
         
-        # Xử lý với unified service và lấy thông tin chi tiết
-        result = rag_service.process_complete_query_with_details(user_input, show_details=request.show_details)
+        # Xử lý với unified service
+        # (các bước blocking chạy trong executor, lời gọi Gemini được await - không chặn event loop)
+        async with admission.slot():
+            result = await _cancel_on_disconnect(http_request, rag_service.aprocess_complete_query_with_details(
+                user_input,
+                show_details=_needs_details(request),
+                session_id=request.session_id or "default",
+                show_timings=_needs_timings(request),
+                deadline=deadline
+            ))
+        
+        if result is None:
+            logger.info(f"Client ngắt kết nối, đã hủy xử lý: {user_input}")
+            metrics.record_request("/chat", "cancelled", time.time() - start_time)
+            # 499: client đóng kết nối trước khi có response (không ai nhận body)
+            return Response(status_code=499)
         
         # Tính thời gian xử lý
         processing_time = time.time() - start_time
+        metrics.record_request("/chat", "success" if result.get("success") else "error", processing_time)
         
-        if result.get("success"):
-            return ChatResponse(
-                success=True,
-                answer=result["answer"],
-                enhanced_query=result.get("enhanced_query"),
-                sub_queries=result.get("sub_queries"),
-                query_count=result.get("query_count"),
-                route=result.get("route"),
-                documents_found=result.get("documents_found"),
-                id_product=result.get("id_product"),
-                name_product=result.get("name_product"),
-                processing_time=processing_time,
-                memory_stats=result.get("memory_stats"),
-                query_transform_info=result.get("query_transform_info"),
-                chunks_info=result.get("chunks_info"),
-                context_info=result.get("context_info")
-            )
-        else:
-            return ChatResponse(
-                success=False,
-                answer=result["answer"],
-                error=result.get("error"),
-                processing_time=processing_time
-            )
+        return FastJSONResponse(_build_chat_payload(result, processing_time, request.fields))
             
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"Lỗi xử lý chat: {str(e)}")
-        return ChatResponse(
-            success=False,
-            answer="Đã xảy ra lỗi trong quá trình xử lý. Vui lòng thử lại!",
-            error=str(e),
-            processing_time=time.time() - start_time
+        metrics.record_error("api_chat")
+        metrics.record_request("/chat", "error", time.time() - start_time)
+        return FastJSONResponse(_build_chat_payload({
+            "success": False,
+            "answer": "Đã xảy ra lỗi trong quá trình xử lý. Vui lòng thử lại!",
+            "error": str(e)
+        }, time.time() - start_time, request.fields))
+
+
+async def _cancel_on_disconnect(http_request: Request, coroutine) -> Optional[Dict[str, Any]]:
+    """Chạy coroutine xử lý, hủy nó và trả về None nếu client ngắt kết nối trước khi xong"""
+    task = asyncio.ensure_future(coroutine)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                task.cancel()
+                return None
+    finally:
+        # Request bị hủy từ phía server (shutdown, ...) - hủy luôn phần xử lý
+        if not task.done():
+            task.cancel()
+
+
+def _needs_details(request: ChatRequest) -> bool:
+    """Chỉ tính thông tin chi tiết khi được bật hoặc có field chi tiết trong fields"""
+    if request.show_details:
+        return True
+    return bool(request.fields) and any(field in DETAIL_FIELDS for field in request.fields)
+
+
+def _needs_timings(request: ChatRequest) -> bool:
+    """Chỉ trace thời gian từng stage khi được bật hoặc có "timings" trong fields"""
+    if request.show_timings:
+        return True
+    return bool(request.fields) and "timings" in request.fields
+
+
+def _build_chat_payload(result: Dict[str, Any], processing_time: Optional[float],
+                        fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Chuyển kết quả của RAG service thành dict theo schema ChatResponse
+    
+    Bỏ các field None và chỉ giữ các field trong fields (nếu có); success và answer luôn có.
+    Trả về dict thay vì ChatResponse để không phải validate lại toàn bộ model pydantic.
+    """
+    if result.get("success"):
+        payload = {
+            field: result.get(field)
+            for field in CHAT_RESPONSE_FIELDS
+            if field not in ("processing_time", "error")
+        }
+    else:
+        payload = {
+            "success": False,
+            "answer": result["answer"],
+            "error": result.get("error"),
+            "timings": result.get("timings"),
+            "degradations": result.get("degradations")
+        }
+    payload["processing_time"] = processing_time
+    
+    if fields:
+        selected = set(fields) | {"success", "answer"}
+        payload = {key: value for key, value in payload.items() if key in selected}
+    
+    return {key: value for key, value in payload.items() if value is not None}
+
+
+@app.post("/chat/batch", response_model=BatchChatResponse, response_model_exclude_none=True)
+async def chat_batch(request: BatchChatRequest):
+    """
+    Endpoint chat batch cho các job offline (QA, đánh giá hằng đêm)
+    
+    Tất cả query trong batch được encode một lần, tìm kiếm bằng Qdrant search_batch
+    và rerank trong các batch dùng chung; các lời gọi LLM chạy song song.
+    
+    Args:
+        request: BatchChatRequest chứa danh sách ChatRequest
+        
+    Returns:
+        BatchChatResponse với kết quả theo đúng thứ tự message gửi lên
+    """
+    global rag_service
+    
+    if rag_service is None:
+        raise HTTPException(
+            status_code=503, 
+            detail="RAG Service chưa sẵn sàng. Vui lòng thử lại sau."
+        )
+    
+    if len(request.messages) > settings.BATCH_MAX_MESSAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch tối đa {settings.BATCH_MAX_MESSAGES} messages"
         )
+    
+    start_time = time.time()
+    
+    try:
+        # Message rỗng trả lỗi ngay, không đưa vào pipeline
+        results: List[Optional[Dict[str, Any]]] = [None] * len(request.messages)
+        pending_indexes = []
+        pending_requests = []
+        for index, chat_request in enumerate(request.messages):
+            user_input = chat_request.message.strip()
+            if not user_input:
+                results[index] = _build_chat_payload({
+                    "success": False,
+                    "answer": "Vui lòng nhập câu hỏi của bạn!",
+                    "error": "Empty message"
+                }, None, chat_request.fields)
+                continue
+            pending_indexes.append(index)
+            pending_requests.append({
+                "message": user_input,
+                "session_id": chat_request.session_id or "default",
+                "show_details": _needs_details(chat_request)
+            })
+        
+        logger.info(f"Nhận batch: {len(pending_requests)} câu hỏi")
+        
+        async with admission.slot():
+            batch_results = await rag_service.aprocess_batch(pending_requests)
+        
+        processing_time = time.time() - start_time
+        metrics.record_request("/chat/batch", "success", processing_time)
+        for index, result in zip(pending_indexes, batch_results):
+            results[index] = _build_chat_payload(result, processing_time, request.messages[index].fields)
+        
+        return FastJSONResponse({
+            "success": True,
+            "results": results,
+            "processing_time": processing_time
+        })
+        
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logger.error(f"Lỗi xử lý chat batch: {str(e)}")
+        metrics.record_error("api_chat_batch")
+        metrics.record_request("/chat/batch", "error", time.time() - start_time)
+        return FastJSONResponse({
+            "success": False,
+            "results": [],
+            "error": str(e),
+            "processing_time": time.time() - start_time
+        })
+
+
+def _format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Format một event theo chuẩn Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Endpoint chat dạng streaming (Server-Sent Events)
+    
+    Gửi event "metadata" (route, id_product, documents) trước, sau đó các event
+    "token" theo từng đoạn câu trả lời và cuối cùng là "done" hoặc "error".
+    
+    Args:
+        request: ChatRequest chứa message và session_id
+        
+    Returns:
+        StreamingResponse với media type text/event-stream
+    """
+    global rag_service
+    
+    if rag_service is None:
+        raise HTTPException(
+            status_code=503, 
+            detail="RAG Service chưa sẵn sàng. Vui lòng thử lại sau."
+        )
+    
+    user_input = request.message.strip()
+    session_id = request.session_id or "default"
+    deadline = create_deadline(request.deadline_ms)
+    
+    # Chiếm slot trước khi trả header để có thể trả 429/503 khi quá tải;
+    # slot được giữ tới khi stream kết thúc
+    await admission.acquire()
+    slot_released = False
+    
+    def release_slot():
+        nonlocal slot_released
+        if not slot_released:
+            slot_released = True
+            admission.release()
+    
+    async def event_generator():
+        start_time = time.time()
+        status = "success"
+        try:
+            if not user_input:
+                yield _format_sse("error", {
+                    "success": False,
+                    "answer": "Vui lòng nhập câu hỏi của bạn!",
+                    "error": "Empty message"
+                })
+                return
+            
+            logger.info(f"Nhận câu hỏi (stream): {user_input}")
+            
+            async for event in rag_service.astream_complete_query(user_input, session_id=session_id,
+                                                                  deadline=deadline):
+                if event["event"] == "error":
+                    status = "error"
+                yield _format_sse(event["event"], event["data"])
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client ngắt kết nối giữa chừng - stream tới Gemini được đóng theo generator
+            status = "cancelled"
+            raise
+        except Exception as e:
+            logger.error(f"Lỗi xử lý chat stream: {str(e)}")
+            metrics.record_error("api_chat_stream")
+            status = "error"
+            yield _format_sse("error", {
+                "success": False,
+                "answer": "Đã xảy ra lỗi trong quá trình xử lý. Vui lòng thử lại!",
+                "error": str(e)
+            })
+        finally:
+            metrics.record_request("/chat/stream", status, time.time() - start_time)
+            release_slot()
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        },
+        # Phòng trường hợp client ngắt trước khi generator chạy
+        background=BackgroundTask(release_slot)
+    )
 
 
 @app.get("/memory/summary", response_model=MemoryResponse)
-async def get_conversation_summary():
-    """Lấy tóm tắt cuộc hội thoại"""
+async def get_conversation_summary(session_id: str = "default"):
+    """Lấy tóm tắt cuộc hội thoại của session"""
     global rag_service
     
     if rag_service is None:
@@ -232,8 +579,8 @@ async def get_conversation_summary():
         )
     
     try:
-        summary = rag_service.get_conversation_summary()
-        stats = rag_service.get_memory_stats()
+        summary = rag_service.get_conversation_summary(session_id)
+        stats = rag_service.get_memory_stats(session_id)
         
         return MemoryResponse(
             success=True,
@@ -249,8 +596,8 @@ async def get_conversation_summary():
 
 
 @app.get("/memory/stats", response_model=MemoryResponse)
-async def get_memory_stats():
-    """Lấy thống kê memory"""
+async def get_memory_stats(session_id: str = "default"):
+    """Lấy thống kê memory của session"""
     global rag_service
     
     if rag_service is None:
@@ -260,7 +607,7 @@ async def get_memory_stats():
         )
     
     try:
-        stats = rag_service.get_memory_stats()
+        stats = rag_service.get_memory_stats(session_id)
         
         return MemoryResponse(
             success=True,
@@ -276,8 +623,8 @@ async def get_memory_stats():
 
 
 @app.post("/memory/clear")
-async def clear_memory():
-    """Xóa lịch sử hội thoại"""
+async def clear_memory(session_id: str = "default"):
+    """Xóa lịch sử hội thoại của session"""
     global rag_service
     
     if rag_service is None:
@@ -287,7 +634,7 @@ async def clear_memory():
         )
     
     try:
-        rag_service.clear_memory()
+        rag_service.clear_memory(session_id)
         return {
             "success": True,
             "message": "Đã xóa lịch sử hội thoại và memory"
@@ -301,6 +648,73 @@ async def clear_memory():
         }
 
 
+@app.post("/cache/invalidate")
+async def invalidate_answer_cache():
+    """Xóa semantic answer cache, vd. ngay sau khi index lại catalog
+    
+    Cache cũng tự xóa khi phát hiện collection Qdrant đã được index lại (kiểm tra định kỳ),
+    endpoint này chỉ xóa cache của worker nhận request.
+    """
+    global rag_service
+    
+    if rag_service is None:
+        raise HTTPException(
+            status_code=503, 
+            detail="RAG Service chưa sẵn sàng"
+        )
+    
+    removed = rag_service.invalidate_answer_cache()
+    return {
+        "success": True,
+        "message": f"Đã xóa {removed} câu trả lời trong cache"
+    }
+
+
+@app.get("/stats")
+async def get_runtime_stats():
+    """Thống kê runtime của pipeline (sessions, singleflight, unified cache, Gemini API keys, hàng chờ, stage limits)"""
+    global rag_service
+    
+    if rag_service is None:
+        raise HTTPException(
+            status_code=503, 
+            detail="RAG Service chưa sẵn sàng"
+        )
+    
+    stats = rag_service.get_runtime_stats()
+    stats["admission"] = admission.get_stats()
+    
+    return {
+        "success": True,
+        "stats": stats
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Metrics theo định dạng text của Prometheus
+    
+    Gồm histogram thời gian từng stage (step1, encode, Qdrant, rerank, context, từng lời gọi Gemini),
+    counter theo route, fallback và lỗi bị nuốt, cùng các gauge của hàng chờ, stage limits,
+    singleflight và session store.
+    """
+    output = metrics.render()
+    output += render_stats_as_gauges("rag_admission", admission.get_stats())
+    
+    if rag_service is not None:
+        runtime_stats = rag_service.get_runtime_stats()
+        output += render_stats_as_gauges("rag_sessions", runtime_stats["sessions"])
+        output += render_stats_as_gauges("rag_search_singleflight", runtime_stats["search_singleflight"])
+        output += render_stats_as_gauges("rag_embedding_cache", runtime_stats["embedding_cache"])
+        output += render_stats_as_gauges("rag_unified_cache", runtime_stats["unified_cache"])
+        output += render_stats_as_gauges("rag_answer_cache", runtime_stats["answer_cache"])
+        output += render_stats_as_gauges("rag_llm_key", runtime_stats["llm_keys"], label="key")
+        output += render_stats_as_gauges("rag_llm_hedge", runtime_stats["llm_hedge"], label="chain")
+        output += render_stats_as_gauges("rag_stage", runtime_stats["stages"], label="stage")
+    
+    return PlainTextResponse(output, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/test")
 async def test_endpoint():
     """Test endpoint để kiểm tra API"""
@@ -6,6 +6,15 @@ load_dotenv()
 class Settings:
     # Gemini API
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+    # Nhiều key (phân tách bằng dấu phẩy) để chia tải; để trống thì dùng GEMINI_API_KEY
+    GEMINI_API_KEYS = [
+        key.strip() for key in os.getenv("GEMINI_API_KEYS", "").split(",") if key.strip()
+    ] or ([GEMINI_API_KEY] if GEMINI_API_KEY else [])
+    GEMINI_KEY_RPM = float(os.getenv("GEMINI_KEY_RPM", 1000))
+    GEMINI_KEY_TPM = float(os.getenv("GEMINI_KEY_TPM", 1000000))
+    GEMINI_POOL_MAX_WAIT = float(os.getenv("GEMINI_POOL_MAX_WAIT", 5))
+    GEMINI_RATE_LIMIT_BACKOFF = float(os.getenv("GEMINI_RATE_LIMIT_BACKOFF", 2))
+    GEMINI_RATE_LIMIT_BACKOFF_MAX = float(os.getenv("GEMINI_RATE_LIMIT_BACKOFF_MAX", 60))
     
     # Qdrant Configuration
     QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
@@ -20,6 +29,8 @@ class Settings:
     EMBEDDING_MODEL = "bkai-foundation-models/vietnamese-bi-encoder"
     EMBEDDING_DIMENSION = 768
     EMBEDDING_BATCH_SIZE = 32
+    # Số embedding query giữ trong cache LRU (0 = tắt cache), ~3KB mỗi entry
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 10000))
 
     # MODEL RERANKER
     MODEL_RERANKER = "BAAI/bge-reranker-v2-m3"
@@ -31,8 +42,128 @@ class Settings:
     
     # RAG Configuration
     CONVERSATION_MEMORY_K = int(os.getenv("CONVERSATION_MEMORY_K", 3))
+    SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", 10000))
+    SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 1800))
+    SESSION_MEMORY_MAX_BYTES = int(os.getenv("SESSION_MEMORY_MAX_BYTES", 64 * 1024 * 1024))
+    # Nguồn LLM: "gemini" (API thật) hoặc "fake" (cục bộ, tất định - load test / CI không cần API key)
+    LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+    LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash")
     LLM_TIMEOUT = int(os.getenv("LLM_TIMEOUT", 20))
     LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", 0.1))
+    # Hedged request: Gemini chậm hơn percentile latency gần đây thì gửi thêm request tới LLM_HEDGE_MODEL
+    LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+    LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL", "gemini-2.5-flash-lite")
+    LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", 95))
+    LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", 1.0))
+    LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", 8.0))
+    LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+    # Backend fake: latency tới token đầu (fixed / uniform / lognormal quanh median), tốc độ sinh token
+    FAKE_LLM_LATENCY_DISTRIBUTION = os.getenv("FAKE_LLM_LATENCY_DISTRIBUTION", "lognormal")
+    FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", 800))
+    FAKE_LLM_LATENCY_SPREAD = float(os.getenv("FAKE_LLM_LATENCY_SPREAD", 0.5))
+    FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", 150))
+    FAKE_LLM_OUTPUT_TOKENS = int(os.getenv("FAKE_LLM_OUTPUT_TOKENS", 120))
+    FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", 42))
+    # Token budget cho prompt QUESTION (instructions + câu hỏi + context + lịch sử), 0 = không giới hạn
+    PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 8000))
+    PROMPT_HISTORY_SHARE = float(os.getenv("PROMPT_HISTORY_SHARE", 0.3))
+    PROMPT_MIN_PARTIAL_TOKENS = int(os.getenv("PROMPT_MIN_PARTIAL_TOKENS", 64))
+    
+    # Concurrency Configuration
+    API_WORKERS = int(os.getenv("API_WORKERS", 1))
+    TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", 0))
+    PIPELINE_MAX_WORKERS = int(os.getenv("PIPELINE_MAX_WORKERS", 8))
+    BATCH_MAX_MESSAGES = int(os.getenv("BATCH_MAX_MESSAGES", 256))
+    RESPONSE_GZIP_MIN_SIZE = int(os.getenv("RESPONSE_GZIP_MIN_SIZE", 1024))
+    
+    # Admission Control
+    ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", 32))
+    ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 64))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 5))
+    ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 2))
+    STAGE_ENCODER_CONCURRENCY = int(os.getenv("STAGE_ENCODER_CONCURRENCY", 4))
+    STAGE_RERANKER_CONCURRENCY = int(os.getenv("STAGE_RERANKER_CONCURRENCY", 2))
+    STAGE_LLM_CONCURRENCY = int(os.getenv("STAGE_LLM_CONCURRENCY", 16))
+    STAGE_ACQUIRE_TIMEOUT = float(os.getenv("STAGE_ACQUIRE_TIMEOUT", 10))
+    
+    # Deadline Configuration (ngưỡng = thời gian còn lại của request, ms)
+    REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", 15000))
+    DEADLINE_SHRINK_SEARCH_MS = float(os.getenv("DEADLINE_SHRINK_SEARCH_MS", 10000))
+    DEADLINE_SHORTEN_RERANK_MS = float(os.getenv("DEADLINE_SHORTEN_RERANK_MS", 9000))
+    DEADLINE_SKIP_RERANK_MS = float(os.getenv("DEADLINE_SKIP_RERANK_MS", 7000))
+    DEADLINE_TRIM_CONTEXT_MS = float(os.getenv("DEADLINE_TRIM_CONTEXT_MS", 6000))
+    DEADLINE_SKIP_ENHANCEMENT_MS = float(os.getenv("DEADLINE_SKIP_ENHANCEMENT_MS", 5000))
+    DEGRADED_SEARCH_LIMIT = int(os.getenv("DEGRADED_SEARCH_LIMIT", 20))
+    DEGRADED_RERANK_CANDIDATES = int(os.getenv("DEGRADED_RERANK_CANDIDATES", 10))
+    DEGRADED_CONTEXT_TOP_K = int(os.getenv("DEGRADED_CONTEXT_TOP_K", 3))
+    
+    # Warmup Configuration
+    WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+    WARMUP_QUERIES = [
+        query.strip()
+        for query in os.getenv(
+            "WARMUP_QUERIES",
+            "kem chống nắng cho da dầu|sữa rửa mặt cho da nhạy cảm|serum vitamin C giá bao nhiêu"
+        ).split("|")
+        if query.strip()
+    ]
+    WARMUP_LLM_PING = os.getenv("WARMUP_LLM_PING", "false").lower() == "true"
+    
+    # Query Rewrite Configuration
+    QUERY_REWRITE_SKIP_ENABLED = os.getenv("QUERY_REWRITE_SKIP_ENABLED", "true").lower() == "true"
+    SPECULATIVE_RETRIEVAL_ENABLED = os.getenv("SPECULATIVE_RETRIEVAL_ENABLED", "false").lower() == "true"
+    SPECULATIVE_SIMILARITY_THRESHOLD = float(os.getenv("SPECULATIVE_SIMILARITY_THRESHOLD", 0.95))
+    SPECULATIVE_MAX_WORKERS = int(os.getenv("SPECULATIVE_MAX_WORKERS", 4))
+    UNIFIED_CACHE_MAX_ENTRIES = int(os.getenv("UNIFIED_CACHE_MAX_ENTRIES", 2048))
+    UNIFIED_CACHE_TTL_SECONDS = float(os.getenv("UNIFIED_CACHE_TTL_SECONDS", 3600))
+    ANSWER_CACHE_ROUTES = [
+        route.strip().upper()
+        for route in os.getenv("ANSWER_CACHE_ROUTES", "QUESTION").split(",")
+        if route.strip()
+    ]
+    ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+    ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 1800))
+    ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.92))
+    ANSWER_CACHE_PRODUCT_MATCH_TOP_K = int(os.getenv("ANSWER_CACHE_PRODUCT_MATCH_TOP_K", 3))
+    ANSWER_CACHE_CATALOG_CHECK_SECONDS = float(os.getenv("ANSWER_CACHE_CATALOG_CHECK_SECONDS", 30))
+    
+    # Structured Answer Configuration - câu hỏi giá / link / đánh giá / phiên bản trả lời từ metadata
+    STRUCTURED_ANSWER_ENABLED = os.getenv("STRUCTURED_ANSWER_ENABLED", "true").lower() == "true"
+    # Tỉ lệ từ trong tên sản phẩm top mà câu hỏi phải nêu (mọi từ khác của câu hỏi phải có trong tên)
+    STRUCTURED_ANSWER_MIN_NAME_COVERAGE = float(os.getenv("STRUCTURED_ANSWER_MIN_NAME_COVERAGE", 0.6))
+    # Số sản phẩm đầu sau rerank được so tên để loại câu hỏi mơ hồ
+    STRUCTURED_ANSWER_CANDIDATES = int(os.getenv("STRUCTURED_ANSWER_CANDIDATES", 5))
+    
+    # Greeting Fast Path Configuration
+    GREETING_FAST_PATH_ENABLED = os.getenv("GREETING_FAST_PATH_ENABLED", "true").lower() == "true"
+    GREETING_FAST_PATH_MIN_CONFIDENCE = float(os.getenv("GREETING_FAST_PATH_MIN_CONFIDENCE", 0.9))
+    GREETING_TEMPLATES = [
+        template.strip()
+        for template in os.getenv(
+            "GREETING_TEMPLATES",
+            "Xin chào! Mình là trợ lý tư vấn mỹ phẩm của Hasaki. {suggestion}|"
+            "Chào bạn! Rất vui được hỗ trợ bạn. {suggestion}"
+        ).split("|")
+        if template.strip()
+    ]
+    THANKS_TEMPLATES = [
+        template.strip()
+        for template in os.getenv(
+            "THANKS_TEMPLATES",
+            "Không có gì ạ! {suggestion}|"
+            "Rất vui vì đã giúp được bạn! {suggestion}"
+        ).split("|")
+        if template.strip()
+    ]
+    GOODBYE_TEMPLATES = [
+        template.strip()
+        for template in os.getenv(
+            "GOODBYE_TEMPLATES",
+            "Tạm biệt bạn! Hẹn gặp lại bạn lần sau nhé.|"
+            "Cảm ơn bạn đã ghé Hasaki, chúc bạn một ngày tốt lành!"
+        ).split("|")
+        if template.strip()
+    ]
 
 settings = Settings()
 
@@ -75,6 +75,8 @@ class ChatApp {
             const response = await fetch(`${this.apiUrl}/health`);
             if (response.ok) {
                 this.updateApiStatus('connected', 'Đã kết nối');
+            } else if (response.status === 503) {
+                this.updateApiStatus('error', 'Đang khởi động');
             } else {
                 this.updateApiStatus('error', 'Lỗi kết nối');
             }
@@ -117,8 +119,11 @@ class ChatApp {
         // Show loading
         this.showLoading();
         
+        let messageText = null;
+        let answer = '';
+        
         try {
-            const response = await fetch(`${this.apiUrl}/chat`, {
+            const response = await fetch(`${this.apiUrl}/chat/stream`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -133,18 +138,43 @@ class ChatApp {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
             
-            const data = await response.json();
+            // Render câu trả lời dần dần theo từng event token
+            await SSEReader.read(response, (event, data) => {
+                if (event === 'token') {
+                    if (!messageText) {
+                        this.hideLoading();
+                        messageText = this.addMessage('bot', '');
+                    }
+                    answer += data.text;
+                    messageText.innerHTML = MessageManager.formatMessage(answer);
+                    this.scrollToBottom();
+                } else if (event === 'done' || event === 'error') {
+                    answer = data.answer || answer;
+                    if (!messageText) {
+                        this.hideLoading();
+                        messageText = this.addMessage('bot', answer);
+                    } else {
+                        messageText.innerHTML = MessageManager.formatMessage(answer);
+                    }
+                    if (event === 'error') {
+                        this.markMessageFailed(messageText, data.truncated);
+                    }
+                }
+            });
             
-            // Add bot response
-            this.addMessage('bot', data.answer);
+            if (!messageText) {
+                throw new Error('Stream ended without an answer');
+            }
             
             // Count products mentioned in response
-            const productLinks = (data.answer.match(/\[.*?\]\(.*?\)/g) || []).length;
+            const productLinks = (answer.match(/\[.*?\]\(.*?\)/g) || []).length;
             this.productCount += productLinks;
             
         } catch (error) {
             console.error('Error:', error);
-            this.addMessage('bot', 'Xin lỗi, đã có lỗi xảy ra. Vui lòng thử lại sau.');
+            if (!messageText) {
+                this.addMessage('bot', 'Xin lỗi, đã có lỗi xảy ra. Vui lòng thử lại sau.');
+            }
         } finally {
             this.hideLoading();
             this.updateStats();
@@ -194,6 +224,19 @@ class ChatApp {
         
         // Scroll to bottom
         this.scrollToBottom();
+        
+        return messageText;
+    }
+    
+    markMessageFailed(messageText, truncated) {
+        // Câu trả lời lỗi / bị ngắt giữa chừng - hiển thị cảnh báo ngay dưới nội dung
+        const notice = document.createElement('div');
+        notice.className = 'message-error';
+        notice.innerHTML = truncated ?
+            '<i class="fas fa-exclamation-triangle"></i> Câu trả lời bị gián đoạn, nội dung có thể chưa đầy đủ. Vui lòng thử lại.' :
+            '<i class="fas fa-exclamation-triangle"></i> Đã có lỗi khi tạo câu trả lời. Vui lòng thử lại.';
+        messageText.appendChild(notice);
+        this.scrollToBottom();
     }
     
     scrollToBottom() {
@@ -234,6 +277,55 @@ class ChatApp {
     }
 }
 
+// Server-Sent Events reader cho fetch (EventSource không hỗ trợ POST)
+class SSEReader {
+    static async read(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+        
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            
+            buffer += decoder.decode(value, { stream: true });
+            
+            // Mỗi event kết thúc bằng một dòng trống
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                SSEReader.dispatch(rawEvent, onEvent);
+            }
+        }
+        
+        if (buffer.trim()) {
+            SSEReader.dispatch(buffer, onEvent);
+        }
+    }
+    
+    static dispatch(rawEvent, onEvent) {
+        let event = 'message';
+        const dataLines = [];
+        
+        rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                event = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                dataLines.push(line.slice(5).trim());
+            }
+        });
+        
+        if (dataLines.length === 0) return;
+        
+        try {
+            onEvent(event, JSON.parse(dataLines.join('\n')));
+        } catch (error) {
+            console.error('Invalid SSE payload:', error);
+        }
+    }
+}
+
 // Message formatting utilities
 class MessageManager {
     static formatMessage(text) {
@@ -6,8 +6,9 @@ Chỉ sử dụng text chunk, không bao gồm metadata
 
 import torch
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Callable, Optional
 import numpy as np
+import time
 
 
 class BGEReranker:
@@ -21,6 +22,9 @@ class BGEReranker:
         self.model_name = model_name
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         
+        # Callback nhận (tên bước, số giây) cho thời gian tokenize và forward pass
+        self.timing_callback: Optional[Callable[[str, float], None]] = None
+        
         print(f"Đang tải BGE Reranker model: {model_name}")
         print(f"Device: {self.device}")
         
@@ -153,6 +157,7 @@ class BGEReranker:
         """
         try:
             # Tokenize input
+            start_time = time.perf_counter()
             inputs = self.tokenizer(
                 query, 
                 document,
@@ -164,13 +169,15 @@ class BGEReranker:
             
             # Chuyển sang device
             inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            tokenized_time = time.perf_counter()
             
             # Forward pass
             with torch.no_grad():
                 outputs = self.model(**inputs)
                 logits = outputs.logits
                 score = torch.sigmoid(logits).cpu().item()
-                
+            
+            self._report_timing(start_time, tokenized_time)
             return float(score)
             
         except Exception as e:
@@ -207,48 +214,8 @@ class BGEReranker:
                 batch_scores = self._compute_batch_scores(query, batch_docs)
                 all_scores.extend(batch_scores)
             
-            # Gán scores cho documents và thêm metadata chi tiết
-            for i, doc in enumerate(documents):
-                # Lưu thông tin rerank
-                doc['rerank_score'] = all_scores[i]
-                
-                # Giữ lại original score từ vector search
-                if 'score' in doc:
-                    doc['vector_score'] = doc['score']
-                
-                # Cập nhật score sau khi rerank
-                doc['score'] = all_scores[i]
-                
-                # Thêm metadata chi tiết cho chunk
-                doc['rerank_metadata'] = {
-                    'original_rank': i + 1,
-                    'vector_score': doc.get('vector_score', 0.0),
-                    'rerank_score': all_scores[i],
-                    'score_improvement': all_scores[i] - doc.get('vector_score', 0.0),
-                    'query_used': query,
-                    'chunk_length': len(doc.get('text', '')),
-                    'batch_processed': True,
-                    'batch_size': batch_size,
-                    'uses_metadata': False,  # Đánh dấu không sử dụng metadata
-                    'product_info': {
-                        'product_id': doc.get('metadata', {}).get('product_id'),
-                        'product_name': doc.get('metadata', {}).get('name'),
-                        'brand': doc.get('metadata', {}).get('brand'),
-                        'category': doc.get('metadata', {}).get('category_name'),
-                        'chunk_type': doc.get('metadata', {}).get('type')
-                    }
-                }
-            
-            # Sắp xếp và trả về
-            reranked_docs = sorted(documents, key=lambda x: x['rerank_score'], reverse=True)
-            
-            # Cập nhật rank sau khi sắp xếp
-            for i, doc in enumerate(reranked_docs):
-                doc['rerank_metadata']['final_rank'] = i + 1
-                doc['rerank_metadata']['rank_change'] = doc['rerank_metadata']['original_rank'] - (i + 1)
-            
-            if top_k is not None:
-                reranked_docs = reranked_docs[:top_k]
+            # Gán scores cho documents, thêm metadata chi tiết và sắp xếp
+            reranked_docs = self._attach_batch_scores(query, documents, all_scores, batch_size, top_k)
             
             print(f"Hoàn thành batch rerank, trả về {len(reranked_docs)} documents")
             
@@ -261,6 +228,115 @@ class BGEReranker:
             print(f"Lỗi trong batch rerank: {e}")
             return documents
     
+    def _attach_batch_scores(self, query: str, documents: List[Dict[str, Any]], all_scores: List[float],
+                             batch_size: int, top_k: int = None) -> List[Dict[str, Any]]:
+        """
+        Gán rerank scores cho documents, thêm metadata chi tiết và sắp xếp lại
+        
+        Args:
+            query: Câu hỏi
+            documents: Danh sách documents
+            all_scores: Scores tương ứng với từng document
+            batch_size: Kích thước batch đã dùng khi tính score
+            top_k: Số lượng documents trả về
+            
+        Returns:
+            Danh sách documents đã sắp xếp theo rerank score
+        """
+        # Gán scores cho documents và thêm metadata chi tiết
+        for i, doc in enumerate(documents):
+            # Lưu thông tin rerank
+            doc['rerank_score'] = all_scores[i]
+            
+            # Giữ lại original score từ vector search
+            if 'score' in doc:
+                doc['vector_score'] = doc['score']
+            
+            # Cập nhật score sau khi rerank
+            doc['score'] = all_scores[i]
+            
+            # Thêm metadata chi tiết cho chunk
+            doc['rerank_metadata'] = {
+                'original_rank': i + 1,
+                'vector_score': doc.get('vector_score', 0.0),
+                'rerank_score': all_scores[i],
+                'score_improvement': all_scores[i] - doc.get('vector_score', 0.0),
+                'query_used': query,
+                'chunk_length': len(doc.get('text', '')),
+                'batch_processed': True,
+                'batch_size': batch_size,
+                'uses_metadata': False,  # Đánh dấu không sử dụng metadata
+                'product_info': {
+                    'product_id': doc.get('metadata', {}).get('product_id'),
+                    'product_name': doc.get('metadata', {}).get('name'),
+                    'brand': doc.get('metadata', {}).get('brand'),
+                    'category': doc.get('metadata', {}).get('category_name'),
+                    'chunk_type': doc.get('metadata', {}).get('type')
+                }
+            }
+        
+        # Sắp xếp và trả về
+        reranked_docs = sorted(documents, key=lambda x: x['rerank_score'], reverse=True)
+        
+        # Cập nhật rank sau khi sắp xếp
+        for i, doc in enumerate(reranked_docs):
+            doc['rerank_metadata']['final_rank'] = i + 1
+            doc['rerank_metadata']['rank_change'] = doc['rerank_metadata']['original_rank'] - (i + 1)
+        
+        if top_k is not None:
+            reranked_docs = reranked_docs[:top_k]
+        
+        return reranked_docs
+    
+    def rerank_many(self, queries: List[str], documents_list: List[List[Dict[str, Any]]],
+                    batch_size: int = 32, top_k: int = None) -> List[List[Dict[str, Any]]]:
+        """
+        Rerank cho nhiều query cùng lúc - gộp tất cả cặp (query, chunk) vào chung các batch
+        
+        Args:
+            queries: Danh sách câu hỏi
+            documents_list: Danh sách documents tương ứng với từng câu hỏi
+            batch_size: Kích thước batch (tính trên tổng số cặp của mọi query)
+            top_k: Số lượng documents trả về cho mỗi query
+            
+        Returns:
+            Danh sách kết quả rerank tương ứng với từng câu hỏi
+        """
+        pair_queries = []
+        pair_texts = []
+        for query, documents in zip(queries, documents_list):
+            for doc in documents:
+                pair_queries.append(query)
+                pair_texts.append(doc.get('text', ''))
+        
+        if not pair_texts:
+            return [[] for _ in queries]
+        
+        print(f"Đang rerank {len(pair_texts)} cặp (query, chunk) của {len(queries)} queries với batch_size={batch_size}")
+        
+        all_scores = []
+        for i in range(0, len(pair_texts), batch_size):
+            all_scores.extend(self._compute_pair_scores(
+                pair_queries[i:i + batch_size],
+                pair_texts[i:i + batch_size]
+            ))
+        
+        # Tách scores về từng query
+        results = []
+        offset = 0
+        for query, documents in zip(queries, documents_list):
+            scores = all_scores[offset:offset + len(documents)]
+            offset += len(documents)
+            
+            if not documents:
+                results.append([])
+                continue
+            
+            results.append(self._attach_batch_scores(query, documents, scores, batch_size, top_k))
+        
+        print(f"Hoàn thành rerank cho {len(queries)} queries")
+        return results
+    
     def _compute_batch_scores(self, query: str, documents: List[Dict[str, Any]]) -> List[float]:
         """
         Tính scores cho một batch documents chỉ với text chunk
@@ -272,14 +348,28 @@ class BGEReranker:
         Returns:
             List scores
         """
-        try:
-            # Chỉ lấy text chunk cho tất cả documents
-            text_contents = [doc.get('text', '') for doc in documents]
-            
-            # Tạo pairs (query, text_content) cho toàn bộ batch
-            queries = [query] * len(text_contents)
+        # Chỉ lấy text chunk cho tất cả documents
+        text_contents = [doc.get('text', '') for doc in documents]
+        
+        # Tạo pairs (query, text_content) cho toàn bộ batch
+        queries = [query] * len(text_contents)
+        
+        return self._compute_pair_scores(queries, text_contents)
+    
+    def _compute_pair_scores(self, queries: List[str], text_contents: List[str]) -> List[float]:
+        """
+        Tính scores cho một batch các cặp (query, text chunk)
+        
+        Args:
+            queries: List câu hỏi (một câu hỏi cho mỗi cặp)
+            text_contents: List text chunk tương ứng
             
+        Returns:
+            List scores
+        """
+        try:
             # Tokenize batch
+            start_time = time.perf_counter()
             inputs = self.tokenizer(
                 queries,
                 text_contents,
@@ -291,6 +381,7 @@ class BGEReranker:
             
             # Chuyển sang device
             inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            tokenized_time = time.perf_counter()
             
             # Forward pass
             with torch.no_grad():
@@ -299,12 +390,20 @@ class BGEReranker:
                 
                 # Chuyển thành scores
                 scores = torch.sigmoid(logits).cpu().numpy().flatten()
-                
+            
+            self._report_timing(start_time, tokenized_time)
             return scores.tolist()
             
         except Exception as e:
             print(f"Lỗi trong batch scoring: {e}")
-            return [0.0] * len(documents)
+            return [0.0] * len(text_contents)
+    
+    def _report_timing(self, start_time: float, tokenized_time: float) -> None:
+        """Gửi thời gian tokenize và forward pass cho timing_callback (nếu có)"""
+        if self.timing_callback is None:
+            return
+        self.timing_callback("rerank_tokenize", tokenized_time - start_time)
+        self.timing_callback("rerank_forward", time.perf_counter() - tokenized_time)
     
     def compare_scores(self, documents: List[Dict[str, Any]]) -> None:
         """
@@ -387,14 +486,15 @@ class RerankService:
     Service wrapper cho BGE Reranker - chỉ sử dụng text chunk
     """
     
-    def __init__(self, model_name: str = "BAAI/bge-reranker-v2-m3"):
+    def __init__(self, model_name: str = "BAAI/bge-reranker-v2-m3", reranker: Optional[BGEReranker] = None):
         """
         Khởi tạo Rerank Service
         
         Args:
             model_name: Tên model reranker
+            reranker: BGEReranker đã load sẵn (dùng chung model thay vì load lại)
         """
-        self.reranker = BGEReranker(model_name)
+        self.reranker = reranker if reranker is not None else BGEReranker(model_name)
     
     def enhance_search_results(self, query: str, search_results: List[Dict[str, Any]], 
                              top_k: int = 5, use_batch: bool = True) -> List[Dict[str, Any]]:
@@ -434,4 +534,24 @@ class RerankService:
         if len(reranked_results) > 0:
             self.reranker.compare_scores(reranked_results)
         
-        return reranked_results
\ No newline at end of file
+        return reranked_results
+    
+    def enhance_search_results_batch(self, queries: List[str], search_results_list: List[List[Dict[str, Any]]],
+                                     top_k: int = 5) -> List[List[Dict[str, Any]]]:
+        """
+        Rerank kết quả tìm kiếm của nhiều query trong các batch dùng chung
+        
+        Args:
+            queries: Danh sách câu hỏi
+            search_results_list: Kết quả vector search tương ứng với từng câu hỏi
+            top_k: Số lượng kết quả cuối cùng cho mỗi câu hỏi
+            
+        Returns:
+            Kết quả đã được rerank cho từng câu hỏi
+        """
+        return self.reranker.rerank_many(
+            queries=queries,
+            documents_list=search_results_list,
+            batch_size=32,
+            top_k=top_k
+        )
\ No newline at end of file
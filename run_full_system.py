@@ -42,11 +42,13 @@ def check_backend_health():
     """Kiểm tra backend có sẵn sàng không"""
     import requests
     
-    for i in range(10):  # Thử 10 lần
+    for i in range(60):  # Thử 60 lần (warmup model có thể mất vài chục giây)
         try:
             response = requests.get("http://localhost:8002/health", timeout=2)
             if response.status_code == 200:
                 return True
+            if response.status_code == 503:
+                print("⏳ Backend đang warmup...")
         except:
             pass
         time.sleep(1)
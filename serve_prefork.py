@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Chạy API với nhiều worker process dùng chung model (pre-fork)
+
+Process cha load encoder + reranker một lần, bind socket rồi fork API_WORKERS worker.
+Các worker dùng chung trang bộ nhớ chứa weights theo cơ chế copy-on-write (model ở
+chế độ eval, không ghi vào weights) nên số worker tăng theo số core chứ không theo RAM.
+
+Lưu ý: CUDA không dùng được sau khi fork, nên khi có GPU mỗi worker tự load model.
+"""
+
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import uvicorn
+import torch
+
+from config.settings import settings
+from services.model_registry import preload_models, get_loaded_models, configure_torch_threads
+
+HOST = "0.0.0.0"
+PORT = 8002
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """Bind socket ở process cha để mọi worker cùng accept trên một cổng"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket, index: int, torch_threads: int):
+    """Chạy uvicorn trong worker process (sau fork)"""
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    configure_torch_threads(torch_threads)
+    print(f"[worker {index}] pid={os.getpid()} torch_threads={torch.get_num_threads()}")
+
+    config = uvicorn.Config("api_modular:app", log_level="info")
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+def main():
+    workers = max(1, settings.API_WORKERS)
+    torch_threads = settings.TORCH_NUM_THREADS or max(1, (os.cpu_count() or 1) // workers)
+
+    print("=" * 70)
+    print(f"🚀 Pre-fork API: {workers} workers, {torch_threads} torch threads/worker, port {PORT}")
+    print("=" * 70)
+
+    sock = bind_socket(HOST, PORT)
+
+    if torch.cuda.is_available():
+        print("⚠️ Có CUDA - bỏ qua preload, mỗi worker tự load model lên GPU")
+    else:
+        # Load với 1 luồng để thread pool của torch/OpenMP chưa khởi tạo trước khi fork
+        torch.set_num_threads(1)
+        start_time = time.time()
+        preload_models(use_rerank=True)
+        print(f"✅ Đã load {get_loaded_models()} trong {time.time() - start_time:.1f}s")
+
+    # Đưa toàn bộ object hiện có ra khỏi GC để GC của worker không ghi vào các trang dùng chung
+    gc.collect()
+    gc.freeze()
+
+    children = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock, index, torch_threads)
+            finally:
+                os._exit(0)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(workers):
+        spawn(index)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # Theo dõi worker, khởi động lại worker chết bất thường
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"⚠️ Worker {index} (pid={pid}) đã dừng với status {status}, khởi động lại...")
+            time.sleep(1)
+            spawn(index)
+
+    sock.close()
+    print("👋 Đã dừng tất cả worker")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+from typing import Any, Dict, Optional
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import threading
+import time
+
+
+class AdmissionRejected(Exception):
+    """Request bị từ chối vì hệ thống đang quá tải - API trả về status_code kèm Retry-After"""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class StageSaturated(AdmissionRejected):
+    """Một stage (encoder, reranker, llm) không còn slot trong thời gian chờ cho phép"""
+
+    def __init__(self, stage: str, retry_after: int):
+        super().__init__(503, f"Stage {stage} đang quá tải", retry_after)
+        self.stage = stage
+
+
+def _resolve_future(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _percentile(samples, percentile: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class AdmissionController:
+    """Giới hạn số request chạy đồng thời, hàng chờ có giới hạn và deadline chờ cho mỗi request
+
+    - Còn slot: request chạy ngay
+    - Hết slot nhưng hàng chờ còn chỗ: chờ tối đa queue_timeout giây, quá hạn -> 503
+    - Hàng chờ đầy: từ chối ngay -> 429
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float, retry_after: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._in_flight = 0
+        self._waiting = 0
+
+        # Thống kê
+        self._admitted = 0
+        self._rejected_queue_full = 0
+        self._rejected_deadline = 0
+        self._wait_samples = deque(maxlen=1000)
+
+    async def acquire(self):
+        """Chiếm một slot, raise AdmissionRejected nếu hàng chờ đầy hoặc chờ quá hạn"""
+        # Còn slot -> chiếm ngay (acquire không phải chờ khi semaphore chưa bị khóa)
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            self._wait_samples.append(0.0)
+            self._in_flight += 1
+            self._admitted += 1
+            return
+
+        if self._waiting >= self.max_queue:
+            self._rejected_queue_full += 1
+            raise AdmissionRejected(429, "Hàng chờ đã đầy, vui lòng thử lại sau", self.retry_after)
+
+        start_time = time.monotonic()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._rejected_deadline += 1
+            raise AdmissionRejected(503, "Hệ thống đang quá tải, vui lòng thử lại sau", self.retry_after)
+        finally:
+            self._waiting -= 1
+            self._wait_samples.append(time.monotonic() - start_time)
+
+        self._in_flight += 1
+        self._admitted += 1
+
+    def release(self):
+        """Trả slot"""
+        self._in_flight -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Context manager chiếm slot trong suốt quá trình xử lý request"""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê hàng chờ và thời gian chờ"""
+        samples = list(self._wait_samples)
+        return {
+            "in_flight": self._in_flight,
+            "max_concurrent": self.max_concurrent,
+            "queue_depth": self._waiting,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "admitted": self._admitted,
+            "rejected_queue_full": self._rejected_queue_full,
+            "rejected_deadline": self._rejected_deadline,
+            "wait_ms_avg": sum(samples) / len(samples) * 1000 if samples else 0.0,
+            "wait_ms_p95": _percentile(samples, 95) * 1000,
+            "wait_ms_max": max(samples) * 1000 if samples else 0.0
+        }
+
+
+class StageLimiter:
+    """Giới hạn số luồng chạy đồng thời cho từng stage của pipeline (encoder, reranker, llm)
+
+    Dùng trong các luồng của executor; nếu không chiếm được slot trong acquire_timeout
+    giây thì raise StageSaturated để API trả về 503 thay vì dồn thêm việc.
+    """
+
+    def __init__(self, limits: Dict[str, int], acquire_timeout: float, retry_after: int):
+        self.limits = dict(limits)
+        self.acquire_timeout = acquire_timeout
+        self.retry_after = retry_after
+
+        self._semaphores = {stage: threading.BoundedSemaphore(limit) for stage, limit in limits.items()}
+        self._lock = threading.Lock()
+        self._active = {stage: 0 for stage in limits}
+        self._waiting = {stage: 0 for stage in limits}
+        self._rejected = {stage: 0 for stage in limits}
+        # Coroutine đang chờ slot: (event loop, future) - được đánh thức khi có slot trả về
+        self._async_waiters = {stage: deque() for stage in limits}
+
+    @contextmanager
+    def acquire(self, stage: str, timeout: Optional[float] = None):
+        """Chiếm một slot của stage trong suốt khối with"""
+        semaphore = self._semaphores[stage]
+        timeout = self.acquire_timeout if timeout is None else timeout
+
+        with self._lock:
+            self._waiting[stage] += 1
+        acquired = semaphore.acquire(timeout=timeout)
+        with self._lock:
+            self._waiting[stage] -= 1
+            if acquired:
+                self._active[stage] += 1
+            else:
+                self._rejected[stage] += 1
+
+        if not acquired:
+            raise StageSaturated(stage, self.retry_after)
+
+        try:
+            yield
+        finally:
+            self._release(stage)
+
+    @asynccontextmanager
+    async def aacquire(self, stage: str, timeout: Optional[float] = None):
+        """Phiên bản async của acquire - chờ slot ngay trên event loop
+
+        Không tốn thread nào cho request đang chờ, nên một process giữ được hàng trăm
+        request chờ LLM cùng lúc mà không chiếm hết thread pool mặc định của asyncio.
+        """
+        timeout = self.acquire_timeout if timeout is None else timeout
+
+        with self._lock:
+            self._waiting[stage] += 1
+        try:
+            acquired = await self._await_slot(stage, timeout)
+        except asyncio.CancelledError:
+            with self._lock:
+                self._waiting[stage] -= 1
+            raise
+        with self._lock:
+            self._waiting[stage] -= 1
+            if acquired:
+                self._active[stage] += 1
+            else:
+                self._rejected[stage] += 1
+
+        if not acquired:
+            raise StageSaturated(stage, self.retry_after)
+
+        try:
+            yield
+        finally:
+            self._release(stage)
+
+    async def _await_slot(self, stage: str, timeout: float) -> bool:
+        """Chờ tới khi lấy được slot hoặc hết timeout"""
+        semaphore = self._semaphores[stage]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            waiter = (loop, loop.create_future())
+            # Đăng ký trước khi thử để không lỡ lần release xảy ra giữa hai bước
+            with self._lock:
+                self._async_waiters[stage].append(waiter)
+            if semaphore.acquire(blocking=False):
+                self._forget_waiter(stage, waiter)
+                return True
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self._forget_waiter(stage, waiter)
+                return False
+
+            try:
+                await asyncio.wait({waiter[1]}, timeout=remaining)
+            except asyncio.CancelledError:
+                # Đã được đánh thức nhưng không dùng slot - chuyển lượt cho coroutine chờ tiếp theo
+                if not self._forget_waiter(stage, waiter):
+                    self._wake_next(stage)
+                raise
+            self._forget_waiter(stage, waiter)
+
+    def _forget_waiter(self, stage: str, waiter) -> bool:
+        """Bỏ waiter khỏi hàng chờ; False nếu nó đã được đánh thức trước đó"""
+        with self._lock:
+            try:
+                self._async_waiters[stage].remove(waiter)
+                return True
+            except ValueError:
+                return False
+
+    def _wake_next(self, stage: str):
+        with self._lock:
+            if not self._async_waiters[stage]:
+                return
+            loop, future = self._async_waiters[stage].popleft()
+        try:
+            loop.call_soon_threadsafe(_resolve_future, future)
+        except RuntimeError:
+            # Event loop của waiter đã đóng
+            pass
+
+    def _release(self, stage: str):
+        with self._lock:
+            self._active[stage] -= 1
+        self._semaphores[stage].release()
+        self._wake_next(stage)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê theo stage"""
+        with self._lock:
+            return {
+                stage: {
+                    "limit": self.limits[stage],
+                    "active": self._active[stage],
+                    "waiting": self._waiting[stage],
+                    "rejected": self._rejected[stage]
+                }
+                for stage in self.limits
+            }
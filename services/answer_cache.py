@@ -0,0 +1,175 @@
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional
+from collections import OrderedDict
+import itertools
+import numpy as np
+import threading
+import time
+
+
+class _AnswerEntry:
+    """Một câu trả lời đã cache: embedding (đã chuẩn hóa) của enhanced query và fingerprint sản phẩm"""
+
+    __slots__ = ("query", "embedding", "product_ids", "route", "answer", "created_at")
+
+    def __init__(self, query: str, embedding: np.ndarray, product_ids: FrozenSet[str],
+                 route: str, answer: str):
+        self.query = query
+        self.embedding = embedding
+        self.product_ids = product_ids
+        self.route = route
+        self.answer = answer
+        self.created_at = time.monotonic()
+
+
+class SemanticAnswerCache:
+    """Cache câu trả lời theo embedding của enhanced query và các sản phẩm top sau rerank
+
+    Câu hỏi diễn đạt khác nhau nhưng cùng ý ("kem chống nắng cho da dầu" / "da dầu nên dùng
+    kem chống nắng nào") dùng lại câu trả lời khi cosine similarity >= similarity_threshold
+    và tập product_id top product_match_top_k trùng nhau (cùng context -> cùng câu trả lời).
+
+    Cache bị xóa khi catalog được index lại: catalog_version_fn (nếu có) được gọi tối đa mỗi
+    catalog_check_seconds, giá trị thay đổi thì toàn bộ câu trả lời cũ bị bỏ.
+    Câu trả lời trong excluded_answers (câu fallback khi LLM lỗi) không bao giờ được lưu.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 3600,
+                 similarity_threshold: float = 0.92, product_match_top_k: int = 3,
+                 routes: Iterable[str] = ("QUESTION",),
+                 catalog_version_fn: Optional[Callable[[], Optional[str]]] = None,
+                 catalog_check_seconds: float = 30, excluded_answers: Iterable[str] = ()):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.product_match_top_k = product_match_top_k
+        self.routes = {route.upper() for route in routes}
+        self.catalog_version_fn = catalog_version_fn
+        self.catalog_check_seconds = catalog_check_seconds
+        self.excluded_answers = frozenset(answer.strip() for answer in excluded_answers)
+
+        # OrderedDict theo thứ tự truy cập: đầu = lâu nhất chưa dùng
+        self._entries: "OrderedDict[int, _AnswerEntry]" = OrderedDict()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+        self._catalog_version: Optional[str] = None
+        self._catalog_checked_at = 0.0
+        self._catalog_lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evicted_ttl = 0
+        self._evicted_lru = 0
+        self._invalidations = 0
+
+    def enabled_for(self, route: str) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0 and route in self.routes
+
+    def product_fingerprint(self, search_results: List[Dict[str, Any]]) -> FrozenSet[str]:
+        """Tập product_id của các sản phẩm đầu tiên (khác nhau) trong kết quả đã rerank"""
+        product_ids = []
+        for doc in search_results:
+            product_id = doc.get("metadata", {}).get("product_id")
+            if product_id is None or str(product_id) in product_ids:
+                continue
+            product_ids.append(str(product_id))
+            if len(product_ids) >= self.product_match_top_k:
+                break
+        return frozenset(product_ids)
+
+    def lookup(self, embedding: np.ndarray, search_results: List[Dict[str, Any]],
+               route: str) -> Optional[Dict[str, Any]]:
+        """Tìm câu trả lời đã cache; trả về {"answer", "query", "similarity"} hoặc None"""
+        if embedding is None or not search_results or not self.enabled_for(route):
+            return None
+        self._check_catalog()
+
+        query_vector = self._normalize(embedding)
+        product_ids = self.product_fingerprint(search_results)
+        now = time.monotonic()
+
+        with self._lock:
+            best_id, best_similarity = None, -1.0
+            for entry_id, entry in list(self._entries.items()):
+                if now - entry.created_at > self.ttl_seconds:
+                    del self._entries[entry_id]
+                    self._evicted_ttl += 1
+                    continue
+                if entry.route != route or entry.product_ids != product_ids:
+                    continue
+                similarity = float(np.dot(query_vector, entry.embedding))
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            if best_id is None or best_similarity < self.similarity_threshold:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(best_id)
+            self._hits += 1
+            entry = self._entries[best_id]
+        return {"answer": entry.answer, "query": entry.query, "similarity": round(best_similarity, 4)}
+
+    def store(self, query: str, embedding: np.ndarray, search_results: List[Dict[str, Any]],
+              route: str, answer: str):
+        if embedding is None or not search_results or not answer or not self.enabled_for(route):
+            return
+        if answer.strip() in self.excluded_answers:
+            return
+        entry = _AnswerEntry(query, self._normalize(embedding), self.product_fingerprint(search_results), route, answer)
+        with self._lock:
+            self._entries[next(self._ids)] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evicted_lru += 1
+
+    def invalidate(self, reason: str = "manual") -> int:
+        """Xóa toàn bộ câu trả lời đã cache, trả về số entry bị xóa"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._invalidations += 1
+        print(f"Đã xóa {count} câu trả lời trong semantic answer cache ({reason})")
+        return count
+
+    def _check_catalog(self):
+        """Xóa cache nếu catalog đã được index lại kể từ lần kiểm tra trước"""
+        if self.catalog_version_fn is None:
+            return
+        now = time.monotonic()
+        if now - self._catalog_checked_at < self.catalog_check_seconds:
+            return
+        # Chỉ một luồng kiểm tra, các luồng khác dùng kết quả lần trước
+        if not self._catalog_lock.acquire(blocking=False):
+            return
+        try:
+            self._catalog_checked_at = now
+            version = self.catalog_version_fn()
+            if version is None:
+                return
+            if self._catalog_version is not None and version != self._catalog_version:
+                self.invalidate("reindex")
+            self._catalog_version = version
+        finally:
+            self._catalog_lock.release()
+
+    def _normalize(self, embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm > 0 else vector
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "similarity_threshold": self.similarity_threshold,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evicted_ttl": self._evicted_ttl,
+                "evicted_lru": self._evicted_lru,
+                "invalidations": self._invalidations
+            }
@@ -0,0 +1,81 @@
+from typing import Any, Dict, List, Optional
+from config.settings import settings
+from services.metrics import metrics
+import threading
+import time
+
+
+# Các mức giảm chất lượng, theo thứ tự được áp dụng khi thời gian còn lại giảm dần
+DEGRADE_SHRINK_SEARCH = "shrink_search_limit"
+DEGRADE_SHORTEN_RERANK = "shorten_rerank"
+DEGRADE_SKIP_RERANK = "skip_rerank"
+DEGRADE_TRIM_CONTEXT = "trim_context"
+DEGRADE_SKIP_ENHANCEMENT = "skip_query_enhancement"
+
+
+class RequestDeadline:
+    """Latency budget của một request, tính từ lúc request tới (gồm cả thời gian chờ trong hàng đợi)
+
+    Mỗi stage hỏi deadline trước khi chạy: nếu thời gian còn lại dưới ngưỡng của một mức
+    giảm chất lượng thì stage chạy bản rẻ hơn và mức đó được ghi vào degradations.
+    """
+
+    def __init__(self, budget_ms: float, thresholds_ms: Optional[Dict[str, float]] = None):
+        self.budget_ms = budget_ms
+        self.thresholds_ms = thresholds_ms or default_thresholds()
+        self._start_time = time.monotonic()
+        self._degradations: List[str] = []
+        self._lock = threading.Lock()
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self._start_time) * 1000
+
+    def remaining_ms(self) -> float:
+        return self.budget_ms - self.elapsed_ms()
+
+    def call_timeout(self, max_seconds: float) -> float:
+        """Thời gian chờ tối đa (giây) cho lời gọi tiếp theo: phần budget còn lại, không quá max_seconds"""
+        return max(0.0, min(max_seconds, self.remaining_ms() / 1000))
+
+    def should_degrade(self, degradation: str) -> bool:
+        """True (và ghi lại) nếu thời gian còn lại thấp hơn ngưỡng của mức giảm chất lượng"""
+        threshold = self.thresholds_ms.get(degradation)
+        if threshold is None or self.remaining_ms() >= threshold:
+            return False
+        with self._lock:
+            if degradation in self._degradations:
+                return True
+            self._degradations.append(degradation)
+        metrics.record_degradation(degradation)
+        return True
+
+    @property
+    def degradations(self) -> List[str]:
+        with self._lock:
+            return list(self._degradations)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "budget_ms": self.budget_ms,
+            "elapsed_ms": round(self.elapsed_ms(), 2),
+            "degradations": self.degradations
+        }
+
+
+def default_thresholds() -> Dict[str, float]:
+    """Ngưỡng thời gian còn lại (ms) cho từng mức giảm chất lượng, lấy từ settings"""
+    return {
+        DEGRADE_SHRINK_SEARCH: settings.DEADLINE_SHRINK_SEARCH_MS,
+        DEGRADE_SHORTEN_RERANK: settings.DEADLINE_SHORTEN_RERANK_MS,
+        DEGRADE_SKIP_RERANK: settings.DEADLINE_SKIP_RERANK_MS,
+        DEGRADE_TRIM_CONTEXT: settings.DEADLINE_TRIM_CONTEXT_MS,
+        DEGRADE_SKIP_ENHANCEMENT: settings.DEADLINE_SKIP_ENHANCEMENT_MS
+    }
+
+
+def create_deadline(budget_ms: Optional[float] = None) -> Optional[RequestDeadline]:
+    """Tạo deadline với budget của request hoặc REQUEST_DEADLINE_MS; None nếu tắt (budget <= 0)"""
+    budget_ms = settings.REQUEST_DEADLINE_MS if budget_ms is None else budget_ms
+    if budget_ms <= 0:
+        return None
+    return RequestDeadline(budget_ms)
@@ -0,0 +1,76 @@
+from typing import Any, Dict, Hashable, Optional
+from collections import OrderedDict
+import numpy as np
+import threading
+
+
+class EmbeddingCache:
+    """Cache LRU embedding của query theo (model, query đã làm sạch), an toàn giữa các luồng
+
+    Vector được lưu dạng float32 liền mạch, chỉ đọc (768 chiều ~ 3KB mỗi entry) để caller không
+    sửa được vector dùng chung. Embedding của một model không đổi theo thời gian nên không có TTL.
+    max_entries <= 0 tắt cache (get luôn miss, set không lưu).
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+
+        # OrderedDict theo thứ tự truy cập: đầu = lâu nhất chưa dùng
+        self._entries: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evicted_lru = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return vector
+
+    def set(self, key: Hashable, embedding: np.ndarray) -> np.ndarray:
+        """Lưu embedding, trả về bản float32 chỉ đọc đã lưu (hoặc bản đã có sẵn của key)"""
+        vector = np.ascontiguousarray(embedding, dtype=np.float32).copy()
+        vector.flags.writeable = False
+        if not self.enabled:
+            return vector
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None:
+                self._entries.move_to_end(key)
+                return existing
+            self._entries[key] = vector
+            self._bytes += vector.nbytes
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._evicted_lru += 1
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evicted_lru": self._evicted_lru
+            }
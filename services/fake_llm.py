@@ -0,0 +1,148 @@
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from services.prompt_budget import count_tokens
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+
+
+# Câu hỏi trong prompt của unified chain: CÂU HỎI HIỆN TẠI: "..."
+_QUERY_RE = re.compile(r'CÂU HỎI HIỆN TẠI:\s*"(.*)"')
+_GREETING_RE = re.compile(r"\b(xin chào|hello|hi|chào|cảm ơn|thanks|tạm biệt|bye)\b")
+_ANSWER_WORDS = (
+    "sản phẩm", "phù hợp", "với", "làn da", "của bạn", "giúp", "dưỡng ẩm", "bảo vệ", "da",
+    "hiệu quả", "nên", "dùng", "mỗi ngày", "kết cấu", "nhẹ", "thấm nhanh", "giá", "tốt"
+)
+
+
+class LatencyModel:
+    """Phân phối thời gian tới token đầu tiên (giây) và tốc độ sinh token
+
+    distribution: "fixed" (luôn bằng median), "uniform" (median ± spread * median)
+    hoặc "lognormal" (median, sigma = spread - có đuôi dài giống API thật).
+    tokens_per_second <= 0 thì toàn bộ output trả về ngay sau token đầu.
+    """
+
+    def __init__(self, distribution: str = "lognormal", median_ms: float = 800, spread: float = 0.5,
+                 tokens_per_second: float = 150, seed: int = 42):
+        if distribution not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Phân phối latency không hỗ trợ: {distribution}")
+        self.distribution = distribution
+        self.median = median_ms / 1000
+        self.spread = spread
+        self.tokens_per_second = tokens_per_second
+        # Cùng seed và cùng thứ tự lời gọi -> cùng dãy latency
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def first_token_delay(self) -> float:
+        with self._lock:
+            if self.distribution == "fixed":
+                return self.median
+            if self.distribution == "uniform":
+                return max(0.0, self._random.uniform(self.median * (1 - self.spread), self.median * (1 + self.spread)))
+            return self._random.lognormvariate(math.log(self.median), self.spread) if self.median > 0 else 0.0
+
+    def token_delay(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model cục bộ, tất định, thay Gemini khi load test / CI
+
+    Lời gọi ở JSON mode (unified chain) trả về intent / enhanced_query / filters theo câu hỏi trong
+    prompt; các lời gọi khác trả về câu trả lời output_tokens âm tiết, sinh từ hash của prompt
+    (cùng prompt -> cùng câu trả lời). Latency theo LatencyModel.
+    """
+
+    model: str = "fake"
+    latency: Any
+    output_tokens: int = 120
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        pieces, usage = self._respond(messages, kwargs)
+        time.sleep(self.latency.first_token_delay() + self.latency.token_delay() * (len(pieces) - 1))
+        message = AIMessage(content="".join(pieces), usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        pieces, usage = self._respond(messages, kwargs)
+        await asyncio.sleep(self.latency.first_token_delay() + self.latency.token_delay() * (len(pieces) - 1))
+        message = AIMessage(content="".join(pieces), usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        pieces, usage = self._respond(messages, kwargs)
+        time.sleep(self.latency.first_token_delay())
+        for index, piece in enumerate(pieces):
+            if index:
+                time.sleep(self.latency.token_delay())
+            if run_manager:
+                run_manager.on_llm_new_token(piece)
+            yield ChatGenerationChunk(message=self._chunk(piece, usage if index == len(pieces) - 1 else None))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        pieces, usage = self._respond(messages, kwargs)
+        await asyncio.sleep(self.latency.first_token_delay())
+        for index, piece in enumerate(pieces):
+            if index:
+                await asyncio.sleep(self.latency.token_delay())
+            if run_manager:
+                await run_manager.on_llm_new_token(piece)
+            yield ChatGenerationChunk(message=self._chunk(piece, usage if index == len(pieces) - 1 else None))
+
+    def _chunk(self, piece: str, usage: Optional[Dict[str, int]]) -> AIMessageChunk:
+        # usage_metadata của chunk là phần tăng thêm -> chỉ gắn vào chunk cuối
+        return AIMessageChunk(content=piece, usage_metadata=usage) if usage else AIMessageChunk(content=piece)
+
+    def _respond(self, messages: List[BaseMessage], kwargs: Dict[str, Any]) -> Tuple[List[str], Dict[str, int]]:
+        """Trả về (các đoạn output theo token, usage_metadata)"""
+        prompt = "\n".join(str(message.content) for message in messages)
+        if kwargs.get("response_mime_type") == "application/json":
+            pieces = [self._unified_json(prompt)]
+        else:
+            pieces = self._answer_pieces(prompt)
+        input_tokens = count_tokens(prompt)
+        output_tokens = count_tokens("".join(pieces))
+        usage = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens
+        }
+        return pieces, usage
+
+    def _unified_json(self, prompt: str) -> str:
+        match = _QUERY_RE.search(prompt)
+        query = match.group(1).strip() if match else prompt.strip().splitlines()[-1].strip()
+        intent = "GREETING" if _GREETING_RE.search(query.lower()) else "QUESTION"
+        return json.dumps({
+            "intent": intent,
+            "enhanced_query": query,
+            "filters": {"brand": None, "category": None, "price_min": None, "price_max": None, "chunk_type": None}
+        }, ensure_ascii=False)
+
+    def _answer_pieces(self, prompt: str) -> List[str]:
+        """output_tokens âm tiết (~1 token mỗi âm tiết), mỗi âm tiết là một chunk khi stream"""
+        rng = random.Random(hashlib.sha1(prompt.encode("utf-8")).hexdigest())
+        syllables = []
+        while len(syllables) < max(1, self.output_tokens):
+            syllables.extend(rng.choice(_ANSWER_WORDS).split())
+        syllables = syllables[:max(1, self.output_tokens)]
+        syllables[0] = syllables[0].capitalize()
+        syllables[-1] += "."
+        return [syllables[0]] + [f" {syllable}" for syllable in syllables[1:]]
@@ -0,0 +1,129 @@
+from typing import Any, Dict, List, Optional, Tuple
+from services.query_utils import normalize_query
+import random
+import re
+
+
+INTENT_GREETING = "greeting"
+INTENT_THANKS = "thanks"
+INTENT_GOODBYE = "goodbye"
+
+# Cụm từ nhận diện từng intent (so khớp theo nguyên từ, ưu tiên cụm dài hơn)
+INTENT_PHRASES = {
+    INTENT_GREETING: ["xin chào", "chào", "hello", "hi", "hey", "alo", "helo"],
+    INTENT_THANKS: ["cảm ơn", "cám ơn", "thank you", "thanks", "thank", "tks", "thx"],
+    INTENT_GOODBYE: ["tạm biệt", "hẹn gặp lại", "goodbye", "bye"]
+}
+
+# Khi một câu có nhiều intent (vd. "chào shop, cảm ơn nhé") thì lấy intent đứng sau trong danh sách
+INTENT_PRIORITY = [INTENT_GREETING, INTENT_THANKS, INTENT_GOODBYE]
+
+# Từ đệm / xưng hô không làm thay đổi ý nghĩa câu chào
+FILLER_WORDS = {
+    "bạn", "shop", "ad", "admin", "hasaki", "bot", "em", "anh", "chị", "mình", "you", "all",
+    "ạ", "à", "nhé", "nhá", "nha", "ơi", "nhiều", "rất", "lắm", "nhaa", "vâng", "dạ", "ok", "oke",
+    "lại", "cả", "mọi", "người"
+}
+
+_NON_WORD_RE = re.compile(r"[^\w\s]+")
+
+
+class LocalIntentClassifier:
+    """Phân loại cục bộ các câu chào / cảm ơn / tạm biệt hiển nhiên, không cần gọi LLM
+
+    Câu chỉ gồm cụm từ chào hỏi và từ đệm được coi là chắc chắn (confidence 1.0). Câu có
+    thêm nội dung khác (vd. "chào shop, kem chống nắng nào tốt?") có confidence thấp và
+    được để cho LLM xử lý.
+    """
+
+    def __init__(self, min_confidence: float = 0.9, max_words: int = 8):
+        self.min_confidence = min_confidence
+        self.max_words = max_words
+        # Cụm từ dài xét trước để "xin chào" không bị tách thành "xin" + "chào"
+        self._phrases = sorted(
+            (
+                (tuple(phrase.split()), intent)
+                for intent, phrases in INTENT_PHRASES.items()
+                for phrase in phrases
+            ),
+            key=lambda item: len(item[0]),
+            reverse=True
+        )
+
+    def classify(self, user_query: str) -> Optional[Dict[str, Any]]:
+        """Trả về {"intent", "confidence"} nếu đủ chắc chắn, ngược lại None"""
+        words = self._tokenize(user_query)
+        if not words or len(words) > self.max_words:
+            return None
+
+        intents, known_words = self._match(words)
+        if not intents:
+            return None
+
+        confidence = known_words / len(words)
+        if confidence < self.min_confidence:
+            return None
+
+        intent = max(intents, key=INTENT_PRIORITY.index)
+        return {"intent": intent, "confidence": round(confidence, 2)}
+
+    def mentions_intent(self, user_query: str) -> bool:
+        """Query có chứa cụm chào hỏi / cảm ơn / tạm biệt nào không (kể cả khi lẫn nội dung khác)"""
+        intents, _ = self._match(self._tokenize(user_query))
+        return bool(intents)
+
+    def _tokenize(self, user_query: str) -> List[str]:
+        return _NON_WORD_RE.sub(" ", normalize_query(user_query)).split()
+
+    def _match(self, words: List[str]) -> Tuple[List[str], int]:
+        """Tìm các intent xuất hiện và đếm số từ thuộc cụm chào hỏi hoặc từ đệm"""
+        intents = []
+        known_words = 0
+        position = 0
+        while position < len(words):
+            for phrase, intent in self._phrases:
+                if tuple(words[position:position + len(phrase)]) == phrase:
+                    intents.append(intent)
+                    known_words += len(phrase)
+                    position += len(phrase)
+                    break
+            else:
+                if words[position] in FILLER_WORDS:
+                    known_words += 1
+                position += 1
+        return intents, known_words
+
+
+class TemplateResponder:
+    """Trả lời GREETING bằng câu mẫu, cá nhân hóa theo entities trong memory của session"""
+
+    def __init__(self, templates: Dict[str, List[str]]):
+        self.templates = templates
+
+    def render(self, intent: str, memory_entities: Optional[Dict[str, List[str]]] = None) -> str:
+        templates = self.templates.get(intent) or self.templates.get(INTENT_GREETING) or ["Xin chào! {suggestion}"]
+        template = random.choice(templates)
+        suggestion = self._build_suggestion(memory_entities or {})
+        try:
+            return template.format(suggestion=suggestion).strip()
+        except (KeyError, IndexError, ValueError):
+            # Template cấu hình sai placeholder - trả nguyên văn
+            return template
+
+    def _build_suggestion(self, memory_entities: Dict[str, List[str]]) -> str:
+        """Gợi ý tiếp theo dựa trên sản phẩm / thương hiệu / danh mục gần nhất trong hội thoại
+
+        Chỉ dùng tên sản phẩm từ metadata (served_products) - recent_products là các dòng trích
+        nguyên văn từ câu trả lời, không đủ sạch để chèn vào câu mẫu.
+        """
+        served_products = memory_entities.get("served_products") or []
+        recent_brands = memory_entities.get("recent_brands") or []
+        recent_categories = memory_entities.get("recent_categories") or []
+
+        if served_products:
+            return f"Bạn có muốn tìm hiểu thêm về {served_products[-1]} không?"
+        if recent_brands:
+            return f"Bạn có muốn xem thêm sản phẩm của {recent_brands[-1]} không?"
+        if recent_categories:
+            return f"Bạn có muốn mình tư vấn thêm về {recent_categories[-1]} không?"
+        return "Mình có thể giúp gì cho bạn về mỹ phẩm hôm nay?"
@@ -0,0 +1 @@
+# Callbacks package
\ No newline at end of file
@@ -0,0 +1,43 @@
+from typing import Any, Dict, List
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from services.request_trace import current_trace
+
+
+class PromptTraceCallback(BaseCallbackHandler):
+    """Ghi độ dài prompt và số token (theo usage_metadata của Gemini) vào trace của request"""
+
+    # Handler rất nhẹ: chạy ngay trên event loop khi dùng ainvoke / astream thay vì
+    # chuyển sang thread pool mặc định (tránh bị kẹt sau các việc blocking khác)
+    run_inline = True
+
+    def __init__(self, prompt_name: str):
+        self.prompt_name = prompt_name
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        trace = current_trace()
+        if trace is not None:
+            trace.add_prompt(self.prompt_name, chars=sum(len(prompt) for prompt in prompts))
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], **kwargs: Any) -> None:
+        trace = current_trace()
+        if trace is not None:
+            chars = sum(len(str(message.content)) for batch in messages for message in batch)
+            trace.add_prompt(self.prompt_name, chars=chars)
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        trace = current_trace()
+        if trace is None:
+            return
+
+        usage = None
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or usage
+        if usage:
+            trace.add_prompt(
+                self.prompt_name,
+                input_tokens=usage.get("input_tokens"),
+                output_tokens=usage.get("output_tokens")
+            )
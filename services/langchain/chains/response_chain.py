@@ -1,55 +1,129 @@
-from typing import Dict, Any, List
-from langchain.chains import LLMChain
-from langchain_google_genai import ChatGoogleGenerativeAI
+from typing import Dict, Any, List, AsyncIterator, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from services.metrics import metrics
+from services.langchain.callbacks.trace_callback import PromptTraceCallback
+import asyncio
+import time
+
 
 
 class ResponseChain:
     """Chain để tạo response - Focus vào sản phẩm hiện tại, tránh nhầm lẫn với lịch sử và tạo link sản phẩm"""
     
-    def __init__(self, llm: ChatGoogleGenerativeAI):
+    def __init__(self, llm: BaseChatModel, timeout: Optional[float] = None):
         self.llm = llm
+        # Thời gian tối đa chờ Gemini cho bản async / stream (None = không giới hạn)
+        self.timeout = timeout
         self.greeting_template = self._get_greeting_template()
         self.question_template = self._get_question_template()
         
-        self.greeting_chain = LLMChain(llm=self.llm, prompt=self.greeting_template, verbose=False)
-        self.question_chain = LLMChain(llm=self.llm, prompt=self.question_template, verbose=False)
+        # Runnable chains: invoke cho luồng đồng bộ, ainvoke / astream cho luồng async
+        self.greeting_chain = self.greeting_template | self.llm | StrOutputParser()
+        self.question_chain = self.question_template | self.llm | StrOutputParser()
+        
+        # Ghi độ dài prompt và số token vào trace của request
+        self.greeting_callback = PromptTraceCallback("greeting")
+        self.question_callback = PromptTraceCallback("question")
     
-    def generate_response(self, query_info: Dict[str, Any], context: str, chat_history: str, route: str) -> str:
-        """Tạo response - focus vào câu hỏi hiện tại và tạo link sản phẩm"""
+    def generate_response(self, query_info: Dict[str, Any], context: str, chat_history: str, route: str,
+                          timeout: Optional[float] = None) -> str:
+        """Tạo response - focus vào câu hỏi hiện tại và tạo link sản phẩm
+        
+        timeout: thời gian còn lại cho lời gọi (giây); bản đồng bộ chỉ dùng để bỏ qua Gemini khi đã hết.
+        Lỗi / hết thời gian được raise để caller trả câu fallback (và không lưu nó vào cache / memory).
+        """
+        if timeout is not None and timeout <= 0:
+            print("Hết thời gian của request - bỏ qua response generation")
+            metrics.record_error("response_chain_timeout")
+            raise TimeoutError("Hết thời gian của request trước khi gọi Gemini")
         try:
-            if route == "GREETING":
-                return self._generate_greeting_response(query_info, chat_history)
-            else:  # QUESTION
-                return self._generate_question_response(query_info, context, chat_history)
+            chain, inputs, config, stage = self._prepare(query_info, context, chat_history, route)
+            with metrics.time_stage(stage):
+                return chain.invoke(inputs, config=config)
         except Exception as e:
             print(f"Error generating response: {e}")
-            return "Xin lỗi, tôi không thể tạo phản hồi cho câu hỏi này."
+            metrics.record_error("response_chain")
+            raise
     
-    def _generate_greeting_response(self, query_info: Dict[str, Any], chat_history: str) -> str:
-        """Tạo response cho greeting"""
-        query = query_info.get("enhanced_query", "")
+    async def agenerate_response(self, query_info: Dict[str, Any], context: str, chat_history: str,
+                                 route: str, timeout: Optional[float] = None) -> str:
+        """Bản async của generate_response - không giữ luồng trong lúc chờ Gemini
+        
+        Hết timeout (mặc định self.timeout) thì raise TimeoutError; request bị hủy thì lời gọi
+        Gemini bị hủy theo.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            chain, inputs, config, stage = self._prepare(query_info, context, chat_history, route)
+            with metrics.time_stage(stage):
+                return await asyncio.wait_for(chain.ainvoke(inputs, config=config), timeout=timeout)
+        except asyncio.TimeoutError as e:
+            print(f"Response generation timeout sau {timeout}s")
+            metrics.record_error("response_chain_timeout")
+            raise TimeoutError(f"Gemini không trả lời trong {timeout}s") from e
+        except Exception as e:
+            print(f"Error generating response: {e}")
+            metrics.record_error("response_chain")
+            raise
+    
+    async def astream_response(self, query_info: Dict[str, Any], context: str, chat_history: str,
+                               route: str, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """Stream response theo từng đoạn token ngay khi Gemini trả về
         
-        print(f"Greeting - Chat history length: {len(chat_history)} characters")
+        Toàn bộ stream bị giới hạn bởi timeout (mặc định self.timeout, raise TimeoutError);
+        consumer dừng giữa chừng hoặc request bị hủy thì stream tới Gemini được đóng ngay.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if timeout is not None and timeout <= 0:
+            print("Hết thời gian của request - bỏ qua response stream")
+            metrics.record_error("response_stream_timeout")
+            raise TimeoutError("Hết thời gian của request trước khi gọi Gemini")
+        chain, inputs, config, _ = self._prepare(query_info, context, chat_history, route, streaming=True)
+        stream = chain.astream(inputs, config=config)
         
-        return self.greeting_chain.run(
-            query=query,
-            chat_history=chat_history
-        )
+        start_time = time.perf_counter()
+        deadline = start_time + timeout if timeout else None
+        first_chunk = True
+        try:
+            while True:
+                remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout=remaining)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError as e:
+                    print(f"Response stream timeout sau {timeout}s")
+                    metrics.record_error("response_stream_timeout")
+                    raise TimeoutError(f"Gemini không stream xong trong {timeout}s") from e
+                if chunk:
+                    if first_chunk:
+                        metrics.observe_stage("llm_stream_first_token", time.perf_counter() - start_time)
+                        first_chunk = False
+                    yield chunk
+        finally:
+            await stream.aclose()
+            metrics.observe_stage(f"llm_{route.lower()}_stream", time.perf_counter() - start_time)
     
-    def _generate_question_response(self, query_info: Dict[str, Any], context: str, chat_history: str) -> str:
-        """Tạo response cho question - focus vào sản phẩm hiện tại và tạo link"""
+    def _prepare(self, query_info: Dict[str, Any], context: str, chat_history: str, route: str,
+                 streaming: bool = False):
+        """Chọn chain theo route, trả về (chain, inputs, config, tên stage)"""
         query = query_info.get("enhanced_query", "")
+        suffix = " (stream)" if streaming else ""
         
-        print(f"Question - Context length: {len(context)} characters")
-        print(f"Question - Chat history length: {len(chat_history)} characters")
-        print(f"Question - Total input length: {len(context) + len(chat_history) + len(query)} characters")
+        if route == "GREETING":
+            print(f"Greeting{suffix} - Chat history length: {len(chat_history)} characters")
+            inputs = {"query": query, "chat_history": chat_history}
+            return self.greeting_chain, inputs, {"callbacks": [self.greeting_callback]}, "llm_greeting"
         
-        return self.question_chain.run(
-            query=query,
-            context=context,
-            chat_history=chat_history
-        )
+        # QUESTION
+        print(f"Question{suffix} - Context length: {len(context)} characters")
+        print(f"Question{suffix} - Chat history length: {len(chat_history)} characters")
+        if not streaming:
+            print(f"Question - Total input length: {len(context) + len(chat_history) + len(query)} characters")
+        inputs = {"query": query, "context": context, "chat_history": chat_history}
+        return self.question_chain, inputs, {"callbacks": [self.question_callback]}, "llm_question"
     
     def _get_greeting_template(self) -> PromptTemplate:
         """Template cho greeting"""
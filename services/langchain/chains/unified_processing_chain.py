@@ -1,102 +1,280 @@
-from typing import Dict, Any
-from langchain.chains import LLMChain
-from langchain_google_genai import ChatGoogleGenerativeAI
+from typing import Dict, Any, Hashable, Literal, Optional, Tuple
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.utils.json_schema import dereference_refs
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
 from services.langchain.prompts.unified_prompts import UnifiedPrompts
+from services.langchain.memory.conversation_memory import NO_HISTORY_SUMMARY
+from services.greeting_fast_path import LocalIntentClassifier
+from services.metrics import metrics
+from services.langchain.callbacks.trace_callback import PromptTraceCallback
+from services.query_utils import normalize_query
+from services.request_trace import current_trace
+from services.ttl_cache import TTLCache
+import asyncio
+import copy
+
+
+# Giá trị "type" của chunk khi index (ContentType trong embedding/text_splitter.py)
+ChunkType = Literal["description_markdown", "general_info", "specification", "ingredient", "guide"]
+
+
+class QueryFilters(BaseModel):
+    """Bộ lọc trích từ câu hỏi - None là câu hỏi không nêu"""
+    
+    brand: Optional[str] = None
+    category: Optional[str] = None
+    price_min: Optional[int] = Field(default=None, ge=0)
+    price_max: Optional[int] = Field(default=None, ge=0)
+    chunk_type: Optional[ChunkType] = None
+    
+    @field_validator("brand", "category", "chunk_type", mode="before")
+    @classmethod
+    def _blank_to_none(cls, value):
+        if isinstance(value, str):
+            value = value.strip()
+            return value or None
+        return value
+    
+    @model_validator(mode="after")
+    def _check_price_range(self):
+        if self.price_min is not None and self.price_max is not None and self.price_min > self.price_max:
+            raise ValueError("price_min lớn hơn price_max")
+        return self
+
+
+class UnifiedQueryResult(BaseModel):
+    """Kết quả JSON của unified chain"""
+    
+    intent: Literal["GREETING", "QUESTION"]
+    enhanced_query: str = Field(min_length=1)
+    filters: QueryFilters = Field(default_factory=QueryFilters)
+    
+    @field_validator("intent", mode="before")
+    @classmethod
+    def _upper_intent(cls, value):
+        return value.strip().upper() if isinstance(value, str) else value
+    
+    @field_validator("enhanced_query", mode="before")
+    @classmethod
+    def _strip_query(cls, value):
+        return value.strip() if isinstance(value, str) else value
 
 
 class UnifiedProcessingChain:
     """Chain gộp cho cả Intent Classification và Query Enhancement"""
     
-    def __init__(self, llm: ChatGoogleGenerativeAI):
+    def __init__(self, llm: BaseChatModel, cache: Optional[TTLCache] = None,
+                 timeout: Optional[float] = None, intent_classifier: Optional[LocalIntentClassifier] = None):
         self.llm = llm
+        # Chỉ cache câu mở đầu hội thoại (chưa có lịch sử): kết quả chỉ phụ thuộc query nên lặp lại
+        # giữa các session. Câu nối tiếp phụ thuộc summary riêng của từng session, gần như không lặp lại.
+        self.cache = cache
+        # Thời gian tối đa chờ Gemini cho bản async (None = không giới hạn)
+        self.timeout = timeout
+        # Routing khi LLM lỗi / JSON vẫn sai sau khi hỏi lại - dùng chung classifier với service
+        self.intent_classifier = intent_classifier or LocalIntentClassifier()
         self.prompt_template = UnifiedPrompts.get_unified_template()
-        self.chain = LLMChain(
-            llm=self.llm,
-            prompt=self.prompt_template,
-            verbose=False
-        )
-    
-    def process_query_unified(self, query: str, chat_summary: str) -> Dict[str, Any]:
-        """Xử lý query gộp - trả về cả intent và enhanced query"""
+        # JSON mode của Gemini: output theo schema của UnifiedQueryResult, vẫn validate lại phía client
+        response_schema = dereference_refs(UnifiedQueryResult.model_json_schema())
+        response_schema.pop("$defs", None)
+        json_llm = self.llm.bind(response_mime_type="application/json", response_schema=response_schema)
+        # Runnable chain: invoke cho luồng đồng bộ, ainvoke cho luồng async
+        self.chain = self.prompt_template | json_llm | StrOutputParser()
+        # Hỏi lại tối đa một lần khi JSON không hợp lệ, kèm lỗi validate
+        self.reask_chain = UnifiedPrompts.get_reask_template() | json_llm | StrOutputParser()
+        self.trace_callback = PromptTraceCallback("unified_processing")
+    
+    def process_query_unified(self, query: str, chat_summary: str,
+                              timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Xử lý query gộp - trả về cả intent và enhanced query
+        
+        timeout: thời gian còn lại cho lời gọi (giây). Bản đồng bộ không ngắt được lời gọi đang
+        chạy nên chỉ dùng để bỏ qua Gemini (dùng fallback) khi đã hết thời gian.
+        """
+        cache_key = self._cache_key(query, chat_summary)
+        cached_result = self._get_cached(cache_key, query)
+        if cached_result is not None:
+            return cached_result
+        
+        if timeout is not None and timeout <= 0:
+            print("Hết thời gian của request - bỏ qua unified processing")
+            metrics.record_error("unified_processing_timeout")
+            metrics.record_fallback("unified_rule_based")
+            return self._fallback_processing(query)
+        
         try:
-            response = self.chain.run(
-                query=query,
-                chat_summary=chat_summary or "Chưa có lịch sử."
-            )
-            
-            # Parse response
-            result = self._parse_unified_response(response)
-            
-            # Thêm thông tin bổ sung
-            result.update({
-                "sub_queries": [result["enhanced_query"]],
-                "query_count": 1,
-                "original_query": query
-            })
+            with metrics.time_stage("llm_unified_processing"):
+                parsed = self._generate_validated(self._chain_inputs(query, chat_summary))
             
-            return result
+            if parsed is None:
+                metrics.record_fallback("unified_rule_based")
+                return self._fallback_processing(query)
+            return self._build_result(parsed, query, cache_key)
             
         except Exception as e:
             print(f"Error in unified processing: {e}")
+            metrics.record_error("unified_processing_chain")
+            metrics.record_fallback("unified_rule_based")
             return self._fallback_processing(query)
     
-    def _parse_unified_response(self, response_text: str) -> Dict[str, Any]:
-        """Parse response từ LLM"""
-        intent = "QUESTION"  # Default
-        enhanced_query = ""
+    async def aprocess_query_unified(self, query: str, chat_summary: str,
+                                     timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Bản async của process_query_unified - không giữ luồng trong lúc chờ Gemini
         
-        lines = response_text.strip().split('\n')
+        Hết timeout (mặc định self.timeout) thì dùng fallback; request bị hủy (client ngắt kết nối)
+        thì lời gọi Gemini cũng bị hủy theo (CancelledError được raise tiếp).
+        """
+        timeout = self.timeout if timeout is None else timeout
+        cache_key = self._cache_key(query, chat_summary)
+        cached_result = self._get_cached(cache_key, query)
+        if cached_result is not None:
+            return cached_result
         
-        for line in lines:
-            line = line.strip()
+        try:
+            with metrics.time_stage("llm_unified_processing"):
+                # Timeout tính cho cả lần hỏi lại
+                parsed = await asyncio.wait_for(
+                    self._agenerate_validated(self._chain_inputs(query, chat_summary)),
+                    timeout=timeout
+                )
             
-            # Parse Intent
-            if line.startswith("Intent:"):
-                intent_value = line.split(":", 1)[1].strip()
-                if intent_value in ["GREETING", "QUESTION"]:
-                    intent = intent_value
+            if parsed is None:
+                metrics.record_fallback("unified_rule_based")
+                return self._fallback_processing(query)
+            return self._build_result(parsed, query, cache_key)
             
-            # Parse Enhanced Query
-            elif line.startswith("Enhanced_Query:"):
-                enhanced_query = line.split(":", 1)[1].strip()
+        except asyncio.TimeoutError:
+            print(f"Unified processing timeout sau {timeout}s")
+            metrics.record_error("unified_processing_timeout")
+            metrics.record_fallback("unified_rule_based")
+            return self._fallback_processing(query)
+        except Exception as e:
+            print(f"Error in unified processing: {e}")
+            metrics.record_error("unified_processing_chain")
+            metrics.record_fallback("unified_rule_based")
+            return self._fallback_processing(query)
+    
+    def _generate_validated(self, inputs: Dict[str, str]) -> Optional[UnifiedQueryResult]:
+        """Gọi chain và validate JSON; không hợp lệ thì hỏi lại một lần, vẫn lỗi thì trả về None"""
+        config = {"callbacks": [self.trace_callback]}
+        response = self.chain.invoke(inputs, config=config)
+        parsed, error = self._parse_unified_response(response)
+        if parsed is not None:
+            return self._record_parse("ok", parsed)
         
-        # Fallback nếu không parse được enhanced_query
-        if not enhanced_query:
-            enhanced_query = self._extract_enhanced_query_fallback(response_text)
+        print(f"Unified JSON không hợp lệ, hỏi lại: {error}")
+        response = self.reask_chain.invoke(self._reask_inputs(inputs, response, error), config=config)
+        parsed, error = self._parse_unified_response(response)
+        return self._record_parse("reask_ok" if parsed is not None else "failed", parsed, error)
+    
+    async def _agenerate_validated(self, inputs: Dict[str, str]) -> Optional[UnifiedQueryResult]:
+        """Bản async của _generate_validated"""
+        config = {"callbacks": [self.trace_callback]}
+        response = await self.chain.ainvoke(inputs, config=config)
+        parsed, error = self._parse_unified_response(response)
+        if parsed is not None:
+            return self._record_parse("ok", parsed)
         
+        print(f"Unified JSON không hợp lệ, hỏi lại: {error}")
+        response = await self.reask_chain.ainvoke(self._reask_inputs(inputs, response, error), config=config)
+        parsed, error = self._parse_unified_response(response)
+        return self._record_parse("reask_ok" if parsed is not None else "failed", parsed, error)
+    
+    def _reask_inputs(self, inputs: Dict[str, str], response: str, error: str) -> Dict[str, str]:
+        return {**inputs, "previous_response": response or "(rỗng)", "error": error}
+    
+    def _record_parse(self, outcome: str, parsed: Optional[UnifiedQueryResult],
+                      error: Optional[str] = None) -> Optional[UnifiedQueryResult]:
+        metrics.record_unified_parse(outcome)
+        trace = current_trace()
+        if trace is not None:
+            trace.set_flag("unified_parse", outcome)
+        if parsed is None:
+            print(f"Unified JSON vẫn không hợp lệ sau khi hỏi lại, dùng fallback: {error}")
+        return parsed
+    
+    def _chain_inputs(self, query: str, chat_summary: str) -> Dict[str, str]:
         return {
-            "intent": intent,
-            "enhanced_query": enhanced_query,
-            "route": intent  # Để tương thích với code cũ
+            "query": query,
+            "chat_summary": chat_summary or "Chưa có lịch sử."
         }
     
-    def _extract_enhanced_query_fallback(self, response_text: str) -> str:
-        """Fallback để extract enhanced query"""
-        lines = response_text.strip().split('\n')
+    def _get_cached(self, cache_key: Optional[Hashable], query: str) -> Optional[Dict[str, Any]]:
+        """Kết quả đã cache (bản copy) hoặc None"""
+        if self.cache is None or cache_key is None:
+            return None
         
-        # Tìm dòng cuối cùng không rỗng
-        for line in reversed(lines):
-            line = line.strip()
-            if line and not line.startswith("Intent:") and not line.startswith("Enhanced_Query:"):
-                return line
+        found, cached_result = self.cache.get(cache_key)
+        trace = current_trace()
+        if trace is not None:
+            trace.set_flag("unified_cache", "hit" if found else "miss")
+        if not found:
+            return None
         
-        return ""
+        print(f"Unified cache hit: {query}")
+        result = copy.deepcopy(cached_result)
+        result["original_query"] = query
+        return result
+    
+    def _build_result(self, parsed: UnifiedQueryResult, query: str, cache_key: Optional[Hashable]) -> Dict[str, Any]:
+        """Chuyển kết quả đã validate sang dict của pipeline và lưu cache"""
+        result = {
+            "intent": parsed.intent,
+            "enhanced_query": parsed.enhanced_query,
+            "route": parsed.intent,  # Để tương thích với code cũ
+            "filters": parsed.filters.model_dump(),
+            "sub_queries": [parsed.enhanced_query],
+            "query_count": 1,
+            "original_query": query
+        }
+        
+        # Chỉ cache kết quả từ LLM, không cache fallback
+        if self.cache is not None and cache_key is not None:
+            self.cache.set(cache_key, copy.deepcopy(result))
+        
+        return result
+    
+    def _cache_key(self, query: str, chat_summary: str) -> Optional[Hashable]:
+        """Key theo query chuẩn hóa cho câu mở đầu hội thoại; None (không cache) nếu đã có lịch sử"""
+        if chat_summary and chat_summary != NO_HISTORY_SUMMARY:
+            return None
+        return normalize_query(query)
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        return self.cache.get_stats() if self.cache is not None else {}
+    
+    def _parse_unified_response(self, response_text: str) -> Tuple[Optional[UnifiedQueryResult], Optional[str]]:
+        """Validate JSON của LLM, trả về (kết quả, None) hoặc (None, mô tả lỗi)"""
+        text = (response_text or "").strip()
+        # Phòng khi model vẫn bọc JSON trong ```json ... ```
+        if text.startswith("```"):
+            text = text.strip("`").strip()
+            if text.lower().startswith("json"):
+                text = text[4:].strip()
+        
+        try:
+            return UnifiedQueryResult.model_validate_json(text), None
+        except ValidationError as e:
+            errors = "; ".join(
+                f"{'.'.join(str(part) for part in error['loc']) or 'json'}: {error['msg']}"
+                for error in e.errors()
+            )
+            return None, errors
     
     def _fallback_processing(self, query: str) -> Dict[str, Any]:
-        """Fallback processing khi LLM fail"""
-        # Simple rule-based intent classification
-        greeting_keywords = ['xin chào', 'hello', 'hi', 'chào', 'cảm ơn', 'thanks', 'tạm biệt', 'bye']
-        query_lower = query.lower()
+        """Fallback processing khi LLM fail - không được cache
         
-        if any(keyword in query_lower for keyword in greeting_keywords):
-            intent = "GREETING"
-        else:
-            intent = "QUESTION"
+        Chỉ câu chào / cảm ơn / tạm biệt hiển nhiên (so khớp nguyên từ) là GREETING,
+        còn lại route QUESTION để câu hỏi sản phẩm vẫn được search.
+        """
+        intent = "GREETING" if self.intent_classifier.classify(query) is not None else "QUESTION"
         
         return {
             "intent": intent,
             "enhanced_query": query,
             "route": intent,
+            "filters": QueryFilters().model_dump(),
             "sub_queries": [query],
             "query_count": 1,
             "original_query": query
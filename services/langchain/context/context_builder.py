@@ -2,6 +2,9 @@ from typing import List, Dict, Any
 from config.settings import settings
 
 
+NO_PRODUCT_CONTEXT = "Không có thông tin sản phẩm."
+
+
 class ContextBuilder:
     """Xây dựng context từ search results - Đơn giản hóa cho 2 routes"""
     
@@ -14,7 +17,7 @@ class ContextBuilder:
         
         # QUESTION - Cung cấp thông tin chi tiết
         if not search_results:
-            return "Không có thông tin sản phẩm."
+            return NO_PRODUCT_CONTEXT
         
         return ContextBuilder._build_product_context(search_results)
     
@@ -22,10 +25,15 @@ class ContextBuilder:
     def _build_product_context(search_results: List[Dict[str, Any]]) -> str:
         """Build context đơn giản - Chỉ name, chunk và điểm"""
         # Lấy top documents theo settings
-        top_docs = search_results[:settings.CONTEXT_TOP_K]
-        
+        return ContextBuilder.join_product_parts(
+            ContextBuilder.build_product_parts(search_results[:settings.CONTEXT_TOP_K])
+        )
+    
+    @staticmethod
+    def build_product_parts(search_results: List[Dict[str, Any]]) -> List[str]:
+        """Mỗi document thành một đoạn context riêng (giữ thứ tự rerank) để có thể cắt theo token budget"""
         context_parts = []
-        for i, doc in enumerate(top_docs, 1):
+        for i, doc in enumerate(search_results, 1):
             metadata = doc.get('metadata', {})
             text = doc.get('text', '')
             
@@ -47,4 +55,10 @@ class ContextBuilder:
             
             context_parts.append(product_info)
         
-        return "\n\n".join(context_parts)
\ No newline at end of file
+        return context_parts
+    
+    @staticmethod
+    def join_product_parts(context_parts: List[str]) -> str:
+        if not context_parts:
+            return NO_PRODUCT_CONTEXT
+        return "\n\n".join(context_parts)
@@ -1,16 +1,78 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable, Tuple
 from langchain.memory import ConversationBufferWindowMemory
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.schema import HumanMessage, AIMessage
+from services.metrics import metrics
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import functools
+import re
+import threading
+
+
+NO_HISTORY_SUMMARY = "Chưa có lịch sử hội thoại."
+
+# Chu kỳ kiểm tra lại khi lượt async phải chờ một lượt đồng bộ cùng session đang chạy ở thread khác
+TURN_LOCK_POLL_SECONDS = 0.01
+
+# Đại từ / cụm chỉ định trỏ về sản phẩm đã nói ở lượt trước
+CONTEXT_PRONOUNS = [
+    'nó', 'cái đó', 'cái này', 'sản phẩm này', 'sản phẩm đó', 'thứ này', 'loại này', 'loại đó',
+    'thương hiệu đó', 'thương hiệu này', 'hãng đó', 'hãng này', 'món này', 'món đó'
+]
+_PRONOUN_RE = re.compile(r"(?<!\w)(" + "|".join(re.escape(pronoun) for pronoun in CONTEXT_PRONOUNS) + r")(?!\w)")
+
+# Câu hỏi nối tiếp rất ngắn (vd. "giá bao nhiêu?", "còn hàng không?") thường lược chủ ngữ
+ELLIPTIC_QUERY_MAX_WORDS = 4
+
+
+def has_context_pronoun(query: str) -> bool:
+    """Query có đại từ cần thay bằng sản phẩm / thương hiệu trong lịch sử không"""
+    return bool(_PRONOUN_RE.search(query.lower()))
+
+
+def is_anaphoric_query(query: str) -> bool:
+    """Query nối tiếp cần lịch sử để hiểu: có đại từ hoặc quá ngắn nên thường lược chủ ngữ"""
+    return has_context_pronoun(query) or len(query.split()) <= ELLIPTIC_QUERY_MAX_WORDS
+
+
+def format_history_turns(turns: List[Tuple[str, str]]) -> str:
+    """Format các lượt hội thoại cho prompt"""
+    if not turns:
+        return NO_HISTORY_SUMMARY
+    formatted_history = []
+    for human_content, ai_content in turns:
+        formatted_history.append(f"Người dùng: {human_content}")
+        formatted_history.append(f"Bot: {ai_content}")
+    return "\n".join(formatted_history)
+
+
+def _synchronized(method):
+    """Chạy method dưới lock riêng của session"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class ConversationMemoryManager:
     """Quản lý memory với ConversationBufferWindowMemory - Không giới hạn text"""
     
-    def __init__(self, llm: ChatGoogleGenerativeAI, k: int = 3):
+    def __init__(self, llm: ChatGoogleGenerativeAI, k: int = 3,
+                 on_change: Optional[Callable[["ConversationMemoryManager"], None]] = None):
         self.llm = llm
         self.k = k  # Số lượng turns gần nhất
         
+        # Lock riêng cho session - các request đồng thời cùng session không ghi đè nhau
+        self.lock = threading.RLock()
+        # Lock cả lượt hội thoại (đọc lịch sử -> lưu câu trả lời) - request cùng session xếp hàng
+        # thay vì cùng đọc lịch sử cũ rồi ghi xen kẽ. Luồng async chờ trên asyncio.Lock (FIFO).
+        self._turn_lock = threading.Lock()
+        self._async_turn_lock = asyncio.Lock()
+        # Callback báo cho SessionMemoryStore khi dung lượng memory thay đổi
+        self._on_change = on_change
+        
         # Sử dụng ConversationBufferWindowMemory thay vì ConversationSummaryMemory
         self.memory = ConversationBufferWindowMemory(
             k=k,  # Chỉ giữ k turns gần nhất
@@ -22,18 +84,56 @@ class ConversationMemoryManager:
         self._recent_products = []  # Sản phẩm được đ�� cập gần đây
         self._recent_brands = []    # Thương hiệu được đề cập gần đây
         self._recent_categories = [] # Danh mục được đề cập gần đây
+        self._served_products = []   # Tên sản phẩm top (metadata["name"]) của các câu trả lời gần đây
     
-    def add_conversation_turn(self, user_message: str, ai_message: str):
-        """Thêm một lượt hội thoại vào memory"""
+    @contextmanager
+    def turn(self):
+        """Giữ session trong suốt một lượt hội thoại (luồng đồng bộ)"""
+        with self._turn_lock:
+            yield
+    
+    @asynccontextmanager
+    async def aturn(self):
+        """Bản async của turn() - chờ lượt trước của session mà không chặn event loop"""
+        async with self._async_turn_lock:
+            # Lượt đồng bộ cùng session có thể đang chạy ở thread khác
+            while not self._turn_lock.acquire(blocking=False):
+                await asyncio.sleep(TURN_LOCK_POLL_SECONDS)
+            try:
+                yield
+            finally:
+                self._turn_lock.release()
+    
+    @_synchronized
+    def add_conversation_turn(self, user_message: str, ai_message: str, served_product: Optional[str] = None):
+        """Thêm một lượt hội thoại vào memory
+        
+        served_product: tên sản phẩm top mà câu trả lời dựa vào (None nếu lượt không có sản phẩm)
+        """
         try:
             self.memory.chat_memory.add_user_message(user_message)
             self.memory.chat_memory.add_ai_message(ai_message)
             
+            # Buffer window chỉ giới hạn khi đọc, chat_memory vẫn giữ toàn bộ messages
+            # -> cắt bớt để memory của session không tăng mãi
+            messages = self.memory.chat_memory.messages
+            if len(messages) > 2 * self.k:
+                self.memory.chat_memory.messages = messages[-2 * self.k:]
+            
             # Trích xuất và lưu context quan trọng
             self._extract_important_entities(user_message, ai_message)
+            if served_product:
+                if served_product in self._served_products:
+                    self._served_products.remove(served_product)
+                self._served_products.append(served_product)
+                self._served_products = self._served_products[-3:]
             
         except Exception as e:
             print(f"Lỗi thêm conversation turn: {e}")
+            metrics.record_error("memory_add_turn")
+        
+        if self._on_change:
+            self._on_change(self)
     
     def _extract_important_entities(self, user_message: str, ai_message: str):
         """Trích xuất entities quan trọng từ cuộc hội thoại"""
@@ -78,12 +178,13 @@ class ConversationMemoryManager:
         self._recent_categories = self._recent_categories[-5:]
         self._recent_products = self._recent_products[-3:]
     
+    @_synchronized
     def get_conversation_summary(self) -> str:
         """Lấy summary ngắn gọn từ buffer window"""
         try:
             messages = self.memory.chat_memory.messages
             if not messages:
-                return "Chưa có lịch sử hội thoại."
+                return NO_HISTORY_SUMMARY
             
             # Tạo summary ngắn gọn từ các turns gần đây
             summary_parts = []
@@ -113,43 +214,49 @@ class ConversationMemoryManager:
                     
                     summary_parts.append(f"Đã hỏi: {human_summary}")
             
-            return " | ".join(summary_parts) if summary_parts else "Chưa có lịch sử hội thoại."
+            return " | ".join(summary_parts) if summary_parts else NO_HISTORY_SUMMARY
             
         except Exception as e:
             print(f"Lỗi lấy conversation summary: {e}")
-            return "Chưa có lịch sử hội thoại."
+            metrics.record_error("memory_summary")
+            return NO_HISTORY_SUMMARY
     
+    @_synchronized
     def get_formatted_history(self, max_turns: int = None) -> str:
         """Lấy lịch sử hội thoại đã format từ buffer window - KHÔNG GIỚI HẠN TEXT"""
+        turns = self.get_history_turns()
+        if not turns:
+            return NO_HISTORY_SUMMARY
+        
+        # Buffer window đã giới hạn số messages, không cần giới hạn thêm
+        formatted_result = format_history_turns(turns)
+        print(f"Formatted history length: {len(formatted_result)} characters (UNLIMITED)")
+        
+        return formatted_result
+    
+    @_synchronized
+    def has_history(self) -> bool:
+        """Session đã có lượt hội thoại nào chưa"""
+        return bool(self.memory.chat_memory.messages)
+    
+    @_synchronized
+    def get_history_turns(self) -> List[Tuple[str, str]]:
+        """Các lượt (câu hỏi, câu trả lời) trong buffer window, cũ trước mới sau"""
         try:
             messages = self.memory.chat_memory.messages
-            if not messages:
-                return "Chưa có lịch sử hội thoại."
             
-            formatted_history = []
-            
-            # Buffer window đã giới hạn số messages, không cần giới hạn thêm
-            for i in range(0, len(messages), 2):
-                if i + 1 < len(messages):
-                    human_msg = messages[i]
-                    ai_msg = messages[i + 1]
-                    
-                    # KHÔNG GIỚI HẠN độ dài - sử dụng toàn bộ content
-                    human_content = human_msg.content
-                    ai_content = ai_msg.content
-                    
-                    formatted_history.append(f"Người dùng: {human_content}")
-                    formatted_history.append(f"Bot: {ai_content}")
-            
-            formatted_result = "\n".join(formatted_history)
-            print(f"Formatted history length: {len(formatted_result)} characters (UNLIMITED)")
-            
-            return formatted_result
+            # KHÔNG GIỚI HẠN độ dài - sử dụng toàn bộ content
+            return [
+                (messages[i].content, messages[i + 1].content)
+                for i in range(0, len(messages) - 1, 2)
+            ]
             
         except Exception as e:
             print(f"Lỗi format history: {e}")
-            return "Chưa có lịch sử hội thoại."
+            metrics.record_error("memory_format_history")
+            return []
     
+    @_synchronized
     def get_recent_context(self) -> str:
         """Lấy context gần đây để enhance query"""
         try:
@@ -170,16 +277,15 @@ class ConversationMemoryManager:
             
         except Exception as e:
             print(f"Lỗi lấy recent context: {e}")
+            metrics.record_error("memory_recent_context")
             return ""
     
+    @_synchronized
     def enhance_query_with_context(self, query: str) -> str:
         """Enhance query với context từ memory"""
         try:
             # Kiểm tra xem query có đại từ không
-            pronouns = ['nó', 'cái đó', 'sản phẩm này', 'thứ này', 'loại này', 'thương hiệu đó']
-            has_pronoun = any(pronoun in query.lower() for pronoun in pronouns)
-            
-            if not has_pronoun:
+            if not has_context_pronoun(query):
                 return query
             
             # Lấy context để thay thế đại từ
@@ -195,8 +301,10 @@ class ConversationMemoryManager:
             
         except Exception as e:
             print(f"Lỗi enhance query: {e}")
+            metrics.record_error("memory_enhance_query")
             return query
     
+    @_synchronized
     def clear_memory(self):
         """Xóa memory"""
         try:
@@ -204,9 +312,34 @@ class ConversationMemoryManager:
             self._recent_products = []
             self._recent_brands = []
             self._recent_categories = []
+            self._served_products = []
         except Exception as e:
             print(f"Lỗi xóa memory: {e}")
+            metrics.record_error("memory_clear")
+        
+        if self._on_change:
+            self._on_change(self)
+    
+    @_synchronized
+    def get_memory_entities(self) -> Dict[str, List[str]]:
+        """Lấy bản sao các entities đã ghi nhận trong session"""
+        return {
+            "recent_brands": list(self._recent_brands),
+            "recent_categories": list(self._recent_categories),
+            "recent_products": list(self._recent_products),
+            "served_products": list(self._served_products)
+        }
+    
+    @_synchronized
+    def get_memory_bytes(self) -> int:
+        """Ước lượng dung lượng (bytes UTF-8) của messages và entities trong session"""
+        entities = self._recent_brands + self._recent_categories + self._recent_products + self._served_products
+        return (
+            sum(len(msg.content.encode("utf-8")) for msg in self.memory.chat_memory.messages)
+            + sum(len(entity.encode("utf-8")) for entity in entities)
+        )
     
+    @_synchronized
     def get_memory_stats(self) -> Dict[str, Any]:
         """Lấy thống kê về memory"""
         try:
@@ -218,11 +351,13 @@ class ConversationMemoryManager:
                 "recent_brands": len(self._recent_brands),
                 "recent_categories": len(self._recent_categories),
                 "recent_products": len(self._recent_products),
+                "served_products": len(self._served_products),
                 "memory_type": "ConversationBufferWindowMemory",
                 "text_limit": "UNLIMITED"
             }
         except Exception as e:
             print(f"Lỗi lấy memory stats: {e}")
+            metrics.record_error("memory_stats")
             return {
                 "total_messages": 0,
                 "total_characters": 0,
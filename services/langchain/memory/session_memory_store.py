@@ -0,0 +1,130 @@
+from typing import Dict, Any, Optional
+from collections import OrderedDict
+from langchain_google_genai import ChatGoogleGenerativeAI
+from services.langchain.memory.conversation_memory import ConversationMemoryManager
+import threading
+import time
+
+
+class _SessionEntry:
+    """Một session trong store: memory manager, thời điểm truy cập cuối và dung lượng"""
+
+    __slots__ = ("memory", "last_access", "bytes")
+
+    def __init__(self, memory: ConversationMemoryManager):
+        self.memory = memory
+        self.last_access = time.monotonic()
+        self.bytes = 0
+
+
+class SessionMemoryStore:
+    """Kho ConversationMemoryManager theo session_id - giới hạn số session (LRU), TTL khi idle và tổng dung lượng"""
+
+    def __init__(self, llm: ChatGoogleGenerativeAI, k: int = 3, max_sessions: int = 10000,
+                 ttl_seconds: float = 1800, max_bytes: int = 64 * 1024 * 1024):
+        self.llm = llm
+        self.k = k
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+
+        # OrderedDict theo thứ tự truy cập: đầu = lâu nhất chưa dùng
+        self._sessions: "OrderedDict[str, _SessionEntry]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        # Thống kê eviction
+        self._evicted_ttl = 0
+        self._evicted_lru = 0
+        self._evicted_bytes = 0
+
+    def get(self, session_id: str) -> ConversationMemoryManager:
+        """Lấy (hoặc tạo mới) memory của session và đánh dấu vừa được truy cập"""
+        with self._lock:
+            now = time.monotonic()
+            self._evict_expired(now)
+
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                memory = ConversationMemoryManager(
+                    self.llm,
+                    k=self.k,
+                    on_change=lambda manager, sid=session_id: self._on_memory_change(sid, manager)
+                )
+                entry = _SessionEntry(memory)
+                self._sessions[session_id] = entry
+
+                # Vượt số session tối đa -> bỏ session lâu nhất chưa dùng
+                while len(self._sessions) > self.max_sessions:
+                    self._pop_oldest()
+                    self._evicted_lru += 1
+            else:
+                self._sessions.move_to_end(session_id)
+
+            entry.last_access = now
+            return entry.memory
+
+    def peek(self, session_id: str) -> Optional[ConversationMemoryManager]:
+        """Lấy memory của session nếu còn sống, không tạo mới và không làm mới LRU"""
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            entry = self._sessions.get(session_id)
+            return entry.memory if entry else None
+
+    def clear(self, session_id: str) -> bool:
+        """Xóa hẳn session khỏi store"""
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None:
+                return False
+            self._total_bytes -= entry.bytes
+            return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê store"""
+        with self._lock:
+            return {
+                "active_sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl_seconds": self.ttl_seconds,
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "evicted_ttl": self._evicted_ttl,
+                "evicted_lru": self._evicted_lru,
+                "evicted_bytes": self._evicted_bytes
+            }
+
+    def _on_memory_change(self, session_id: str, memory: ConversationMemoryManager):
+        """Cập nhật dung lượng session và áp dụng byte budget"""
+        new_bytes = memory.get_memory_bytes()
+
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            # Session đã bị evict trong lúc request đang chạy
+            if entry is None or entry.memory is not memory:
+                return
+
+            self._total_bytes += new_bytes - entry.bytes
+            entry.bytes = new_bytes
+
+            # Vượt byte budget -> bỏ các session lâu nhất chưa dùng, giữ lại session hiện tại
+            while self._total_bytes > self.max_bytes and len(self._sessions) > 1:
+                oldest_id = next(iter(self._sessions))
+                if oldest_id == session_id:
+                    self._sessions.move_to_end(session_id)
+                    continue
+                self._pop_oldest()
+                self._evicted_bytes += 1
+
+    def _evict_expired(self, now: float):
+        """Bỏ các session idle quá TTL (nằm ở đầu OrderedDict)"""
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.last_access <= self.ttl_seconds:
+                break
+            self._pop_oldest()
+            self._evicted_ttl += 1
+
+    def _pop_oldest(self):
+        _, entry = self._sessions.popitem(last=False)
+        self._total_bytes -= entry.bytes
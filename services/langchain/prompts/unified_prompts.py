@@ -63,44 +63,66 @@ CÂU HỎI HIỆN TẠI: "{query}"
 - Nếu câu hỏi về sản phẩm A, KHÔNG thêm thông tin về sản phẩm B từ lịch sử
 - Nếu câu hỏi đã rõ ràng, KHÔNG thêm thông tin không cần thiết
 
+=== BƯỚC 3: TRÍCH XUẤT BỘ LỌC (CHỈ KHI INTENT = QUESTION) ===
+
+Chỉ điền khi câu hỏi (sau khi tăng cường) nêu RÕ, không đoán; không có thì để null:
+- brand: thương hiệu, ví dụ "Anessa", "La Roche-Posay"
+- category: loại sản phẩm, ví dụ "Kem chống nắng", "Sữa rửa mặt"
+- price_min / price_max: khoảng giá (VNĐ, số nguyên), ví dụ "dưới 300k" → price_max = 300000
+- chunk_type: loại thông tin được hỏi, một trong:
+  "general_info" (giá, thông tin chung), "description_markdown" (mô tả, công dụng),
+  "specification" (thông số, xuất xứ, dung tích), "ingredient" (thành phần), "guide" (hướng dẫn sử dụng)
+
 === ĐỊNH DẠNG TRẢ VỀ ===
-Intent: <GREETING hoặc QUESTION>
-Enhanced_Query: <câu hỏi đã được cải thiện>
+Chỉ trả về MỘT object JSON, không thêm chữ nào khác:
+{{"intent": "<GREETING hoặc QUESTION>", "enhanced_query": "<câu hỏi đã được cải thiện>", "filters": {{"brand": null, "category": null, "price_min": null, "price_max": null, "chunk_type": null}}}}
 
 === VÍ DỤ THỰC TẾ ===
 
 Ví dụ 1 - Câu hỏi rõ ràng:
 Lịch sử: "Kem chống nắng Anessa có tốt không?"
 Query: "La Roche Posay giá bao nhiêu?"
-→ Intent: QUESTION
-→ Enhanced_Query: La Roche Posay giá bao nhiêu?
+→ {{"intent": "QUESTION", "enhanced_query": "La Roche Posay giá bao nhiêu?", "filters": {{"brand": "La Roche-Posay", "category": null, "price_min": null, "price_max": null, "chunk_type": "general_info"}}}}
 (KHÔNG thêm Anessa vì câu hỏi đã rõ về La Roche Posay)
 
 Ví dụ 2 - Đại từ không rõ:
 Lịch sử: "Kem chống nắng Anessa có tốt không?"
 Query: "nó có phù hợp với da nhạy cảm không?"
-→ Intent: QUESTION
-→ Enhanced_Query: Anessa có phù hợp với da nhạy cảm không?
+→ {{"intent": "QUESTION", "enhanced_query": "Anessa có phù hợp với da nhạy cảm không?", "filters": {{"brand": "Anessa", "category": "Kem chống nắng", "price_min": null, "price_max": null, "chunk_type": "description_markdown"}}}}
 
 Ví dụ 3 - Thiếu ngữ cảnh:
 Lịch sử: "Cetaphil có tốt không?"
 Query: "giá bao nhiêu?"
-→ Intent: QUESTION
-→ Enhanced_Query: Cetaphil giá bao nhiêu?
+→ {{"intent": "QUESTION", "enhanced_query": "Cetaphil giá bao nhiêu?", "filters": {{"brand": "Cetaphil", "category": null, "price_min": null, "price_max": null, "chunk_type": "general_info"}}}}
 
 Ví dụ 4 - Tư vấn chung:
 Lịch sử: "Kem chống nắng Anessa có tốt không?"
-Query: "Tư vấn kem dưỡng ẩm cho da khô"
-→ Intent: QUESTION
-→ Enhanced_Query: Tư vấn kem dưỡng ẩm cho da khô
+Query: "Tư vấn kem dưỡng ẩm cho da khô dưới 500k"
+→ {{"intent": "QUESTION", "enhanced_query": "Tư vấn kem dưỡng ẩm cho da khô dưới 500k", "filters": {{"brand": null, "category": "Kem dưỡng ẩm", "price_min": null, "price_max": 500000, "chunk_type": null}}}}
 (KHÔNG thêm Anessa vì đây là câu hỏi tư vấn mới)
 
 Ví dụ 5 - Greeting:
 Query: "Cảm ơn bạn"
-→ Intent: GREETING
-→ Enhanced_Query: Cảm ơn bạn
+→ {{"intent": "GREETING", "enhanced_query": "Cảm ơn bạn", "filters": {{"brand": null, "category": null, "price_min": null, "price_max": null, "chunk_type": null}}}}
 """
         return PromptTemplate(
             input_variables=["query", "chat_summary"],
             template=template
-        )
\ No newline at end of file
+        )
+    
+    @staticmethod
+    def get_reask_template() -> PromptTemplate:
+        """Template hỏi lại một lần khi JSON trả về không hợp lệ"""
+        template = UnifiedPrompts.get_unified_template().template + """
+=== LẦN TRẢ LỜI TRƯỚC KHÔNG HỢP LỆ ===
+Câu trả lời trước:
+{previous_response}
+
+Lỗi: {error}
+
+Hãy trả lời lại, CHỈ gồm một object JSON đúng định dạng ở trên.
+"""
+        return PromptTemplate(
+            input_variables=["query", "chat_summary", "previous_response", "error"],
+            template=template
+        )
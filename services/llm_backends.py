@@ -0,0 +1,95 @@
+from typing import Any, Dict, List
+from abc import ABC, abstractmethod
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_google_genai import ChatGoogleGenerativeAI
+from config.settings import settings
+from services.fake_llm import FakeChatModel, LatencyModel
+from services.llm_pool import GeminiKeyPool, PooledChatModel
+
+
+class LLMBackend(ABC):
+    """Nguồn chat model cho các chain - chọn bằng LLM_BACKEND"""
+
+    name = "base"
+
+    @abstractmethod
+    def create_chat_model(self, model: str, label: str = "key") -> BaseChatModel:
+        """Chat model cho tên model; label là tiền tố tên key / slot trong thống kê"""
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Thống kê theo key / model, xuất ra /metrics với label key"""
+        return {}
+
+
+class GeminiBackend(LLMBackend):
+    """Gemini thật: mỗi model một GeminiKeyPool trên các key của GEMINI_API_KEYS (quota tính theo model)"""
+
+    name = "gemini"
+
+    def __init__(self):
+        self.pools: List[GeminiKeyPool] = []
+
+    def create_chat_model(self, model: str, label: str = "key") -> BaseChatModel:
+        pool = GeminiKeyPool(
+            settings.GEMINI_API_KEYS,
+            lambda api_key: self._create_client(api_key, model),
+            requests_per_minute=settings.GEMINI_KEY_RPM,
+            tokens_per_minute=settings.GEMINI_KEY_TPM,
+            max_wait=settings.GEMINI_POOL_MAX_WAIT,
+            backoff_base=settings.GEMINI_RATE_LIMIT_BACKOFF,
+            backoff_max=settings.GEMINI_RATE_LIMIT_BACKOFF_MAX,
+            label=label
+        )
+        self.pools.append(pool)
+        return PooledChatModel(pool=pool)
+
+    def _create_client(self, api_key: str, model: str) -> ChatGoogleGenerativeAI:
+        return ChatGoogleGenerativeAI(
+            model=model,
+            google_api_key=api_key,
+            temperature=settings.LLM_TEMPERATURE,
+            timeout=settings.LLM_TIMEOUT,
+            # Có nhiều key thì 429 được pool chuyển sang key khác thay vì retry trên cùng key
+            max_retries=1 if len(settings.GEMINI_API_KEYS) > 1 else 6
+        )
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {}
+        for pool in self.pools:
+            stats.update(pool.get_stats())
+        return stats
+
+
+class FakeBackend(LLMBackend):
+    """Chat model cục bộ, tất định, không cần API key - để load test / benchmark phần còn lại của pipeline"""
+
+    name = "fake"
+
+    def __init__(self):
+        self.models: List[FakeChatModel] = []
+
+    def create_chat_model(self, model: str, label: str = "key") -> BaseChatModel:
+        latency = LatencyModel(
+            distribution=settings.FAKE_LLM_LATENCY_DISTRIBUTION,
+            median_ms=settings.FAKE_LLM_LATENCY_MS,
+            spread=settings.FAKE_LLM_LATENCY_SPREAD,
+            tokens_per_second=settings.FAKE_LLM_TOKENS_PER_SECOND,
+            # Model thứ hai (hedge) có dãy latency riêng, vẫn tái lập được theo FAKE_LLM_SEED
+            seed=settings.FAKE_LLM_SEED + len(self.models)
+        )
+        self.models.append(FakeChatModel(model=model, latency=latency, output_tokens=settings.FAKE_LLM_OUTPUT_TOKENS))
+        return self.models[-1]
+
+
+LLM_BACKENDS = {
+    GeminiBackend.name: GeminiBackend,
+    FakeBackend.name: FakeBackend
+}
+
+
+def create_llm_backend(name: str) -> LLMBackend:
+    backend_class = LLM_BACKENDS.get(name.lower())
+    if backend_class is None:
+        raise ValueError(f"LLM_BACKEND không hợp lệ: {name} (hỗ trợ: {', '.join(LLM_BACKENDS)})")
+    print(f"LLM backend: {backend_class.name}")
+    return backend_class()
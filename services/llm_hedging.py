@@ -0,0 +1,204 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from services.metrics import metrics
+import asyncio
+import threading
+import time
+
+
+PRIMARY = "primary"
+HEDGE = "hedge"
+
+# Lời gọi đồng bộ chạy trong thread riêng để có thể chờ song song hai request
+_SYNC_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+
+
+class HedgePolicy:
+    """Ngưỡng gửi request dự phòng = percentile latency gần đây của request chính, kèm thống kê hedge
+
+    Chưa đủ min_samples mẫu thì dùng max_delay; ngưỡng luôn nằm trong [min_delay, max_delay].
+    Request chính bị hủy vì request dự phòng thắng được ghi nhận bằng thời gian đã chờ
+    (chặn dưới của latency thật) để ngưỡng không bị kéo xuống.
+    """
+
+    def __init__(self, percentile: float = 95, min_delay: float = 1.0, max_delay: float = 8.0,
+                 min_samples: int = 20, window: int = 500):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+        self._calls = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+        self._failures = 0
+
+    def current_delay(self) -> float:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.max_delay
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return min(self.max_delay, max(self.min_delay, ordered[index]))
+
+    def record(self, winner: Optional[str], hedged: bool, elapsed: float) -> str:
+        """Ghi nhận kết quả một lời gọi, trả về outcome cho metrics"""
+        with self._lock:
+            if winner is not None:
+                self._samples.append(elapsed)
+            self._calls += 1
+            self._hedged += int(hedged)
+            self._hedge_wins += int(winner == HEDGE)
+            self._failures += int(winner is None)
+
+        if winner is None:
+            return "failed"
+        return f"{winner}_won" if hedged else "not_hedged"
+
+    def get_stats(self) -> Dict[str, Any]:
+        delay = self.current_delay()
+        with self._lock:
+            return {
+                "delay_seconds": round(delay, 3),
+                "latency_samples": len(self._samples),
+                "calls": self._calls,
+                "hedged": self._hedged,
+                "hedge_wins": self._hedge_wins,
+                "failures": self._failures,
+                "hedge_rate": round(self._hedged / self._calls, 4) if self._calls else 0.0,
+                "win_rate": round(self._hedge_wins / self._hedged, 4) if self._hedged else 0.0
+            }
+
+
+class HedgedChatModel(BaseChatModel):
+    """Gửi thêm request dự phòng (có thể tới model nhẹ hơn) khi request chính chậm hơn ngưỡng
+
+    Request nào trả về trước được dùng, request còn lại bị hủy. Request chính lỗi trước ngưỡng
+    thì request dự phòng được gửi ngay. Stream chỉ hedge tới chunk đầu tiên.
+    Lời gọi đồng bộ không hủy được thread đang chạy - kết quả của request thua bị bỏ qua.
+    """
+
+    primary: Any
+    hedge: Any
+    name: str
+    policy: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged-chat-model"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        message = self._race(lambda model: model.invoke(messages, stop=stop, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        message = await self._arace(lambda model: model.ainvoke(messages, stop=stop, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        # Không hủy được generator đồng bộ đang chờ ở thread khác -> stream đồng bộ không hedge
+        for chunk in self.primary.stream(messages, stop=stop, **kwargs):
+            if run_manager and chunk.content:
+                run_manager.on_llm_new_token(str(chunk.content))
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        streams = []
+
+        async def first_chunk(model: BaseChatModel):
+            stream = model.astream(messages, stop=stop, **kwargs)
+            streams.append(stream)
+            try:
+                return stream, await stream.__anext__()
+            except StopAsyncIteration:
+                return stream, None
+
+        winner = None
+        try:
+            winner, chunk = await self._arace(first_chunk)
+        finally:
+            for stream in streams:
+                if stream is not winner:
+                    await stream.aclose()
+
+        try:
+            while chunk is not None:
+                if run_manager and chunk.content:
+                    await run_manager.on_llm_new_token(str(chunk.content))
+                yield ChatGenerationChunk(message=chunk)
+                try:
+                    chunk = await winner.__anext__()
+                except StopAsyncIteration:
+                    chunk = None
+        finally:
+            await winner.aclose()
+
+    async def _arace(self, call: Callable[[BaseChatModel], Awaitable[Any]]) -> Any:
+        started_at = time.monotonic()
+        deadline = started_at + self.policy.current_delay()
+        pending = {asyncio.ensure_future(call(self.primary)): PRIMARY}
+        hedged, error = False, None
+        try:
+            while pending:
+                timeout = None if hedged else max(0.0, deadline - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    role = pending.pop(task)
+                    if task.exception() is None:
+                        self._record(role, hedged, started_at)
+                        return task.result()
+                    error = task.exception()
+                    print(f"LLM {self.name} ({role}) lỗi: {error}")
+                if not hedged:
+                    hedged = True
+                    pending[asyncio.ensure_future(call(self.hedge))] = HEDGE
+            self._record(None, hedged, started_at)
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            # Chờ request thua dừng hẳn (trả key về pool, đóng stream) trước khi trả kết quả
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def _race(self, call: Callable[[BaseChatModel], Any]) -> Any:
+        started_at = time.monotonic()
+        deadline = started_at + self.policy.current_delay()
+        pending = {_SYNC_EXECUTOR.submit(call, self.primary): PRIMARY}
+        hedged, error = False, None
+        try:
+            while pending:
+                timeout = None if hedged else max(0.0, deadline - time.monotonic())
+                done, _ = wait_futures(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    role = pending.pop(future)
+                    if future.exception() is None:
+                        self._record(role, hedged, started_at)
+                        return future.result()
+                    error = future.exception()
+                    print(f"LLM {self.name} ({role}) lỗi: {error}")
+                if not hedged:
+                    hedged = True
+                    pending[_SYNC_EXECUTOR.submit(call, self.hedge)] = HEDGE
+            self._record(None, hedged, started_at)
+            raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _record(self, winner: Optional[str], hedged: bool, started_at: float):
+        outcome = self.policy.record(winner, hedged, time.monotonic() - started_at)
+        metrics.record_hedge(self.name, outcome)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return self.policy.get_stats()
@@ -0,0 +1,305 @@
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+from google.api_core.exceptions import ResourceExhausted
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from services.metrics import metrics
+from services.prompt_budget import count_tokens
+import asyncio
+import threading
+import time
+
+
+# Ước lượng token output trước khi gọi (số thực tế từ usage_metadata được trừ bù sau khi gọi xong)
+OUTPUT_TOKEN_ESTIMATE = 512
+
+
+class LLMPoolExhausted(RuntimeError):
+    """Không key nào còn quota (hoặc đều đang backoff vì 429) trong thời gian chờ cho phép"""
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Lỗi 429 / hết quota của Gemini (kể cả khi bị bọc trong exception của langchain)"""
+    if isinstance(error, ResourceExhausted):
+        return True
+    text = str(error).lower()
+    return "429" in text or "resource_exhausted" in text or "resource exhausted" in text or "quota" in text
+
+
+class TokenBucket:
+    """Token bucket nạp đều theo phút; per_minute <= 0 là không giới hạn
+
+    Cho phép âm tạm thời khi số token thực tế vượt ước lượng - các request sau phải chờ bù lại.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def available(self, now: float) -> float:
+        if self.unlimited:
+            return float("inf")
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens
+
+    def consume(self, amount: float):
+        if not self.unlimited:
+            self.tokens -= amount
+
+    def seconds_until(self, amount: float, now: float) -> float:
+        """Thời gian chờ tới khi đủ amount (amount lớn hơn capacity thì chờ tới khi đầy)"""
+        missing = min(amount, self.capacity) - self.available(now)
+        return max(0.0, missing / self.rate) if missing > 0 else 0.0
+
+    def utilization(self, now: float) -> float:
+        if self.unlimited:
+            return 0.0
+        return round(1.0 - max(0.0, self.available(now)) / self.capacity, 4)
+
+
+class _KeySlot:
+    """Một API key: client riêng, budget request / token theo phút và trạng thái backoff"""
+
+    def __init__(self, label: str, client: BaseChatModel, requests_per_minute: float, tokens_per_minute: float):
+        self.label = label
+        self.client = client
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.backoff = 0.0
+
+        self.requests = 0
+        self.tokens = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+
+class GeminiKeyPool:
+    """Phân phối lời gọi Gemini trên nhiều API key theo budget RPM / TPM của từng key
+
+    Chọn key đang ít request nhất trong số key còn budget; key trả về 429 bị tạm ngưng
+    với backoff tăng dần (reset khi gọi thành công). Hết budget ở mọi key thì chờ tối đa
+    max_wait giây rồi raise LLMPoolExhausted.
+    """
+
+    def __init__(self, api_keys: List[str], client_factory: Callable[[str], BaseChatModel],
+                 requests_per_minute: float = 1000, tokens_per_minute: float = 1000000,
+                 max_wait: float = 5, backoff_base: float = 2, backoff_max: float = 60, label: str = "key"):
+        if not api_keys:
+            raise ValueError("Cần ít nhất một Gemini API key")
+        self.slots = [
+            _KeySlot(f"{label}_{index}", client_factory(api_key), requests_per_minute, tokens_per_minute)
+            for index, api_key in enumerate(api_keys, start=1)
+        ]
+        self.max_wait = max_wait
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+
+    @property
+    def max_attempts(self) -> int:
+        # Mỗi key thử tối đa một lần trước khi bỏ cuộc, ít nhất hai lần với pool một key
+        return max(2, len(self.slots))
+
+    def estimate_tokens(self, messages: List[BaseMessage]) -> int:
+        return sum(count_tokens(str(message.content)) for message in messages) + OUTPUT_TOKEN_ESTIMATE
+
+    def acquire(self, estimated_tokens: int) -> _KeySlot:
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            slot, wait = self._try_acquire(estimated_tokens)
+            if slot is not None:
+                return slot
+            time.sleep(self._next_sleep(wait, deadline))
+
+    async def aacquire(self, estimated_tokens: int) -> _KeySlot:
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            slot, wait = self._try_acquire(estimated_tokens)
+            if slot is not None:
+                return slot
+            await asyncio.sleep(self._next_sleep(wait, deadline))
+
+    def _next_sleep(self, wait: float, deadline: float) -> float:
+        remaining = deadline - time.monotonic()
+        if wait > remaining:
+            raise LLMPoolExhausted(f"Không có Gemini API key nào còn quota trong {self.max_wait}s")
+        # Chờ từng đoạn ngắn: key khác có thể rảnh sớm hơn dự tính
+        return min(max(wait, 0.01), 0.5)
+
+    def _try_acquire(self, estimated_tokens: int):
+        """Trả về (slot, 0) nếu chiếm được key, ngược lại (None, thời gian chờ ngắn nhất)"""
+        now = time.monotonic()
+        with self._lock:
+            best, best_key, shortest_wait = None, None, float("inf")
+            for slot in self.slots:
+                wait = max(
+                    slot.cooldown_until - now,
+                    slot.request_bucket.seconds_until(1, now),
+                    slot.token_bucket.seconds_until(estimated_tokens, now)
+                )
+                if wait > 0:
+                    shortest_wait = min(shortest_wait, wait)
+                    continue
+                # Ít request đang chạy nhất, hòa thì key còn nhiều budget request hơn
+                key = (slot.in_flight, slot.request_bucket.utilization(now))
+                if best is None or key < best_key:
+                    best, best_key = slot, key
+
+            if best is None:
+                return None, shortest_wait
+            best.request_bucket.consume(1)
+            best.token_bucket.consume(estimated_tokens)
+            best.in_flight += 1
+            return best, 0.0
+
+    def release(self, slot: _KeySlot, estimated_tokens: int, used_tokens: Optional[int],
+                error: Optional[Exception] = None):
+        """Trả key sau khi gọi xong; bù chênh lệch token thực tế và xử lý 429"""
+        now = time.monotonic()
+        with self._lock:
+            slot.in_flight -= 1
+            slot.requests += 1
+            if used_tokens is not None:
+                slot.tokens += used_tokens
+                slot.token_bucket.consume(used_tokens - estimated_tokens)
+
+            if error is None:
+                slot.backoff = 0.0
+                return
+            if not is_rate_limit_error(error):
+                slot.errors += 1
+                return
+
+            slot.rate_limited += 1
+            slot.backoff = min(self.backoff_max, slot.backoff * 2 if slot.backoff else self.backoff_base)
+            retry_after = getattr(error, "retry_after", None) or 0
+            slot.cooldown_until = now + max(slot.backoff, retry_after)
+            backoff = slot.backoff
+        print(f"Gemini {slot.label} bị giới hạn quota (429) - tạm ngưng {backoff:.1f}s")
+        metrics.record_rate_limit(slot.label)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                slot.label: {
+                    "in_flight": slot.in_flight,
+                    "requests": slot.requests,
+                    "tokens": slot.tokens,
+                    "rate_limited": slot.rate_limited,
+                    "errors": slot.errors,
+                    "cooldown_seconds": round(max(0.0, slot.cooldown_until - now), 2),
+                    "request_utilization": slot.request_bucket.utilization(now),
+                    "token_utilization": slot.token_bucket.utilization(now)
+                }
+                for slot in self.slots
+            }
+
+
+def _total_tokens(message: BaseMessage) -> Optional[int]:
+    usage = getattr(message, "usage_metadata", None)
+    return usage.get("total_tokens") if usage else None
+
+
+class PooledChatModel(BaseChatModel):
+    """Chat model dùng GeminiKeyPool - thay thế trực tiếp cho ChatGoogleGenerativeAI trong các chain
+
+    Lời gọi bị 429 được thử lại trên key khác (stream chỉ thử lại khi chưa nhận token nào).
+    """
+
+    pool: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "gemini-key-pool"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        estimated_tokens = self.pool.estimate_tokens(messages)
+        for attempt in range(self.pool.max_attempts):
+            slot = self.pool.acquire(estimated_tokens)
+            used_tokens, error = 0, None
+            try:
+                message = slot.client.invoke(messages, stop=stop, **kwargs)
+                used_tokens = _total_tokens(message)
+                return ChatResult(generations=[ChatGeneration(message=message)])
+            except Exception as e:
+                error = e
+                if is_rate_limit_error(e) and attempt + 1 < self.pool.max_attempts:
+                    continue
+                raise
+            finally:
+                self.pool.release(slot, estimated_tokens, used_tokens, error)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        estimated_tokens = self.pool.estimate_tokens(messages)
+        for attempt in range(self.pool.max_attempts):
+            slot = await self.pool.aacquire(estimated_tokens)
+            used_tokens, error = 0, None
+            try:
+                message = await slot.client.ainvoke(messages, stop=stop, **kwargs)
+                used_tokens = _total_tokens(message)
+                return ChatResult(generations=[ChatGeneration(message=message)])
+            except Exception as e:
+                error = e
+                if is_rate_limit_error(e) and attempt + 1 < self.pool.max_attempts:
+                    continue
+                raise
+            finally:
+                self.pool.release(slot, estimated_tokens, used_tokens, error)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        estimated_tokens = self.pool.estimate_tokens(messages)
+        for attempt in range(self.pool.max_attempts):
+            slot = self.pool.acquire(estimated_tokens)
+            started, used_tokens, error = False, 0, None
+            try:
+                for chunk in slot.client.stream(messages, stop=stop, **kwargs):
+                    started = True
+                    # usage_metadata của từng chunk là phần tăng thêm
+                    used_tokens += _total_tokens(chunk) or 0
+                    if run_manager and chunk.content:
+                        run_manager.on_llm_new_token(str(chunk.content))
+                    yield ChatGenerationChunk(message=chunk)
+                return
+            except Exception as e:
+                error = e
+                if not started and is_rate_limit_error(e) and attempt + 1 < self.pool.max_attempts:
+                    continue
+                raise
+            finally:
+                self.pool.release(slot, estimated_tokens, used_tokens, error)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        estimated_tokens = self.pool.estimate_tokens(messages)
+        for attempt in range(self.pool.max_attempts):
+            slot = await self.pool.aacquire(estimated_tokens)
+            started, used_tokens, error = False, 0, None
+            try:
+                async for chunk in slot.client.astream(messages, stop=stop, **kwargs):
+                    started = True
+                    # usage_metadata của từng chunk là phần tăng thêm
+                    used_tokens += _total_tokens(chunk) or 0
+                    if run_manager and chunk.content:
+                        await run_manager.on_llm_new_token(str(chunk.content))
+                    yield ChatGenerationChunk(message=chunk)
+                return
+            except Exception as e:
+                error = e
+                if not started and is_rate_limit_error(e) and attempt + 1 < self.pool.max_attempts:
+                    continue
+                raise
+            finally:
+                self.pool.release(slot, estimated_tokens, used_tokens, error)
@@ -0,0 +1,237 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+from services.request_trace import current_trace
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)
+TOKEN_BUCKETS = (500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    parts = []
+    for key, value in items:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    """Counter theo label (Prometheus counter)"""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Histogram theo label với bucket cố định (Prometheus histogram)"""
+
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[LabelValues, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._series[key] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    le = ("le", _format_value(bound))
+                    lines.append(f"{self.name}_bucket{_format_labels(labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(series['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """Registry metrics dùng chung cho cả process, xuất theo định dạng text của Prometheus"""
+
+    def __init__(self):
+        self.stage_duration = Histogram(
+            "rag_stage_duration_seconds",
+            "Thời gian xử lý từng stage của pipeline RAG"
+        )
+        self.routes = Counter("rag_route_total", "Số request theo route")
+        self.fallbacks = Counter("rag_fallback_total", "Số lần dùng đường fallback")
+        self.errors = Counter("rag_swallowed_errors_total", "Số lỗi bị bắt trong except và xử lý tiếp")
+        self.degradations = Counter("rag_degradation_total", "Số lần giảm chất lượng vì sắp hết deadline")
+        self.fast_paths = Counter("rag_fast_path_total", "Số câu trả lời bằng template, không gọi LLM")
+        self.rewrite_skips = Counter("rag_query_rewrite_skipped_total", "Số lần bỏ qua LLM viết lại query")
+        self.speculations = Counter("rag_speculative_search_total", "Kết quả speculative retrieval theo outcome")
+        self.speculative_saved = Counter(
+            "rag_speculative_saved_seconds_total",
+            "Tổng thời gian encode + search chạy song song với LLM viết lại query"
+        )
+        self.prompt_tokens = Histogram(
+            "rag_prompt_tokens",
+            "Số token ước lượng của prompt sau khi áp token budget",
+            buckets=TOKEN_BUCKETS
+        )
+        self.prompt_trims = Counter("rag_prompt_trimmed_total", "Số lần cắt context / lịch sử cho vừa token budget")
+        self.rate_limits = Counter("rag_llm_rate_limited_total", "Số lời gọi Gemini bị 429 / hết quota theo API key")
+        self.hedges = Counter("rag_llm_hedge_total", "Kết quả hedged request theo chain")
+        self.unified_parses = Counter(
+            "rag_unified_parse_total",
+            "Kết quả validate JSON của unified chain (ok / reask_ok / failed)"
+        )
+        self.requests = Counter("rag_requests_total", "Số request theo endpoint và trạng thái")
+        self.request_duration = Histogram(
+            "rag_request_duration_seconds",
+            "Thời gian xử lý request theo endpoint"
+        )
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        """Đo thời gian một stage và ghi vào histogram (và trace của request nếu có)"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start_time)
+
+    def timed(self, stage: str):
+        """Decorator đo thời gian cả hàm như một stage"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time_stage(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe_stage(self, stage: str, seconds: float):
+        self.stage_duration.observe(seconds, stage=stage)
+        trace = current_trace()
+        if trace is not None:
+            trace.add_stage(stage, seconds)
+
+    def record_route(self, route: str):
+        self.routes.inc(route=route)
+
+    def record_fallback(self, kind: str):
+        self.fallbacks.inc(kind=kind)
+
+    def record_error(self, location: str):
+        self.errors.inc(location=location)
+
+    def record_degradation(self, kind: str):
+        self.degradations.inc(kind=kind)
+
+    def record_fast_path(self, intent: str):
+        self.fast_paths.inc(intent=intent)
+
+    def record_rewrite_skip(self, reason: str):
+        self.rewrite_skips.inc(reason=reason)
+
+    def record_speculation(self, outcome: str, saved_seconds: float = 0.0):
+        self.speculations.inc(outcome=outcome)
+        if saved_seconds > 0:
+            self.speculative_saved.inc(saved_seconds)
+
+    def record_prompt_budget(self, prompt: str, report: Dict[str, Any]):
+        self.prompt_tokens.observe(report["total"], prompt=prompt)
+        if report["documents_dropped"] or (report["truncated"] and report["context"]):
+            self.prompt_trims.inc(part="context")
+        if report["history_turns_dropped"]:
+            self.prompt_trims.inc(part="history")
+
+    def record_rate_limit(self, key: str):
+        self.rate_limits.inc(key=key)
+
+    def record_hedge(self, chain: str, outcome: str):
+        self.hedges.inc(chain=chain, outcome=outcome)
+
+    def record_unified_parse(self, outcome: str):
+        self.unified_parses.inc(outcome=outcome)
+
+    def record_request(self, endpoint: str, status: str, seconds: Optional[float] = None):
+        self.requests.inc(endpoint=endpoint, status=status)
+        if seconds is not None:
+            self.request_duration.observe(seconds, endpoint=endpoint)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.stage_duration, self.request_duration, self.prompt_tokens, self.routes,
+                       self.fallbacks, self.errors, self.degradations, self.fast_paths,
+                       self.rewrite_skips, self.speculations, self.speculative_saved, self.prompt_trims, self.rate_limits,
+                       self.hedges, self.unified_parses, self.requests):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def render_stats_as_gauges(prefix: str, stats: Dict[str, Any], label: Optional[str] = None) -> str:
+    """Chuyển dict thống kê (vd. từ get_stats()) thành các gauge Prometheus
+
+    - {"in_flight": 3} -> rag_admission_in_flight 3
+    - label="stage", {"llm": {"active": 2}} -> rag_stage_active{stage="llm"} 2
+    """
+    samples: Dict[str, List[str]] = {}
+    for key, value in stats.items():
+        if label and isinstance(value, dict):
+            for field, field_value in value.items():
+                if isinstance(field_value, (int, float)) and not isinstance(field_value, bool):
+                    name = f"{prefix}_{field}"
+                    labels = _format_labels(((label, key),))
+                    samples.setdefault(name, []).append(f"{name}{labels} {_format_value(field_value)}")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            name = f"{prefix}_{key}"
+            samples.setdefault(name, []).append(f"{name} {_format_value(value)}")
+
+    lines = []
+    for name, metric_lines in samples.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(metric_lines)
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+# Registry dùng chung
+metrics = MetricsRegistry()
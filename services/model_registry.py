@@ -0,0 +1,63 @@
+from typing import Any, Dict, List
+from sentence_transformers import SentenceTransformer
+from model_rerank.model_rerank import BGEReranker
+from config.settings import settings
+import threading
+import torch
+
+
+# Model đã load trong process, key = (loại, tên model, device)
+_models: Dict[tuple, Any] = {}
+_lock = threading.Lock()
+
+
+def get_embedding_model(model_name: str, device: str = "cpu") -> SentenceTransformer:
+    """Lấy embedding model, chỉ load một lần cho mỗi process
+
+    Khi chạy pre-fork (serve_prefork.py), model được load ở process cha trước khi fork
+    nên các worker dùng chung trang bộ nhớ chứa weights (copy-on-write).
+    """
+    key = ("embedding", model_name, device)
+    with _lock:
+        model = _models.get(key)
+        if model is None:
+            model = SentenceTransformer(model_name)
+            # Chỉ sử dụng to_device nếu method tồn tại
+            if hasattr(model, 'to_device'):
+                model = model.to_device(device)
+            _models[key] = model
+        return model
+
+
+def get_reranker(model_name: str) -> BGEReranker:
+    """Lấy BGE reranker, chỉ load một lần cho mỗi process"""
+    key = ("reranker", model_name, None)
+    with _lock:
+        reranker = _models.get(key)
+        if reranker is None:
+            reranker = BGEReranker(model_name)
+            _models[key] = reranker
+        return reranker
+
+
+def preload_models(use_rerank: bool = True):
+    """Load trước encoder và reranker (gọi ở process cha trước khi fork worker)"""
+    get_embedding_model(settings.EMBEDDING_MODEL, getattr(settings, 'QDRANT_DEVICE', 'cpu'))
+    if use_rerank:
+        try:
+            get_reranker(settings.MODEL_RERANKER)
+        except Exception as e:
+            # Worker sẽ thử load lại và chạy không rerank nếu vẫn lỗi (xem UnifiedRAGService)
+            print(f"Lỗi preload reranker: {e}")
+
+
+def get_loaded_models() -> List[str]:
+    """Danh sách model đã load trong process"""
+    with _lock:
+        return [f"{kind}:{name}" for kind, name, _ in _models]
+
+
+def configure_torch_threads(num_threads: int):
+    """Đặt số luồng intra-op của torch cho process hiện tại (0 = giữ mặc định)"""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
@@ -0,0 +1,134 @@
+from typing import Any, Dict, List, Tuple
+import re
+
+
+# Xấp xỉ tokenizer SentencePiece của Gemini: mỗi từ / âm tiết ~1 token, từ dài tách thêm
+# mỗi WORD_PIECE_CHARS ký tự, mỗi dấu câu 1 token. Không cần gọi API count_tokens.
+WORD_PIECE_CHARS = 5
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+# Nhãn "Người dùng:" / "Bot:" của mỗi lượt trong lịch sử đã format
+HISTORY_TURN_OVERHEAD = 5
+
+
+def _piece_count(match: str) -> int:
+    return 1 + (len(match) - 1) // WORD_PIECE_CHARS
+
+
+def count_tokens(text: str) -> int:
+    """Số token ước lượng của text"""
+    if not text:
+        return 0
+    return sum(_piece_count(match.group()) for match in _TOKEN_RE.finditer(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cắt text giữ phần đầu vừa max_tokens token (kể cả "…" đánh dấu phần bị cắt)"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 1:
+        return ""
+    used = 0
+    for match in _TOKEN_RE.finditer(text):
+        used += _piece_count(match.group())
+        if used > max_tokens - 1:
+            return text[:match.start()].rstrip() + "…"
+    return text
+
+
+class PromptBudgeter:
+    """Chia token budget của prompt QUESTION cho instructions, context sản phẩm và lịch sử hội thoại
+
+    Instructions và câu hỏi luôn được giữ nguyên. Phần còn lại chia cho context (giữ theo thứ tự
+    rerank - document liên quan nhất trước) và lịch sử (giữ các lượt gần nhất); lịch sử được tối đa
+    history_share phần budget còn lại, phần lịch sử không dùng hết được nhường cho context.
+    max_tokens <= 0 tắt budget (giữ toàn bộ như trước).
+    """
+
+    def __init__(self, instructions: str, max_tokens: int = 8000, history_share: float = 0.3,
+                 min_partial_tokens: int = 64):
+        self.instruction_tokens = count_tokens(instructions)
+        self.max_tokens = max_tokens
+        self.history_share = history_share
+        self.min_partial_tokens = min_partial_tokens
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_tokens > 0
+
+    def fit(self, query: str, documents: List[str],
+            history_turns: List[Tuple[str, str]]) -> Tuple[List[str], List[Tuple[str, str]], Dict[str, Any]]:
+        """Trả về (documents, history_turns) đã cắt theo budget và báo cáo số token đã dùng"""
+        query_tokens = count_tokens(query)
+        document_tokens = [count_tokens(document) for document in documents]
+        turn_tokens = [self._turn_tokens(user, bot) for user, bot in history_turns]
+
+        if not self.enabled:
+            kept_documents, kept_turns = documents, history_turns
+            context_used, history_used = sum(document_tokens), sum(turn_tokens)
+            truncated = False
+        else:
+            available = max(0, self.max_tokens - self.instruction_tokens - query_tokens)
+            history_cap = min(sum(turn_tokens), int(available * self.history_share))
+            context_budget = min(sum(document_tokens), available - history_cap)
+            history_budget = available - context_budget
+
+            kept_documents, context_used, context_truncated = self._fit_documents(
+                documents, document_tokens, context_budget
+            )
+            kept_turns, history_used, history_truncated = self._fit_history(
+                history_turns, turn_tokens, history_budget
+            )
+            truncated = context_truncated or history_truncated
+
+        report = {
+            "budget": self.max_tokens if self.enabled else None,
+            "instructions": self.instruction_tokens,
+            "query": query_tokens,
+            "context": context_used,
+            "history": history_used,
+            "total": self.instruction_tokens + query_tokens + context_used + history_used,
+            "documents_used": len(kept_documents),
+            "documents_dropped": len(documents) - len(kept_documents),
+            "history_turns_used": len(kept_turns),
+            "history_turns_dropped": len(history_turns) - len(kept_turns),
+            "truncated": truncated
+        }
+        return kept_documents, kept_turns, report
+
+    def _fit_documents(self, documents: List[str], document_tokens: List[int], budget: int):
+        """Giữ document theo thứ tự liên quan; document đầu tiên không vừa được cắt bớt rồi dừng"""
+        kept, used = [], 0
+        for document, tokens in zip(documents, document_tokens):
+            if used + tokens <= budget:
+                kept.append(document)
+                used += tokens
+                continue
+            remaining = budget - used
+            # Luôn giữ ít nhất một phần document liên quan nhất
+            if remaining >= self.min_partial_tokens or not kept:
+                partial = truncate_to_tokens(document, remaining)
+                if partial:
+                    kept.append(partial)
+                    used += count_tokens(partial)
+            return kept, used, True
+        return kept, used, False
+
+    def _fit_history(self, turns: List[Tuple[str, str]], turn_tokens: List[int], budget: int):
+        """Giữ các lượt gần nhất; lượt mới nhất không vừa thì cắt bớt câu trả lời của bot"""
+        kept, used = [], 0
+        for (user, bot), tokens in zip(reversed(turns), reversed(turn_tokens)):
+            if used + tokens <= budget:
+                kept.insert(0, (user, bot))
+                used += tokens
+                continue
+            remaining = budget - used - self._turn_tokens(user, "")
+            if not kept and remaining >= self.min_partial_tokens:
+                partial_bot = truncate_to_tokens(bot, remaining)
+                kept.insert(0, (user, partial_bot))
+                used += self._turn_tokens(user, partial_bot)
+            return kept, used, True
+        return kept, used, False
+
+    def _turn_tokens(self, user: str, bot: str) -> int:
+        return count_tokens(user) + count_tokens(bot) + HISTORY_TURN_OVERHEAD
@@ -1,9 +1,14 @@
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct, Filter, FieldCondition, MatchValue, MatchAny, Range
-from sentence_transformers import SentenceTransformer
+from qdrant_client.models import Distance, VectorParams, PointStruct, Filter, FieldCondition, MatchValue, MatchAny, Range, SearchRequest
 from config.settings import settings
+from services.embedding_cache import EmbeddingCache
+from services.metrics import metrics
+from services.model_registry import get_embedding_model
+from services.query_utils import clean_query
+from services.request_trace import current_trace
+import numpy as np
 import uuid
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 class QdrantService:
     def __init__(self):
@@ -13,52 +18,148 @@ class QdrantService:
         )
         self.collection_name = settings.QDRANT_COLLECTION_NAME
         self.device = getattr(settings, 'QDRANT_DEVICE', 'cpu')
-        self.embedding_model = SentenceTransformer(settings.EMBEDDING_MODEL)
+        # Model dùng chung trong process (và giữa các worker khi chạy pre-fork)
+        self.embedding_model = get_embedding_model(settings.EMBEDDING_MODEL, self.device)
+        # Query lặp lại (giữa các session, retry) không cần chạy lại encoder
+        self.embedding_cache = EmbeddingCache(max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES)
+
+    def _embedding_key(self, query: str) -> Tuple[str, str]:
+        # Chỉ gộp các cách viết khác nhau về khoảng trắng / Unicode - hoa / thường và dấu câu có thể
+        # đổi embedding của model. Encoder nhận đúng key[1] nên kết quả không phụ thuộc cache hit hay miss.
+        return settings.EMBEDDING_MODEL, clean_query(query)
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Tạo embedding cho nhiều query - chỉ encode (một lần gọi) các query chưa có trong cache"""
+        keys = [self._embedding_key(query) for query in queries]
+        embeddings = {}
+        # key -> query đã làm sạch sẽ đưa vào encoder
+        missing: Dict[Tuple[str, str], str] = {}
+        for key in keys:
+            if key in embeddings or key in missing:
+                continue
+            cached = self.embedding_cache.get(key)
+            if cached is not None:
+                embeddings[key] = cached
+            else:
+                missing[key] = key[1]
+        
+        if missing:
+            with metrics.time_stage("query_encode"):
+                encoded = self.embedding_model.encode(list(missing.values()), batch_size=settings.EMBEDDING_BATCH_SIZE)
+            for key, embedding in zip(missing, encoded):
+                embeddings[key] = self.embedding_cache.set(key, embedding)
+        return np.stack([embeddings[key] for key in keys])
+
+    def encode_query(self, query: str) -> np.ndarray:
+        """Tạo embedding cho một query (dùng lại embedding đã cache nếu có)"""
+        key = self._embedding_key(query)
+        embedding = self.embedding_cache.get(key)
         
-        # Chỉ sử dụng to_device nếu method tồn tại
-        if hasattr(self.embedding_model, 'to_device'):
-            self.embedding_model = self.embedding_model.to_device(self.device)
+        trace = current_trace()
+        if trace is not None:
+            trace.set_flag("embedding_cache", "hit" if embedding is not None else "miss")
+        if embedding is not None:
+            return embedding
+        
+        with metrics.time_stage("query_encode"):
+            embedding = self.embedding_model.encode([key[1]])[0]
+        return self.embedding_cache.set(key, embedding)
+
+    def search_by_vector(self, query_embedding: np.ndarray, limit: int = 5) -> List[Dict[str, Any]]:
+        """Tìm kiếm theo embedding đã có (lỗi được raise cho caller tự xử lý)"""
+        with metrics.time_stage("qdrant_search"):
+            search_result = self.client.search(
+                collection_name=self.collection_name,
+                query_vector=query_embedding.tolist(),
+                limit=limit
+            )
+        return [self._format_hit(hit) for hit in search_result]
 
     def search_similar(self, query: str, limit: int = 5, filters: Dict[str, Any] = None) -> List[Dict[str, Any]]:
         """Tìm kiếm documents tương tự"""
+        search_results, _ = self.search_similar_with_embedding(query, limit)
+        return search_results
+
+    def search_similar_with_embedding(self, query: str,
+                                      limit: int = 5) -> Tuple[List[Dict[str, Any]], Optional[np.ndarray]]:
+        """Tìm kiếm documents tương tự, trả về kèm embedding của query (None nếu encode lỗi)"""
+        query_embedding = None
         try:
             # Tạo embedding cho query
-            query_embedding = self.embedding_model.encode([query])[0]
+            query_embedding = self.encode_query(query)
             
             # Tìm kiếm
-            search_result = self.client.search(
+            return self.search_by_vector(query_embedding, limit), query_embedding
+        except Exception as e:
+            print(f"Error searching: {e}")
+            metrics.record_error("qdrant_search")
+            return [], query_embedding
+
+    def get_catalog_fingerprint(self) -> Optional[str]:
+        """Dấu vân tay của catalog trong collection, thay đổi mỗi khi index lại
+        
+        Pipeline embedding sinh uuid4 mới cho mọi point mỗi lần index, nên số points + id
+        nhỏ nhất đủ để nhận ra collection đã được index lại. None nếu không đọc được.
+        """
+        try:
+            collection_info = self.client.get_collection(self.collection_name)
+            points, _ = self.client.scroll(
                 collection_name=self.collection_name,
-                query_vector=query_embedding.tolist(),
-                limit=limit
+                limit=1,
+                with_payload=False,
+                with_vectors=False
             )
+            first_id = points[0].id if points else None
+            return f"{collection_info.points_count}:{first_id}"
+        except Exception as e:
+            print(f"Error reading catalog fingerprint: {e}")
+            metrics.record_error("qdrant_catalog_fingerprint")
+            return None
+
+    def search_similar_batch(self, queries: List[str], limit: int = 5) -> List[List[Dict[str, Any]]]:
+        """Tìm kiếm cho nhiều query: encode một lần và gửi một request search_batch tới Qdrant"""
+        if not queries:
+            return []
+        
+        try:
+            query_embeddings = self.encode_queries(queries)
             
-            # Format kết quả - map payload fields vào metadata structure
-            results = []
-            for hit in search_result:
-                # Tạo metadata từ payload
-                metadata = {
-                    "product_id": hit.payload.get("product_id"),
-                    "name": hit.payload.get("name"),
-                    "english_name": hit.payload.get("english_name"),
-                    "category_name": hit.payload.get("category_name"),
-                    "brand": hit.payload.get("brand"),
-                    "price": hit.payload.get("price"),
-                    "data_variant": hit.payload.get("data_variant"),
-                    "item_count_by": hit.payload.get("item_count_by"),
-                    "url": hit.payload.get("url"),
-                    "options": hit.payload.get("options") if hit.payload.get("options") else None,
-                    "average_rating": hit.payload.get("average_rating"),
-                    "total_rating": hit.payload.get("total_rating"),
-                    "type": hit.payload.get("type")
-                }
-                
-                results.append({
-                    "text": hit.payload.get("text", ""),
-                    "score": hit.score,
-                    "metadata": metadata
-                })
+            with metrics.time_stage("qdrant_search_batch"):
+                search_results = self.client.search_batch(
+                    collection_name=self.collection_name,
+                    requests=[
+                        SearchRequest(vector=embedding.tolist(), limit=limit, with_payload=True)
+                        for embedding in query_embeddings
+                    ]
+                )
             
-            return results
+            return [[self._format_hit(hit) for hit in hits] for hits in search_results]
         except Exception as e:
-            print(f"Error searching: {e}")
-            return []
\ No newline at end of file
+            print(f"Error batch searching: {e}")
+            metrics.record_error("qdrant_search_batch")
+            return [[] for _ in queries]
+
+    def _format_hit(self, hit) -> Dict[str, Any]:
+        """Format kết quả - map payload fields vào metadata structure"""
+        # Tạo metadata từ payload
+        metadata = {
+            "product_id": hit.payload.get("product_id"),
+            "name": hit.payload.get("name"),
+            "english_name": hit.payload.get("english_name"),
+            "category_name": hit.payload.get("category_name"),
+            "brand": hit.payload.get("brand"),
+            "price": hit.payload.get("price"),
+            "data_variant": hit.payload.get("data_variant"),
+            "item_count_by": hit.payload.get("item_count_by"),
+            "url": hit.payload.get("url"),
+            "options": hit.payload.get("options") if hit.payload.get("options") else None,
+            "average_rating": hit.payload.get("average_rating"),
+            "total_rating": hit.payload.get("total_rating"),
+            "type": hit.payload.get("type")
+        }
+        
+        return {
+            "text": hit.payload.get("text", ""),
+            "score": hit.score,
+            "metadata": metadata
+        }
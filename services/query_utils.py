@@ -0,0 +1,18 @@
+import re
+import unicodedata
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = " ?!.,;:…"
+
+
+def clean_query(query: str) -> str:
+    """Làm sạch query nhưng giữ nguyên nội dung: NFC, gộp khoảng trắng (giữ hoa / thường, dấu câu)"""
+    if not query:
+        return ""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", query)).strip()
+
+
+def normalize_query(query: str) -> str:
+    """Chuẩn hóa query để so khớp: NFC, chữ thường, gộp khoảng trắng, bỏ dấu câu cuối"""
+    return clean_query(query).lower().rstrip(_TRAILING_PUNCTUATION)
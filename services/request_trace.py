@@ -0,0 +1,74 @@
+from typing import Any, Dict, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+
+
+class RequestTrace:
+    """Thời gian từng stage và thông tin prompt của một request
+
+    Trace được gắn vào context hiện tại (contextvars) nên các bước chạy trong
+    executor của service vẫn ghi được vào đúng request (xem UnifiedRAGService._run_blocking).
+    """
+
+    def __init__(self):
+        self._start_time = time.perf_counter()
+        self._stages: Dict[str, Dict[str, float]] = {}
+        self._prompts: Dict[str, Dict[str, Any]] = {}
+        self._flags: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float):
+        """Cộng dồn thời gian của stage (một stage có thể chạy nhiều lần trong request)"""
+        with self._lock:
+            entry = self._stages.setdefault(stage, {"ms": 0.0, "calls": 0})
+            entry["ms"] += seconds * 1000
+            entry["calls"] += 1
+
+    def add_prompt(self, name: str, **info):
+        """Ghi thông tin prompt gửi tới LLM (chars, input_tokens, output_tokens)"""
+        with self._lock:
+            self._prompts.setdefault(name, {}).update(
+                {key: value for key, value in info.items() if value is not None}
+            )
+
+    def set_flag(self, key: str, value: Any):
+        with self._lock:
+            self._flags[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {
+                "total_ms": round((time.perf_counter() - self._start_time) * 1000, 2),
+                "stages": {
+                    stage: {"ms": round(entry["ms"], 2), "calls": entry["calls"]}
+                    for stage, entry in self._stages.items()
+                },
+                "prompts": {name: dict(info) for name, info in self._prompts.items()}
+            }
+            result.update(self._flags)
+            return result
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("rag_request_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    """Trace của request đang chạy, None nếu request không yêu cầu timings"""
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_request(enabled: bool = True):
+    """Bật trace cho các bước chạy trong khối with"""
+    if not enabled:
+        yield None
+        return
+
+    trace = RequestTrace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
@@ -0,0 +1,74 @@
+from typing import Any, Callable, Dict, Hashable, Tuple
+import threading
+
+
+class _Call:
+    """Một lời gọi đang chạy mà các request trùng key sẽ chờ"""
+
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Gộp các lời gọi trùng key đang chạy đồng thời thành một lần tính (singleflight)
+
+    Request đầu tiên với một key sẽ tính kết quả, các request trùng key đến trong lúc
+    đó chỉ chờ và dùng chung kết quả. Khi lời gọi xong, key được giải phóng - đây không
+    phải cache, request sau đó sẽ tính lại.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._hits = 0
+        self._misses = 0
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args) -> Tuple[Any, bool]:
+        """Chạy func(*args) hoặc chờ lời gọi trùng key đang chạy
+
+        Returns:
+            (kết quả, shared) - shared=True nếu dùng chung kết quả của request khác
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self._hits += 1
+                is_leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self._misses += 1
+                is_leader = True
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result, False
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê hit/miss"""
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / total if total else 0.0,
+                "in_flight": len(self._calls)
+            }
@@ -0,0 +1,132 @@
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from services.admission_control import StageLimiter, StageSaturated
+from services.metrics import metrics
+from services.query_utils import clean_query
+from services.request_trace import current_trace
+import contextvars
+import numpy as np
+import time
+
+
+SPECULATION_HIT = "hit"
+SPECULATION_MISS = "miss"
+SPECULATION_NOT_STARTED = "not_started"
+SPECULATION_ERROR = "error"
+
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    norm = float(np.linalg.norm(a) * np.linalg.norm(b))
+    if norm == 0.0:
+        return 0.0
+    return float(np.dot(a, b) / norm)
+
+
+class SpeculativeSearch:
+    """Encode + vector search trên query gốc đang chạy trong lúc chờ LLM viết lại query"""
+
+    def __init__(self, query: str, limit: int, future: Future):
+        self.query = query
+        self.limit = limit
+        self.future = future
+
+    def cancel(self):
+        """Bỏ kết quả (route GREETING, ...); job chưa chạy thì không chạy nữa"""
+        self.future.cancel()
+
+
+class SpeculativeRetriever:
+    """Chạy retrieval trên query gốc song song với unified chain, dùng lại nếu enhanced query gần giống
+
+    Kết quả được dùng lại khi enhanced query trùng query gốc (sau chuẩn hóa) hoặc có cosine
+    similarity embedding >= similarity_threshold; ngược lại search lại bằng embedding của enhanced query.
+    Job chạy trên executor riêng để không chiếm luồng của pipeline đang chờ nó.
+    """
+
+    def __init__(self, qdrant_service, stage_limiter: StageLimiter,
+                 similarity_threshold: float = 0.95, max_workers: int = 4):
+        self.qdrant_service = qdrant_service
+        self.stage_limiter = stage_limiter
+        self.similarity_threshold = similarity_threshold
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag-speculative")
+
+    def start(self, query: str, limit: int) -> SpeculativeSearch:
+        # Copy context để thời gian encode / search vào đúng trace của request
+        context = contextvars.copy_context()
+        future = self.executor.submit(context.run, self._encode_and_search, query, limit)
+        return SpeculativeSearch(query, limit, future)
+
+    def _encode_and_search(self, query: str, limit: int) -> Tuple[np.ndarray, List[Dict[str, Any]], float]:
+        start_time = time.perf_counter()
+        with self.stage_limiter.acquire("encoder"), metrics.time_stage("speculative_search"):
+            query_embedding = self.qdrant_service.encode_query(query)
+            search_results = self.qdrant_service.search_by_vector(query_embedding, limit)
+        return query_embedding, search_results, time.perf_counter() - start_time
+
+    def resolve(self, speculation: SpeculativeSearch, query: str,
+                limit: int) -> Tuple[List[Dict[str, Any]], Optional[np.ndarray]]:
+        """Kết quả vector search (kèm embedding) cho enhanced query, dùng lại kết quả speculative nếu được"""
+        if speculation.future.cancel():
+            # Executor bận, job chưa kịp chạy - search bình thường
+            self._record(SPECULATION_NOT_STARTED, 0.0)
+            return self._search(query, limit)
+
+        wait_start = time.perf_counter()
+        try:
+            speculative_embedding, speculative_results, elapsed = speculation.future.result()
+        except Exception as e:
+            print(f"Lỗi speculative search: {e}")
+            metrics.record_error("speculative_search")
+            self._record(SPECULATION_ERROR, 0.0)
+            return self._search(query, limit)
+        waited = time.perf_counter() - wait_start
+
+        if clean_query(query) == clean_query(speculation.query):
+            similarity = 1.0
+            query_embedding = speculative_embedding
+        else:
+            try:
+                with self.stage_limiter.acquire("encoder"):
+                    query_embedding = self.qdrant_service.encode_query(query)
+            except StageSaturated:
+                raise
+            except Exception as e:
+                print(f"Lỗi encode enhanced query: {e}")
+                metrics.record_error("speculative_search")
+                self._record(SPECULATION_ERROR, 0.0)
+                return self._search(query, limit)
+            similarity = cosine_similarity(query_embedding, speculative_embedding)
+
+        if similarity >= self.similarity_threshold and limit <= speculation.limit:
+            print(f"Dùng lại speculative search (similarity {similarity:.3f})")
+            # Phần encode + search đã chạy trong lúc chờ LLM thay vì sau đó
+            self._record(SPECULATION_HIT, max(0.0, elapsed - waited), similarity)
+            return speculative_results[:limit], query_embedding
+
+        print(f"Bỏ speculative search (similarity {similarity:.3f}) - search lại với enhanced query")
+        self._record(SPECULATION_MISS, 0.0, similarity)
+        try:
+            with self.stage_limiter.acquire("encoder"):
+                return self.qdrant_service.search_by_vector(query_embedding, limit), query_embedding
+        except StageSaturated:
+            raise
+        except Exception as e:
+            print(f"Error searching: {e}")
+            metrics.record_error("qdrant_search")
+            return [], query_embedding
+
+    def _search(self, query: str, limit: int) -> Tuple[List[Dict[str, Any]], Optional[np.ndarray]]:
+        with self.stage_limiter.acquire("encoder"):
+            return self.qdrant_service.search_similar_with_embedding(query, limit)
+
+    def _record(self, outcome: str, saved_seconds: float, similarity: Optional[float] = None):
+        metrics.record_speculation(outcome, saved_seconds)
+        trace = current_trace()
+        if trace is not None:
+            trace.set_flag("speculative_search", outcome)
+            trace.set_flag("speculative_saved_ms", round(saved_seconds * 1000, 2))
+            if similarity is not None:
+                trace.set_flag("speculative_similarity", round(similarity, 4))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,227 @@
+from typing import Any, Dict, List, Optional, Set, Tuple
+from services.query_utils import normalize_query
+import re
+
+
+LOOKUP_PRICE = "price"
+LOOKUP_LINK = "link"
+LOOKUP_RATING = "rating"
+LOOKUP_VARIANT = "variant"
+
+# Cụm từ nhận diện từng loại câu hỏi tra cứu (so khớp theo nguyên từ, ưu tiên cụm dài hơn)
+LOOKUP_PHRASES = {
+    LOOKUP_PRICE: ["giá", "giá bán", "giá tiền", "bao nhiêu tiền", "mấy tiền", "bao tiền", "nhiêu tiền", "price"],
+    LOOKUP_LINK: ["link", "link mua", "đường dẫn", "url", "mua ở đâu", "mua tại đâu", "chỗ mua", "đặt mua", "mua online"],
+    LOOKUP_RATING: ["đánh giá", "review", "rating", "mấy sao", "bao nhiêu sao", "số sao"],
+    LOOKUP_VARIANT: ["dung tích", "phiên bản", "mấy loại", "bao nhiêu loại", "các loại", "size", "kích thước",
+                     "mấy ml", "bao nhiêu ml", "biến thể", "mẫu mã"]
+}
+
+# Từ để hỏi / xưng hô / từ đệm không mang thông tin về sản phẩm
+QUESTION_WORDS = {
+    "của", "có", "bao", "nhiêu", "là", "thế", "nào", "không", "ko", "k", "vậy", "vay", "ạ", "à", "ơi",
+    "shop", "bạn", "ad", "cho", "mình", "em", "tôi", "hỏi", "xin", "với", "nhé", "nha", "sản", "phẩm",
+    "sp", "này", "cái", "hiện", "tại", "đang", "bán", "mấy", "gì", "ở", "đâu", "hả", "thì", "được",
+    "bên", "loại", "trên", "hasaki", "web", "website", "xem", "và", "the", "of", "how", "much",
+    "what", "is", "and"
+}
+
+# Cụm từ đánh giá / so sánh / hỏi độ phù hợp: câu hỏi cần tư vấn, không chỉ tra cứu metadata
+# (vd. "có tốt không, giá bao nhiêu", "giá rẻ không", "cho da dầu giá bao nhiêu")
+EVALUATIVE_PHRASES = [
+    "tốt", "rẻ", "đắt", "mắc", "hời", "đáng", "so sánh", "so với", "hơn", "nhất", "hay", "vs",
+    "hợp", "phù hợp", "thích hợp", "nên", "hiệu quả", "khác", "khác nhau", "an toàn", "dùng",
+    "công dụng", "thành phần", "chính hãng", "auth", "giả", "cho da", "loại da", "da dầu", "da khô",
+    "da mụn", "da nhạy cảm", "da hỗn hợp", "da thường"
+]
+
+_NON_WORD_RE = re.compile(r"[^\w\s]+")
+
+
+def _tokenize(text: str) -> List[str]:
+    return _NON_WORD_RE.sub(" ", normalize_query(text or "")).split()
+
+
+def format_price(price: Any) -> Optional[str]:
+    """350000 / "350000" / 350000.0 -> "350.000đ"; giá không phải số thì giữ nguyên"""
+    if price is None or price == "":
+        return None
+    try:
+        value = int(float(str(price).replace(",", "")))
+    except ValueError:
+        return str(price)
+    if value <= 0:
+        return None
+    return f"{value:,}".replace(",", ".") + "đ"
+
+
+def _product_link(name: str, url: Optional[str]) -> str:
+    return f"[{name}]({url})" if url else name
+
+
+class StructuredAnswerer:
+    """Trả lời câu hỏi tra cứu giá / link / đánh giá / phiên bản từ metadata của sản phẩm top, không gọi LLM
+
+    Chỉ trả lời khi:
+    - câu hỏi chỉ gồm cụm tra cứu, từ để hỏi và tên sản phẩm - không có cụm đánh giá / so sánh
+      (EVALUATIVE_PHRASES) và mọi từ còn lại đều có trong tên / thương hiệu sản phẩm top,
+    - câu hỏi phủ ít nhất min_name_coverage phần các từ trong tên sản phẩm top (tên chung chung
+      như "sữa rửa mặt cerave" không đủ để chọn một SKU),
+    - không có sản phẩm khác trong candidates sản phẩm đầu khớp tên bằng hoặc hơn (phiên bản
+      trong options của sản phẩm top khớp bằng thì trả lời bằng danh sách phiên bản),
+    - metadata có đủ field cho mọi loại tra cứu được hỏi.
+    Ngược lại trả về None để pipeline gọi LLM như bình thường.
+    """
+
+    def __init__(self, min_name_coverage: float = 0.6, candidates: int = 5):
+        self.min_name_coverage = min_name_coverage
+        self.candidates = candidates
+        self._phrases = sorted(
+            (
+                (tuple(phrase.split()), lookup)
+                for lookup, phrases in LOOKUP_PHRASES.items()
+                for phrase in phrases
+            ),
+            key=lambda item: len(item[0]),
+            reverse=True
+        )
+        self._evaluative_phrases = {tuple(phrase.split()) for phrase in EVALUATIVE_PHRASES}
+
+    def detect_lookups(self, query: str) -> Tuple[List[str], List[str]]:
+        """Trả về (các loại tra cứu theo thứ tự xuất hiện, các từ còn lại sau khi bỏ cụm tra cứu / từ để hỏi)"""
+        words = _tokenize(query)
+        lookups, rest = [], []
+        position = 0
+        while position < len(words):
+            for phrase, lookup in self._phrases:
+                if tuple(words[position:position + len(phrase)]) == phrase:
+                    if lookup not in lookups:
+                        lookups.append(lookup)
+                    position += len(phrase)
+                    break
+            else:
+                if words[position] not in QUESTION_WORDS:
+                    rest.append(words[position])
+                position += 1
+        return lookups, rest
+
+    def is_evaluative(self, query: str) -> bool:
+        """Câu hỏi có cụm đánh giá / so sánh / hỏi độ phù hợp (cần LLM tư vấn) không"""
+        words = _tokenize(query)
+        return any(
+            tuple(words[position:position + len(phrase)]) == phrase
+            for position in range(len(words))
+            for phrase in self._evaluative_phrases
+        )
+
+    def answer(self, query: str, search_results: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Trả về {"answer", "lookups", "product_id", "product_name", "name_coverage"} hoặc None"""
+        if not search_results or self.is_evaluative(query):
+            return None
+        lookups, rest = self.detect_lookups(query)
+        if not lookups or not rest:
+            return None
+
+        products = self._candidate_products(search_results)
+        top = products[0]
+        coverage = self._name_coverage(rest, top)
+        if coverage is None or coverage < self.min_name_coverage:
+            return None
+
+        top_variants = [
+            option for option in (top.get("options") or [])
+            if isinstance(option, dict) and option.get("name")
+        ]
+        variant_names = {normalize_query(option["name"]) for option in top_variants}
+        for other in products[1:]:
+            other_coverage = self._name_coverage(rest, other)
+            if normalize_query(other.get("name", "")) not in variant_names and \
+                    other_coverage is not None and other_coverage >= coverage:
+                return None
+
+        # Câu hỏi không phân biệt được các phiên bản (vd. không nêu dung tích) -> liệt kê cả các phiên bản
+        if any((self._name_coverage(rest, variant) or 0.0) >= coverage for variant in top_variants):
+            if LOOKUP_RATING in lookups:
+                return None
+            lines = [self._render(LOOKUP_VARIANT, top)]
+        else:
+            lines = [self._render(lookup, top) for lookup in lookups]
+        if any(line is None for line in lines):
+            return None
+        return {
+            "answer": "\n".join(lines),
+            "lookups": lookups,
+            "product_id": top.get("product_id"),
+            "product_name": top.get("name"),
+            "name_coverage": round(coverage, 2)
+        }
+
+    def _candidate_products(self, search_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Metadata của các sản phẩm khác nhau đầu tiên, giữ thứ tự rerank"""
+        products, seen = [], set()
+        for doc in search_results:
+            metadata = doc.get("metadata", {})
+            product_id = metadata.get("product_id")
+            key = product_id if product_id is not None else metadata.get("name")
+            if key in seen:
+                continue
+            seen.add(key)
+            products.append(metadata)
+            if len(products) >= self.candidates:
+                break
+        return products
+
+    def _name_coverage(self, rest: List[str], metadata: Dict[str, Any]) -> Optional[float]:
+        """Tỉ lệ từ của tên sản phẩm (name hoặc english_name) có trong câu hỏi
+
+        None nếu câu hỏi còn từ không có trong tên / thương hiệu của sản phẩm.
+        """
+        known_tokens: Set[str] = set()
+        for field in ("name", "english_name", "brand"):
+            known_tokens.update(_tokenize(metadata.get(field) or ""))
+        if any(word not in known_tokens for word in rest):
+            return None
+
+        query_tokens = set(rest)
+        coverage = 0.0
+        for field in ("name", "english_name"):
+            name_tokens = {token for token in _tokenize(metadata.get(field) or "") if token not in QUESTION_WORDS}
+            if name_tokens:
+                coverage = max(coverage, len(name_tokens & query_tokens) / len(name_tokens))
+        return coverage
+
+    def _render(self, lookup: str, metadata: Dict[str, Any]) -> Optional[str]:
+        name = metadata.get("name") or "Sản phẩm"
+        url = metadata.get("url") or None
+        product = _product_link(name, url)
+
+        if lookup == LOOKUP_PRICE:
+            price = format_price(metadata.get("price"))
+            return f"Giá của {product} hiện là {price}." if price else None
+
+        if lookup == LOOKUP_LINK:
+            return f"Bạn có thể xem và mua {product} tại: {url}" if url else None
+
+        if lookup == LOOKUP_RATING:
+            average_rating = metadata.get("average_rating")
+            total_rating = metadata.get("total_rating") or 0
+            if average_rating is None:
+                return None
+            if not total_rating:
+                return f"{product} hiện chưa có lượt đánh giá nào."
+            return f"{product} được đánh giá trung bình {float(average_rating):.1f}/5 sao từ {int(total_rating)} lượt đánh giá."
+
+        if lookup == LOOKUP_VARIANT:
+            options = [option for option in (metadata.get("options") or []) if isinstance(option, dict) and option.get("name")]
+            if not options:
+                return None
+            variants = [(name, url, metadata.get("price"))] + [
+                (option["name"], option.get("url") or None, option.get("price")) for option in options
+            ]
+            lines = [f"{product} có {len(variants)} phiên bản:"]
+            for variant_name, variant_url, variant_price in variants:
+                price = format_price(variant_price)
+                lines.append(f"- {_product_link(variant_name, variant_url)}" + (f": {price}" if price else ""))
+            return "\n".join(lines)
+
+        return None
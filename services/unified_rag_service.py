@@ -1,45 +1,139 @@
 from services.qdrant_service import QdrantService
 from model_rerank.model_rerank import RerankService
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, AsyncIterator, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from config.settings import settings
-
-# LangChain imports
-from langchain_google_genai import ChatGoogleGenerativeAI
+import asyncio
+import contextlib
+import contextvars
+import functools
+import time
 
 # Local imports
-from services.langchain.memory.conversation_memory import ConversationMemoryManager
+from services.langchain.memory.conversation_memory import (
+    ConversationMemoryManager, NO_HISTORY_SUMMARY, format_history_turns, has_context_pronoun, is_anaphoric_query
+)
+from services.langchain.memory.session_memory_store import SessionMemoryStore
 from services.langchain.chains.unified_processing_chain import UnifiedProcessingChain
 from services.langchain.chains.response_chain import ResponseChain
 from services.langchain.context.context_builder import ContextBuilder
+from services.query_utils import clean_query
+from services.singleflight import SingleFlight
+from services.ttl_cache import TTLCache
+from services.answer_cache import SemanticAnswerCache
+from services.llm_backends import create_llm_backend
+from services.llm_hedging import HedgedChatModel, HedgePolicy
+from services.prompt_budget import PromptBudgeter
+from services.admission_control import StageLimiter, StageSaturated
+from services.metrics import metrics
+from services.request_trace import trace_request, current_trace
+from services.model_registry import get_reranker
+from services.speculative_search import SpeculativeRetriever, SpeculativeSearch
+from services.structured_answers import StructuredAnswerer
+from services.greeting_fast_path import (
+    LocalIntentClassifier, TemplateResponder, INTENT_GREETING, INTENT_THANKS, INTENT_GOODBYE
+)
+from services.deadline import (
+    RequestDeadline, DEGRADE_SHRINK_SEARCH, DEGRADE_SHORTEN_RERANK, DEGRADE_SKIP_RERANK,
+    DEGRADE_TRIM_CONTEXT, DEGRADE_SKIP_ENHANCEMENT
+)
+
+
+# Câu trả lời khi không gọi được LLM ở bước 3 - không bao giờ được lưu vào answer cache
+GREETING_FALLBACK_RESPONSE = "Xin chào! Tôi có thể giúp gì cho bạn về mỹ phẩm?"
+QUESTION_FALLBACK_RESPONSE = "Xin lỗi, tôi không thể trả lời câu hỏi này. Bạn có thể hỏi khác không?"
+
+
+def fallback_response_for(route: str) -> str:
+    return GREETING_FALLBACK_RESPONSE if route == "GREETING" else QUESTION_FALLBACK_RESPONSE
+
+
+def served_product_name(search_results: List[Dict[str, Any]]) -> Optional[str]:
+    """Tên sản phẩm top (metadata["name"]) mà câu trả lời dựa vào, None nếu không có kết quả"""
+    if not search_results:
+        return None
+    return search_results[0].get("metadata", {}).get("name") or None
 
 
 class UnifiedRAGService:
     """Unified RAG Service - Không giới hạn text history và context"""
     
     def __init__(self, use_rerank: bool = True):
-        # Khởi tạo LLM với settings từ env
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            google_api_key=settings.GEMINI_API_KEY,
-            temperature=settings.LLM_TEMPERATURE,
-            timeout=settings.LLM_TIMEOUT
-        )
+        # Khởi tạo LLM theo LLM_BACKEND: Gemini (một client cho mỗi API key, chia tải theo quota từng key)
+        # hoặc fake cục bộ để load test pipeline không cần API key
+        self.llm_backend = create_llm_backend(settings.LLM_BACKEND)
+        self.llm = self.llm_backend.create_chat_model(settings.LLM_MODEL)
+        # Model dự phòng cho hedged request
+        self.hedge_llm = None
+        if settings.LLM_HEDGE_ENABLED:
+            self.hedge_llm = self.llm_backend.create_chat_model(settings.LLM_HEDGE_MODEL, label="hedge_key")
+        self.hedged_llms: Dict[str, HedgedChatModel] = {}
         
         # Khởi tạo services
         self.qdrant_service = QdrantService()
-        # ConversationBufferWindowMemory với k từ settings
-        self.memory_manager = ConversationMemoryManager(self.llm, k=settings.CONVERSATION_MEMORY_K)
+        # Memory riêng cho từng session (ConversationBufferWindowMemory với k từ settings)
+        self.memory_store = SessionMemoryStore(
+            self.llm,
+            k=settings.CONVERSATION_MEMORY_K,
+            max_sessions=settings.SESSION_MAX_SESSIONS,
+            ttl_seconds=settings.SESSION_TTL_SECONDS,
+            max_bytes=settings.SESSION_MEMORY_MAX_BYTES
+        )
+        
+        # Câu trả lời cho câu hỏi gần giống (cùng sản phẩm top), tự xóa khi catalog được index lại
+        self.answer_cache = SemanticAnswerCache(
+            max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+            ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS,
+            similarity_threshold=settings.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+            product_match_top_k=settings.ANSWER_CACHE_PRODUCT_MATCH_TOP_K,
+            routes=settings.ANSWER_CACHE_ROUTES,
+            catalog_version_fn=self.qdrant_service.get_catalog_fingerprint,
+            catalog_check_seconds=settings.ANSWER_CACHE_CATALOG_CHECK_SECONDS,
+            excluded_answers=(GREETING_FALLBACK_RESPONSE, QUESTION_FALLBACK_RESPONSE)
+        )
+        
+        # Câu chào / cảm ơn / tạm biệt hiển nhiên được nhận diện cục bộ và trả lời bằng template
+        self.intent_classifier = LocalIntentClassifier(min_confidence=settings.GREETING_FAST_PATH_MIN_CONFIDENCE)
         
         # Khởi tạo chain gộp
-        self.unified_processor = UnifiedProcessingChain(self.llm)
-        self.response_chain = ResponseChain(self.llm)
+        self.unified_processor = UnifiedProcessingChain(
+            self._hedged_llm("unified_processing"),
+            cache=TTLCache(
+                max_entries=settings.UNIFIED_CACHE_MAX_ENTRIES,
+                ttl_seconds=settings.UNIFIED_CACHE_TTL_SECONDS
+            ),
+            timeout=settings.LLM_TIMEOUT,
+            intent_classifier=self.intent_classifier
+        )
+        self.response_chain = ResponseChain(self._hedged_llm("response"), timeout=settings.LLM_TIMEOUT)
+        # Giới hạn token của prompt QUESTION: cắt context theo độ liên quan, lịch sử theo độ mới
+        self.prompt_budgeter = PromptBudgeter(
+            self.response_chain.question_template.template,
+            max_tokens=settings.PROMPT_TOKEN_BUDGET,
+            history_share=settings.PROMPT_HISTORY_SHARE,
+            min_partial_tokens=settings.PROMPT_MIN_PARTIAL_TOKENS
+        )
+        
+        # Câu chào hiển nhiên được trả lời bằng template cá nhân hóa theo memory
+        self.template_responder = TemplateResponder({
+            INTENT_GREETING: settings.GREETING_TEMPLATES,
+            INTENT_THANKS: settings.THANKS_TEMPLATES,
+            INTENT_GOODBYE: settings.GOODBYE_TEMPLATES
+        })
+        # Câu hỏi giá / link / đánh giá / phiên bản của một sản phẩm cụ thể trả lời thẳng từ metadata
+        self.structured_answerer = StructuredAnswerer(
+            min_name_coverage=settings.STRUCTURED_ANSWER_MIN_NAME_COVERAGE,
+            candidates=settings.STRUCTURED_ANSWER_CANDIDATES
+        )
         
         # Khởi tạo reranker
         self.use_rerank = use_rerank
         if use_rerank:
             try:
                 print("Đang khởi tạo Rerank Service...")
-                self.rerank_service = RerankService()
+                self.rerank_service = RerankService(reranker=get_reranker(settings.MODEL_RERANKER))
+                # Thời gian tokenize / forward pass của reranker vào metrics và trace của request
+                self.rerank_service.reranker.timing_callback = metrics.observe_stage
                 print("Rerank Service đã sẵn sàng!")
             except Exception as e:
                 print(f"Lỗi khởi tạo Rerank Service: {e}")
@@ -48,211 +142,851 @@ class UnifiedRAGService:
                 self.rerank_service = None
         else:
             self.rerank_service = None
+        
+        # Giới hạn số luồng đồng thời cho từng stage nặng
+        self.stage_limiter = StageLimiter(
+            {
+                "encoder": settings.STAGE_ENCODER_CONCURRENCY,
+                "reranker": settings.STAGE_RERANKER_CONCURRENCY,
+                "llm": settings.STAGE_LLM_CONCURRENCY
+            },
+            acquire_timeout=settings.STAGE_ACQUIRE_TIMEOUT,
+            retry_after=settings.ADMISSION_RETRY_AFTER
+        )
+        
+        # Gộp các tìm kiếm trùng query đang chạy đồng thời
+        self.search_singleflight = SingleFlight()
+        
+        # Retrieval trên query gốc chạy song song với LLM viết lại query (tùy chọn)
+        self.speculative_retriever = None
+        if settings.SPECULATIVE_RETRIEVAL_ENABLED:
+            self.speculative_retriever = SpeculativeRetriever(
+                self.qdrant_service,
+                self.stage_limiter,
+                similarity_threshold=settings.SPECULATIVE_SIMILARITY_THRESHOLD,
+                max_workers=settings.SPECULATIVE_MAX_WORKERS
+            )
+        
+        # Executor giới hạn số luồng cho các bước blocking (encode, rerank, LLM)
+        # để endpoint async không chặn event loop
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.PIPELINE_MAX_WORKERS,
+            thread_name_prefix="rag-pipeline"
+        )
     
-    def process_complete_query(self, user_query: str) -> Dict[str, Any]:
-        """Xử lý query đơn giản - Chỉ 2 routes: GREETING và QUESTION"""
+    def _hedged_llm(self, chain: str):
+        """LLM cho một chain: có hedging thì mỗi chain có ngưỡng theo latency riêng của nó"""
+        if self.hedge_llm is None:
+            return self.llm
+        self.hedged_llms[chain] = HedgedChatModel(
+            primary=self.llm,
+            hedge=self.hedge_llm,
+            name=chain,
+            policy=HedgePolicy(
+                percentile=settings.LLM_HEDGE_PERCENTILE,
+                min_delay=settings.LLM_HEDGE_MIN_DELAY,
+                max_delay=settings.LLM_HEDGE_MAX_DELAY,
+                min_samples=settings.LLM_HEDGE_MIN_SAMPLES
+            )
+        )
+        return self.hedged_llms[chain]
+    
+    async def _run_blocking(self, func: Callable, *args) -> Any:
+        """Chạy một bước blocking trong executor của service
+        
+        Copy context hiện tại sang luồng của executor để trace của request (contextvars) đi theo.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args))
+    
+    def shutdown(self):
+        """Giải phóng executor khi dừng service"""
+        self.executor.shutdown(wait=False)
+        if self.speculative_retriever is not None:
+            self.speculative_retriever.shutdown()
+    
+    def warmup(self, queries: List[str], llm_ping: bool = False) -> Dict[str, Any]:
+        """Chạy thử các stage nặng trước khi nhận request thật
+        
+        Khởi tạo kernel CPU/CUDA và cache tokenizer của encoder + reranker, mở kết nối tới
+        Qdrant và (tùy chọn) kết nối TLS tới Gemini. Lỗi ở một bước không dừng các bước sau.
+        """
+        print("=== WARMUP ===")
+        steps = {}
+        errors = {}
+        
+        # Encoder + kết nối Qdrant
+        start_time = time.time()
+        search_results = []
         try:
-            print(f"Bắt đầu xử lý query: {user_query}")
-            
-            # Bước 1: Xử lý query và routing đơn giản
-            query_info = self._step1_process_and_route(user_query)
-            
-            # Bước 2: Tìm kiếm (chỉ khi cần)
-            search_results = self._step2_search_if_needed(query_info)
-            
-            # Bước 3: Tạo response
-            response = self._step3_generate_response(query_info, search_results)
-            
-            # Lấy thông tin sản phẩm từ document đầu tiên
-            id_product = None
-            name_product = None
-            if search_results:
-                first_doc = search_results[0]
-                metadata = first_doc.get('metadata', {})
-                id_product = metadata.get('product_id')
-                name_product = metadata.get('name')
-            
-            return {
-                "success": True,
-                "answer": response,
-                "enhanced_query": query_info["enhanced_query"],
-                "route": query_info["route"],
-                "documents_found": len(search_results),
-                "id_product": id_product,
-                "name_product": name_product,
-                "memory_stats": self.memory_manager.get_memory_stats()
-            }
-            
+            for query in queries:
+                results = self.qdrant_service.search_similar(query, limit=settings.SEMANTIC_SEARCH_LIMIT)
+                if len(results) > len(search_results):
+                    search_results = results
+            if len(queries) > 1:
+                self.qdrant_service.search_similar_batch(queries, limit=settings.SEMANTIC_SEARCH_LIMIT)
         except Exception as e:
-            print(f"Lỗi xử lý query: {e}")
-            error_response = "Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi của bạn."
-            
-            # Vẫn lưu vào memory
+            print(f"Lỗi warmup search: {e}")
+            errors["search"] = str(e)
+        steps["search_ms"] = (time.time() - start_time) * 1000
+        steps["documents_found"] = len(search_results)
+        
+        # Reranker với batch đúng kích thước lúc chạy thật (SEMANTIC_SEARCH_LIMIT documents)
+        if self.use_rerank and self.rerank_service and queries:
+            start_time = time.time()
             try:
-                self.memory_manager.add_conversation_turn(user_query, error_response)
-            except:
-                pass
+                documents = list(search_results)
+                while len(documents) < settings.SEMANTIC_SEARCH_LIMIT:
+                    documents.append({"text": " ".join(queries), "score": 0.0, "metadata": {}})
+                self.rerank_service.enhance_search_results(
+                    query=queries[0],
+                    search_results=documents,
+                    top_k=settings.RERANK_TOP_K,
+                    use_batch=True
+                )
+            except Exception as e:
+                print(f"Lỗi warmup rerank: {e}")
+                errors["rerank"] = str(e)
+            steps["rerank_ms"] = (time.time() - start_time) * 1000
+        
+        # Gemini - mở kết nối TLS
+        if llm_ping:
+            start_time = time.time()
+            try:
+                self.llm.invoke("ping")
+            except Exception as e:
+                print(f"Lỗi warmup LLM: {e}")
+                errors["llm"] = str(e)
+            steps["llm_ms"] = (time.time() - start_time) * 1000
+        
+        print(f"Warmup hoàn thành: {steps}")
+        return {"steps": steps, "errors": errors}
+    
+    async def awarmup(self, queries: List[str], llm_ping: bool = False) -> Dict[str, Any]:
+        """Chạy warmup trong executor để event loop vẫn trả lời được /health"""
+        return await self._run_blocking(self.warmup, queries, llm_ping)
+    
+    def process_complete_query(self, user_query: str, session_id: str = "default") -> Dict[str, Any]:
+        """Xử lý query đơn giản - Chỉ 2 routes: GREETING và QUESTION"""
+        memory = self.memory_store.get(session_id)
+        with memory.turn():
+            try:
+                print(f"Bắt đầu xử lý query: {user_query}")
+                
+                # Bước 1: Xử lý query và routing đơn giản
+                query_info = self._step1_process_and_route(user_query, memory)
+                
+                # Bước 2: Tìm kiếm (chỉ khi cần)
+                search_results = self._step2_search_if_needed(query_info)
+                
+                # Bước 3: Tạo response
+                response = self._step3_generate_response(query_info, search_results, memory)
+                
+                # Lấy thông tin sản phẩm từ document đầu tiên
+                id_product = None
+                name_product = None
+                if search_results:
+                    first_doc = search_results[0]
+                    metadata = first_doc.get('metadata', {})
+                    id_product = metadata.get('product_id')
+                    name_product = metadata.get('name')
+                
+                return {
+                    "success": True,
+                    "answer": response,
+                    "enhanced_query": query_info["enhanced_query"],
+                    "route": query_info["route"],
+                    "documents_found": len(search_results),
+                    "id_product": id_product,
+                    "name_product": name_product,
+                    "memory_stats": memory.get_memory_stats()
+                }
+                
+            except StageSaturated:
+                raise
+            except Exception as e:
+                print(f"Lỗi xử lý query: {e}")
+                metrics.record_error("process_complete_query")
+                error_response = "Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi của bạn."
+                
+                # Vẫn lưu vào memory
+                try:
+                    memory.add_conversation_turn(user_query, error_response)
+                except:
+                    pass
+                
+                return {
+                    "success": False,
+                    "answer": error_response,
+                    "error": str(e)
+                }
+    
+    def process_complete_query_with_details(self, user_query: str, show_details: bool = True,
+                                            session_id: str = "default",
+                                            show_timings: bool = False,
+                                            deadline: Optional[RequestDeadline] = None) -> Dict[str, Any]:
+        """Xử lý query với thông tin chi tiết về transform và chunks - KHÔNG GIỚI HẠN TEXT
+        
+        show_timings=True thêm "timings": thời gian từng stage và độ dài/số token của từng prompt.
+        deadline: latency budget của request; khi sắp hết, các stage chạy bản rẻ hơn và
+        các mức giảm chất lượng đã áp dụng được ghi vào "degradations".
+        """
+        memory = self.memory_store.get(session_id)
+        with memory.turn(), trace_request(show_timings) as trace:
+            try:
+                print(f"Bắt đầu xử lý query với details (UNLIMITED TEXT): {user_query}")
+                
+                # Bước 1: Xử lý query và routing với details
+                query_info = self._step1_process_and_route_with_details(
+                    user_query, show_details, memory, deadline, True
+                )
+                
+                # Bước 2: Tìm kiếm với details
+                search_results, search_details = self._step2_search_with_details(query_info, show_details, deadline)
+                
+                # Bước 3: Tạo response với details
+                response, context_details = self._step3_generate_response_with_details(
+                    query_info, search_results, show_details, memory, deadline
+                )
+                
+                result = self._build_result_with_details(
+                    query_info, search_results, search_details, response, context_details, show_details, memory
+                )
+                
+            except StageSaturated:
+                raise
+            except Exception as e:
+                print(f"Lỗi xử lý query với details: {e}")
+                metrics.record_error("process_complete_query_with_details")
+                result = self._build_error_result(user_query, e, memory)
             
-            return {
-                "success": False,
-                "answer": error_response,
-                "error": str(e)
-            }
+            self._attach_request_info(result, trace, deadline)
+            return result
     
-    def process_complete_query_with_details(self, user_query: str, show_details: bool = True) -> Dict[str, Any]:
-        """Xử lý query với thông tin chi tiết về transform và chunks - KHÔNG GIỚI HẠN TEXT"""
+    async def aprocess_complete_query_with_details(self, user_query: str, show_details: bool = True,
+                                                   session_id: str = "default",
+                                                   show_timings: bool = False,
+                                                   deadline: Optional[RequestDeadline] = None) -> Dict[str, Any]:
+        """Phiên bản async của process_complete_query_with_details
+        
+        Encode, search và rerank chạy trong executor giới hạn của service; lời gọi Gemini
+        được await trực tiếp (ainvoke) nên request đang chờ LLM không chiếm luồng nào.
+        Request bị hủy (client ngắt kết nối) thì lời gọi Gemini đang chờ bị hủy theo.
+        """
+        memory = self.memory_store.get(session_id)
+        async with memory.aturn():
+            with trace_request(show_timings) as trace:
+                try:
+                    print(f"Bắt đầu xử lý query async với details (UNLIMITED TEXT): {user_query}")
+                    
+                    query_info = await self._astep1_process_and_route_with_details(
+                        user_query, show_details, memory, deadline, True
+                    )
+                    
+                    search_results, search_details = await self._run_blocking(
+                        self._step2_search_with_details, query_info, show_details, deadline
+                    )
+                    
+                    response, context_details = await self._astep3_generate_response_with_details(
+                        query_info, search_results, show_details, memory, deadline
+                    )
+                    
+                    result = self._build_result_with_details(
+                        query_info, search_results, search_details, response, context_details, show_details, memory
+                    )
+                    
+                except StageSaturated:
+                    raise
+                except Exception as e:
+                    print(f"Lỗi xử lý query async với details: {e}")
+                    metrics.record_error("process_complete_query_with_details")
+                    result = await self._run_blocking(self._build_error_result, user_query, e, memory)
+                
+                self._attach_request_info(result, trace, deadline)
+                return result
+    
+    def _attach_request_info(self, result: Dict[str, Any], trace, deadline: Optional[RequestDeadline]):
+        """Thêm timings (nếu bật trace) và các mức giảm chất lượng đã áp dụng vào kết quả"""
+        if trace is not None:
+            result["timings"] = trace.to_dict()
+        if deadline is not None and deadline.degradations:
+            result["degradations"] = deadline.degradations
+    
+    async def astream_complete_query(self, user_query: str, session_id: str = "default",
+                                     deadline: Optional[RequestDeadline] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Xử lý query và stream câu trả lời theo từng đoạn token
+        
+        Yield các event dạng {"event": ..., "data": ...}:
+        - "metadata": route, enhanced_query, sản phẩm và documents đã tìm được (gửi trước khi gọi LLM)
+        - "token": một đoạn text vừa nhận từ Gemini
+        - "done": câu trả lời đầy đủ sau khi đã lưu vào memory
+        - "error": lỗi trong quá trình xử lý kèm câu trả lời fallback, hoặc phần đã stream
+          kèm "truncated": true khi Gemini lỗi giữa chừng (lượt này không được lưu vào memory)
+        """
+        memory = self.memory_store.get(session_id)
+        # Giữ session tới khi stream xong (hoặc bị đóng) - lượt sau của session chờ lượt này lưu vào memory
+        async with memory.aturn():
+            async for event in self._astream_turn(user_query, memory, deadline):
+                yield event
+    
+    async def _astream_turn(self, user_query: str, memory: ConversationMemoryManager,
+                            deadline: Optional[RequestDeadline]) -> AsyncIterator[Dict[str, Any]]:
+        """Một lượt stream của astream_complete_query, chạy khi đã giữ lock lượt của session"""
+        start_time = time.time()
+        
         try:
-            print(f"Bắt đầu xử lý query với details (UNLIMITED TEXT): {user_query}")
+            print(f"Bắt đầu xử lý query streaming: {user_query}")
             
-            # Bước 1: Xử lý query và routing với details
-            query_info = self._step1_process_and_route_with_details(user_query, show_details)
-            
-            # Bước 2: Tìm kiếm với details
-            search_results, search_details = self._step2_search_with_details(query_info, show_details)
-            
-            # Bước 3: Tạo response với details
-            response, context_details = self._step3_generate_response_with_details(query_info, search_results, show_details)
-            
-            # Lấy thông tin sản phẩm từ document đầu tiên
-            id_product = None
-            name_product = None
-            if search_results:
-                first_doc = search_results[0]
-                metadata = first_doc.get('metadata', {})
-                id_product = metadata.get('product_id')
-                name_product = metadata.get('name')
-            
-            result = {
+            query_info = await self._astep1_process_and_route_with_details(
+                user_query, False, memory, deadline, True
+            )
+            route = query_info.get("route", "QUESTION")
+            cached_answer, structured_answer = None, None
+            if query_info.get("fast_path"):
+                # Trả lời bằng template - không cần search và context
+                search_results, context, chat_history = [], "", ""
+            else:
+                search_results, _ = await self._run_blocking(
+                    self._step2_search_with_details, query_info, False, deadline
+                )
+                structured_answer = self._lookup_structured_answer(query_info, search_results, route)
+                if structured_answer is None:
+                    cached_answer = await self._run_blocking(
+                        self._lookup_cached_answer, query_info, search_results, route, memory
+                    )
+            if cached_answer is None and structured_answer is None and not query_info.get("fast_path"):
+                context, chat_history = await self._run_blocking(
+                    self._prepare_generation_inputs, query_info, search_results, memory,
+                    self._plan_context_top_k(deadline)
+                )
+        except StageSaturated:
+            raise
+        except Exception as e:
+            print(f"Lỗi xử lý query streaming: {e}")
+            metrics.record_error("stream_prepare")
+            error_result = await self._run_blocking(self._build_error_result, user_query, e, memory)
+            yield {"event": "error", "data": error_result}
+            return
+        
+        metadata = self._build_result_with_details(query_info, search_results, {}, "", {}, False, memory)
+        metadata.pop("answer")
+        if deadline is not None and deadline.degradations:
+            metadata["degradations"] = deadline.degradations
+        metadata["documents"] = [
+            {
+                "product_id": doc.get("metadata", {}).get("product_id"),
+                "name": doc.get("metadata", {}).get("name"),
+                "url": doc.get("metadata", {}).get("url"),
+                "price": doc.get("metadata", {}).get("price"),
+                "score": doc.get("score")
+            }
+            for doc in search_results[:settings.CONTEXT_TOP_K]
+        ]
+        yield {"event": "metadata", "data": metadata}
+        
+        answer_parts = []
+        if query_info.get("fast_path"):
+            # Template trả về ngay, gửi cả câu trong một event token
+            answer_parts.append(self._render_fast_path_response(query_info, memory))
+            yield {"event": "token", "data": {"text": answer_parts[0]}}
+        elif structured_answer is not None:
+            # Câu hỏi tra cứu trả lời từ metadata - gửi cả câu trong một event token
+            answer_parts.append(structured_answer["answer"])
+            yield {"event": "token", "data": {"text": answer_parts[0]}}
+        elif cached_answer is not None:
+            # Câu trả lời đã cache cho câu hỏi gần giống - gửi cả câu trong một event token
+            print(f"Dùng lại câu trả lời đã cache của: {cached_answer['query']}")
+            answer_parts.append(cached_answer["answer"])
+            yield {"event": "token", "data": {"text": answer_parts[0]}}
+        else:
+            try:
+                async with self.stage_limiter.aacquire("llm"):
+                    async for chunk in self.response_chain.astream_response(
+                        query_info, context, chat_history, route, self._llm_timeout(deadline)
+                    ):
+                        answer_parts.append(chunk)
+                        yield {"event": "token", "data": {"text": chunk}}
+                # Chỉ cache câu trả lời stream trọn vẹn
+                self._store_cached_answer(
+                    query_info, search_results, route, "".join(answer_parts), memory, deadline
+                )
+            except Exception as e:
+                print(f"Lỗi stream response: {e}")
+                metrics.record_error("stream_response")
+                if not answer_parts:
+                    metrics.record_fallback("step3_fallback_response")
+                    # Chưa gửi token nào - trả về fallback như luồng thường
+                    fallback_response = fallback_response_for(route)
+                    yield {"event": "error", "data": {"success": False, "answer": fallback_response, "error": str(e)}}
+                    return
+                # Đứt giữa chừng - báo lỗi kèm phần đã gửi, không lưu câu trả lời dở vào memory
+                metrics.record_error("stream_truncated")
+                yield {
+                    "event": "error",
+                    "data": {
+                        "success": False,
+                        "truncated": True,
+                        "answer": "".join(answer_parts),
+                        "error": str(e),
+                        "processing_time": time.time() - start_time
+                    }
+                }
+                return
+        
+        response = "".join(answer_parts)
+        served_product = (
+            structured_answer["product_name"] if structured_answer is not None
+            else served_product_name(search_results)
+        )
+        
+        # Lưu vào memory
+        try:
+            await self._run_blocking(
+                memory.add_conversation_turn, query_info.get("enhanced_query", ""), response, served_product
+            )
+        except Exception as e:
+            print(f"Lỗi lưu memory: {e}")
+            metrics.record_error("memory_save")
+        
+        yield {
+            "event": "done",
+            "data": {
                 "success": True,
                 "answer": response,
-                "enhanced_query": query_info["enhanced_query"],
-                "route": query_info["route"],
-                "documents_found": len(search_results),
-                "id_product": id_product,
-                "name_product": name_product,
-                "memory_stats": self.memory_manager.get_memory_stats()
+                "processing_time": time.time() - start_time
             }
-            
-            # Thêm thông tin chi tiết nếu được yêu cầu
-            if show_details:
-                result.update({
-                    "query_transform_info": query_info.get("transform_details"),
-                    "chunks_info": search_details.get("chunks_info"),
-                    "context_info": context_details
-                })
-            
-            return result
-            
-        except Exception as e:
-            print(f"Lỗi xử lý query với details: {e}")
-            error_response = "Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi của bạn."
-            
-            # Vẫn lưu vào memory
+        }
+    
+    async def aprocess_batch(self, requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Xử lý nhiều message trong một lần - dùng chung encode, Qdrant search_batch và rerank batch
+        
+        Mỗi request là dict có "message", "session_id" và "show_details". Các message cùng
+        session được xử lý lần lượt theo thứ tự (mỗi lượt là một "wave") để lịch sử hội thoại
+        đúng thứ tự; các message khác session trong cùng wave chạy chung batch và gọi LLM song song.
+        """
+        results: List[Dict[str, Any]] = [None] * len(requests)
+        
+        # Chia waves: wave thứ k chứa message thứ k của mỗi session
+        waves: List[List[int]] = []
+        session_counts: Dict[str, int] = {}
+        for index, request in enumerate(requests):
+            session_id = request.get("session_id") or "default"
+            position = session_counts.get(session_id, 0)
+            session_counts[session_id] = position + 1
+            if position == len(waves):
+                waves.append([])
+            waves[position].append(index)
+        
+        for wave in waves:
+            wave_requests = [requests[index] for index in wave]
+            # Giữ lock lượt của mọi session trong wave (theo thứ tự session_id để tránh deadlock giữa các batch)
+            async with contextlib.AsyncExitStack() as stack:
+                for session_id in sorted(request.get("session_id") or "default" for request in wave_requests):
+                    await stack.enter_async_context(self.memory_store.get(session_id).aturn())
+                wave_results = await self._aprocess_batch_wave(wave_requests)
+            for index, result in zip(wave, wave_results):
+                results[index] = result
+        
+        return results
+    
+    async def _aprocess_batch_wave(self, requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Xử lý một wave gồm các message thuộc các session khác nhau"""
+        memories = [self.memory_store.get(request.get("session_id") or "default") for request in requests]
+        show_details = [request.get("show_details", False) for request in requests]
+        
+        # Bước 1: routing + enhance song song
+        query_infos = await asyncio.gather(*[
+            self._astep1_process_and_route_with_details(request["message"], details, memory)
+            for request, details, memory in zip(requests, show_details, memories)
+        ], return_exceptions=True)
+        
+        # Bước 2: tìm kiếm chung cho các QUESTION
+        search_results_list: List[List[Dict[str, Any]]] = [[] for _ in requests]
+        question_indexes = [
+            i for i, query_info in enumerate(query_infos)
+            if not isinstance(query_info, Exception) and query_info.get("route") != "GREETING"
+        ]
+        if question_indexes:
             try:
-                self.memory_manager.add_conversation_turn(user_query, error_response)
-            except:
-                pass
+                batch_results = await self._run_blocking(
+                    self._search_batch_queries,
+                    [query_infos[i].get("enhanced_query", "") for i in question_indexes]
+                )
+                for i, search_results in zip(question_indexes, batch_results):
+                    search_results_list[i] = search_results
+            except StageSaturated:
+                raise
+            except Exception as e:
+                print(f"Lỗi tìm kiếm batch: {e}")
+                metrics.record_error("search_batch")
+        
+        # Bước 3: tạo response song song
+        async def generate(i: int) -> Dict[str, Any]:
+            query_info = query_infos[i]
+            if isinstance(query_info, Exception):
+                raise query_info
             
-            return {
-                "success": False,
-                "answer": error_response,
-                "error": str(e)
+            response, context_details = await self._astep3_generate_response_with_details(
+                query_info, search_results_list[i], show_details[i], memories[i]
+            )
+            search_details = {
+                "chunks_info": self._build_chunks_info(search_results_list[i]) if show_details[i] else []
             }
+            return self._build_result_with_details(
+                query_info, search_results_list[i], search_details, response,
+                context_details, show_details[i], memories[i]
+            )
+        
+        outcomes = await asyncio.gather(*[generate(i) for i in range(len(requests))], return_exceptions=True)
+        
+        results = []
+        for request, memory, outcome in zip(requests, memories, outcomes):
+            if isinstance(outcome, StageSaturated):
+                raise outcome
+            if isinstance(outcome, Exception):
+                print(f"Lỗi xử lý query trong batch: {outcome}")
+                metrics.record_error("batch_query")
+                outcome = await self._run_blocking(self._build_error_result, request["message"], outcome, memory)
+            results.append(outcome)
+        return results
+    
+    def _build_result_with_details(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                                   search_details: Dict[str, Any], response: str,
+                                   context_details: Dict[str, Any], show_details: bool,
+                                   memory: ConversationMemoryManager) -> Dict[str, Any]:
+        """Gộp kết quả 3 bước thành response dict"""
+        # Lấy thông tin sản phẩm từ document đầu tiên
+        id_product = None
+        name_product = None
+        if search_results:
+            first_doc = search_results[0]
+            metadata = first_doc.get('metadata', {})
+            id_product = metadata.get('product_id')
+            name_product = metadata.get('name')
+        
+        result = {
+            "success": True,
+            "answer": response,
+            "enhanced_query": query_info["enhanced_query"],
+            "route": query_info["route"],
+            "documents_found": len(search_results),
+            "id_product": id_product,
+            "name_product": name_product,
+            "memory_stats": memory.get_memory_stats()
+        }
+        metrics.record_route(query_info["route"])
+        
+        # Thêm thông tin chi tiết nếu được yêu cầu
+        if show_details:
+            result.update({
+                "query_transform_info": query_info.get("transform_details"),
+                "chunks_info": search_details.get("chunks_info"),
+                "context_info": context_details
+            })
+        
+        return result
+    
+    def _build_error_result(self, user_query: str, error: Exception,
+                            memory: ConversationMemoryManager) -> Dict[str, Any]:
+        """Tạo response lỗi và vẫn lưu lượt hội thoại vào memory"""
+        error_response = "Xin lỗi, đã xảy ra lỗi khi xử lý câu hỏi của bạn."
+        metrics.record_route("ERROR")
+        
+        # Vẫn lưu vào memory
+        try:
+            memory.add_conversation_turn(user_query, error_response)
+        except:
+            pass
+        
+        return {
+            "success": False,
+            "answer": error_response,
+            "error": str(error)
+        }
     
-    def _step1_process_and_route(self, user_query: str) -> Dict[str, Any]:
+    @metrics.timed("step1_process_and_route")
+    def _step1_process_and_route(self, user_query: str, memory: ConversationMemoryManager) -> Dict[str, Any]:
         """Bước 1: Xử lý và routing gộp với unified chain"""
         print("=== BƯỚC 1: XỬ LÝ VÀ ROUTING GỘP ===")
         
+        # Câu chào hỏi hiển nhiên - không cần gọi LLM
+        fast_path_info = self._fast_path_query_info(user_query)
+        if fast_path_info is not None:
+            return fast_path_info
+        
         # Lấy chat summary
-        chat_summary = self.memory_manager.get_conversation_summary()
+        chat_summary = memory.get_conversation_summary()
         print(f"Chat summary: {chat_summary}")
         
+        # Không có gì để viết lại - dùng nguyên query cho retrieval
+        skip_reason = self._rewrite_skip_reason(user_query, chat_summary)
+        if skip_reason is not None:
+            return self._direct_query_info(user_query, skip_reason)
+        
         # Xử lý gộp với unified chain
         try:
-            query_info = self.unified_processor.process_query_unified(user_query, chat_summary)
+            with self.stage_limiter.acquire("llm"):
+                query_info = self.unified_processor.process_query_unified(user_query, chat_summary)
             print(f"Unified processing result: {query_info}")
             return query_info
+        except StageSaturated:
+            raise
         except Exception as e:
             print(f"Lỗi unified processing, dùng fallback: {e}")
+            metrics.record_error("step1_process_and_route")
+            metrics.record_fallback("step1_rule_based")
             # Fallback processing
-            greeting_keywords = ['xin chào', 'hello', 'hi', 'chào', 'cảm ơn', 'thanks', 'tạm biệt', 'bye']
-            if any(keyword in user_query.lower() for keyword in greeting_keywords):
-                route = "GREETING"
-            else:
-                route = "QUESTION"
-            
-            return {
-                "intent": route,
-                "enhanced_query": user_query,
-                "route": route,
-                "sub_queries": [user_query],
-                "query_count": 1,
-                "original_query": user_query
-            }
+            return self._rule_based_query_info(user_query)
+    
+    def _rule_based_query_info(self, user_query: str) -> Dict[str, Any]:
+        """Routing cục bộ, giữ nguyên query (dùng khi không gọi được LLM)
+        
+        Chỉ câu chào / cảm ơn / tạm biệt hiển nhiên (so khớp nguyên từ) mới là GREETING;
+        chưa chắc chắn thì route QUESTION để không bỏ qua search của câu hỏi sản phẩm.
+        """
+        route = "GREETING" if self.intent_classifier.classify(user_query) is not None else "QUESTION"
+        
+        return {
+            "intent": route,
+            "enhanced_query": user_query,
+            "route": route,
+            "sub_queries": [user_query],
+            "query_count": 1,
+            "original_query": user_query
+        }
+    
+    def _fast_path_query_info(self, user_query: str) -> Optional[Dict[str, Any]]:
+        """Routing GREETING bằng classifier cục bộ; None nếu tắt fast path hoặc câu chưa đủ chắc chắn"""
+        if not settings.GREETING_FAST_PATH_ENABLED:
+            return None
+        
+        classification = self.intent_classifier.classify(user_query)
+        if classification is None:
+            return None
+        
+        print(f"Fast path {classification['intent']} (confidence {classification['confidence']}) - bỏ qua LLM")
+        result = self._rule_based_query_info(user_query)
+        result.update({
+            "intent": "GREETING",
+            "route": "GREETING",
+            "fast_path": classification["intent"],
+            "intent_confidence": classification["confidence"]
+        })
+        return result
+    
+    def _rewrite_skip_reason(self, user_query: str, chat_summary: str) -> Optional[str]:
+        """Lý do bỏ qua LLM viết lại query ("first_turn" / "self_contained"); None nếu cần gọi LLM
+        
+        Chỉ câu hỏi nối tiếp (có đại từ hoặc lược chủ ngữ) mới cần LLM thay bằng sản phẩm trong lịch sử.
+        """
+        if not settings.QUERY_REWRITE_SKIP_ENABLED:
+            return None
+        
+        # Câu có lời chào lẫn nội dung khác - để LLM quyết định route
+        if self.intent_classifier.mentions_intent(user_query):
+            return None
+        
+        if chat_summary == NO_HISTORY_SUMMARY:
+            return "first_turn"
+        if not is_anaphoric_query(user_query):
+            return "self_contained"
+        return None
+    
+    def _direct_query_info(self, user_query: str, skip_reason: str) -> Dict[str, Any]:
+        """Route QUESTION với nguyên query, không qua unified chain"""
+        print(f"Bỏ qua LLM rewrite ({skip_reason}) - dùng nguyên query")
+        metrics.record_rewrite_skip(skip_reason)
+        result = self._rule_based_query_info(user_query)
+        result.update({
+            "intent": "QUESTION",
+            "route": "QUESTION",
+            "rewrite_skipped": skip_reason
+        })
+        return result
     
-    def _step1_process_and_route_with_details(self, user_query: str, show_details: bool) -> Dict[str, Any]:
-        """Bước 1: Xử lý và routing với thông tin chi tiết"""
+    @metrics.timed("step1_process_and_route")
+    def _step1_process_and_route_with_details(self, user_query: str, show_details: bool,
+                                              memory: ConversationMemoryManager,
+                                              deadline: Optional[RequestDeadline] = None,
+                                              speculate: bool = False) -> Dict[str, Any]:
+        """Bước 1: Xử lý và routing với thông tin chi tiết
+        
+        speculate=True: chạy trước encode + search trên query gốc trong lúc chờ unified chain
+        (nếu bật SPECULATIVE_RETRIEVAL_ENABLED), bước 2 sẽ dùng lại nếu enhanced query gần giống.
+        """
         print("=== BƯỚC 1: XỬ LÝ VÀ ROUTING GỘP (WITH DETAILS) ===")
         
-        # Lấy chat summary
-        chat_summary = self.memory_manager.get_conversation_summary()
-        print(f"Chat summary: {chat_summary}")
+        chat_summary, local_info = self._step1_route_locally(user_query, show_details, memory, deadline)
+        if local_info is not None:
+            return local_info
+        
+        speculation = self._start_speculative_search(user_query, deadline) if speculate else None
         
         # Xử lý gộp với unified chain
         try:
-            query_info = self.unified_processor.process_query_unified(user_query, chat_summary)
-            print(f"Unified processing result: {query_info}")
+            with self.stage_limiter.acquire("llm"):
+                query_info = self.unified_processor.process_query_unified(
+                    user_query, chat_summary, self._llm_timeout(deadline)
+                )
+            return self._step1_unified_result(query_info, user_query, chat_summary, show_details, memory, speculation)
+        except StageSaturated:
+            if speculation is not None:
+                speculation.cancel()
+            raise
+        except Exception as e:
+            return self._step1_fallback_result(user_query, chat_summary, e, show_details, speculation)
+    
+    async def _astep1_process_and_route_with_details(self, user_query: str, show_details: bool,
+                                                     memory: ConversationMemoryManager,
+                                                     deadline: Optional[RequestDeadline] = None,
+                                                     speculate: bool = False) -> Dict[str, Any]:
+        """Bản async của bước 1: chờ unified chain trên event loop thay vì giữ một luồng của executor"""
+        with metrics.time_stage("step1_process_and_route"):
+            print("=== BƯỚC 1: XỬ LÝ VÀ ROUTING GỘP (ASYNC) ===")
+            
+            chat_summary, local_info = self._step1_route_locally(user_query, show_details, memory, deadline)
+            if local_info is not None:
+                return local_info
             
-            # Thêm thông tin chi tiết về transform
+            speculation = self._start_speculative_search(user_query, deadline) if speculate else None
+            
+            try:
+                async with self.stage_limiter.aacquire("llm"):
+                    query_info = await self.unified_processor.aprocess_query_unified(
+                        user_query, chat_summary, self._llm_timeout(deadline)
+                    )
+                return self._step1_unified_result(query_info, user_query, chat_summary, show_details, memory, speculation)
+            except (StageSaturated, asyncio.CancelledError):
+                if speculation is not None:
+                    speculation.cancel()
+                raise
+            except Exception as e:
+                return self._step1_fallback_result(user_query, chat_summary, e, show_details, speculation)
+    
+    def _step1_route_locally(self, user_query: str, show_details: bool, memory: ConversationMemoryManager,
+                             deadline: Optional[RequestDeadline]) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """Phần routing không cần LLM của bước 1, trả về (chat_summary, query_info hoặc None nếu cần unified chain)"""
+        # Lấy chat summary
+        chat_summary = memory.get_conversation_summary()
+        print(f"Chat summary: {chat_summary}")
+        
+        # Câu chào hỏi hiển nhiên - không cần gọi LLM
+        fast_path_info = self._fast_path_query_info(user_query)
+        if fast_path_info is not None:
             if show_details:
-                query_info["transform_details"] = {
+                fast_path_info["transform_details"] = {
                     "original_query": user_query,
                     "chat_summary": chat_summary,
-                    "enhanced_query": query_info.get("enhanced_query"),
-                    "intent_detected": query_info.get("intent"),
-                    "route_selected": query_info.get("route"),
-                    "enhancement_method": "unified_processing_chain",
-                    "context_used": bool(chat_summary and chat_summary != "Chưa có lịch sử."),
-                    "memory_entities": {
-                        "recent_brands": getattr(self.memory_manager, '_recent_brands', []),
-                        "recent_categories": getattr(self.memory_manager, '_recent_categories', []),
-                        "recent_products": getattr(self.memory_manager, '_recent_products', [])
-                    }
+                    "enhanced_query": user_query,
+                    "intent_detected": fast_path_info["fast_path"],
+                    "intent_confidence": fast_path_info["intent_confidence"],
+                    "route_selected": fast_path_info["route"],
+                    "enhancement_method": "local_intent_classifier",
+                    "context_used": False,
+                    "memory_entities": memory.get_memory_entities()
                 }
-            
-            return query_info
-            
-        except Exception as e:
-            print(f"Lỗi unified processing, dùng fallback: {e}")
-            # Fallback processing
-            greeting_keywords = ['xin chào', 'hello', 'hi', 'chào', 'cảm ơn', 'thanks', 'tạm biệt', 'bye']
-            if any(keyword in user_query.lower() for keyword in greeting_keywords):
-                route = "GREETING"
-            else:
-                route = "QUESTION"
-            
-            result = {
-                "intent": route,
-                "enhanced_query": user_query,
-                "route": route,
-                "sub_queries": [user_query],
-                "query_count": 1,
-                "original_query": user_query
-            }
-            
+            return chat_summary, fast_path_info
+        
+        # Không có gì để viết lại (lượt đầu hoặc câu hỏi tự đủ nghĩa) - dùng nguyên query cho retrieval
+        skip_reason = self._rewrite_skip_reason(user_query, chat_summary)
+        if skip_reason is not None:
+            result = self._direct_query_info(user_query, skip_reason)
             if show_details:
                 result["transform_details"] = {
                     "original_query": user_query,
                     "chat_summary": chat_summary,
                     "enhanced_query": user_query,
-                    "intent_detected": route,
-                    "route_selected": route,
-                    "enhancement_method": "fallback_rule_based",
+                    "intent_detected": result["route"],
+                    "route_selected": result["route"],
+                    "enhancement_method": f"skipped_{skip_reason}",
                     "context_used": False,
-                    "error": str(e)
+                    "memory_entities": memory.get_memory_entities()
                 }
-            
-            return result
+            return chat_summary, result
+        
+        # Sắp hết deadline -> bỏ qua LLM enhancement, routing theo từ khóa
+        if deadline is not None and deadline.should_degrade(DEGRADE_SKIP_ENHANCEMENT):
+            print("Deadline sắp hết - bỏ qua query enhancement LLM")
+            result = self._rule_based_query_info(user_query)
+            if show_details:
+                result["transform_details"] = {
+                    "original_query": user_query,
+                    "chat_summary": chat_summary,
+                    "enhanced_query": user_query,
+                    "intent_detected": result["route"],
+                    "route_selected": result["route"],
+                    "enhancement_method": "skipped_deadline",
+                    "context_used": False
+                }
+            return chat_summary, result
+        
+        return chat_summary, None
+    
+    def _step1_unified_result(self, query_info: Dict[str, Any], user_query: str, chat_summary: str,
+                              show_details: bool, memory: ConversationMemoryManager,
+                              speculation: Optional[SpeculativeSearch]) -> Dict[str, Any]:
+        """Hoàn thiện kết quả của unified chain: gắn speculative search và thông tin chi tiết"""
+        print(f"Unified processing result: {query_info}")
+        self._attach_speculation(query_info, speculation)
+        
+        # Thêm thông tin chi tiết về transform
+        if show_details:
+            query_info["transform_details"] = {
+                "original_query": user_query,
+                "chat_summary": chat_summary,
+                "enhanced_query": query_info.get("enhanced_query"),
+                "intent_detected": query_info.get("intent"),
+                "route_selected": query_info.get("route"),
+                "filters": query_info.get("filters"),
+                "enhancement_method": "unified_processing_chain",
+                "context_used": bool(chat_summary and chat_summary != NO_HISTORY_SUMMARY),
+                "memory_entities": memory.get_memory_entities()
+            }
+        
+        return query_info
+    
+    def _step1_fallback_result(self, user_query: str, chat_summary: str, error: Exception, show_details: bool,
+                               speculation: Optional[SpeculativeSearch]) -> Dict[str, Any]:
+        """Routing theo từ khóa khi unified chain lỗi"""
+        print(f"Lỗi unified processing, dùng fallback: {error}")
+        metrics.record_error("step1_process_and_route")
+        metrics.record_fallback("step1_rule_based")
+        # Fallback processing
+        result = self._rule_based_query_info(user_query)
+        route = result["route"]
+        self._attach_speculation(result, speculation)
+        
+        if show_details:
+            result["transform_details"] = {
+                "original_query": user_query,
+                "chat_summary": chat_summary,
+                "enhanced_query": user_query,
+                "intent_detected": route,
+                "route_selected": route,
+                "enhancement_method": "fallback_rule_based",
+                "context_used": False,
+                "error": str(error)
+            }
+        
+        return result
+    
+    def _start_speculative_search(self, user_query: str,
+                                  deadline: Optional[RequestDeadline]) -> Optional[SpeculativeSearch]:
+        """Bắt đầu encode + vector search trên query gốc, chạy song song với LLM viết lại query"""
+        if self.speculative_retriever is None:
+            return None
+        search_limit, _ = self._plan_search(deadline)
+        return self.speculative_retriever.start(user_query, search_limit)
+    
+    def _attach_speculation(self, query_info: Dict[str, Any], speculation: Optional[SpeculativeSearch]):
+        """Chuyển speculative search sang bước 2 nếu route cần search, ngược lại bỏ"""
+        if speculation is None:
+            return
+        if query_info.get("route") == "GREETING":
+            speculation.cancel()
+        else:
+            query_info["speculative_search"] = speculation
     
     def _step2_search_if_needed(self, query_info: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Bước 2: Tìm kiếm chỉ khi cần (QUESTION)"""
@@ -268,9 +1002,11 @@ class UnifiedRAGService:
         print("Route QUESTION - Thực hiện search")
         enhanced_query = query_info.get("enhanced_query", "")
         
-        return self._search_single_query(enhanced_query)
+        search_results, _ = self._search_single_query(enhanced_query)
+        return search_results
     
-    def _step2_search_with_details(self, query_info: Dict[str, Any], show_details: bool) -> tuple:
+    def _step2_search_with_details(self, query_info: Dict[str, Any], show_details: bool,
+                                   deadline: Optional[RequestDeadline] = None) -> tuple:
         """Bước 2: Tìm kiếm với thông tin chi tiết - KHÔNG GIỚI HẠN TEXT"""
         print("=== BƯỚC 2: TÌM KIẾM NẾU CẦN (WITH DETAILS - UNLIMITED TEXT) ===")
         
@@ -285,187 +1021,586 @@ class UnifiedRAGService:
         print("Route QUESTION - Thực hiện search")
         enhanced_query = query_info.get("enhanced_query", "")
         
-        search_results = self._search_single_query(enhanced_query)
-        
-        # Tạo thông tin chi tiết về chunks - KHÔNG GIỚI HẠN TEXT
-        if show_details and search_results:
-            for i, doc in enumerate(search_results[:10]):  # Top 10 chunks
-                metadata = doc.get('metadata', {})
-                chunk_info = {
-                    "rank": i + 1,
-                    "product_id": metadata.get('product_id'),
-                    "product_name": metadata.get('name'),
-                    "brand": metadata.get('brand'),
-                    "category": metadata.get('category_name'),
-                    "chunk_type": metadata.get('type'),
-                    "chunk_length": len(doc.get('text', '')),
-                    "vector_score": doc.get('vector_score', doc.get('score', 0.0)),
-                    "rerank_score": doc.get('rerank_score'),
-                    "score_improvement": doc.get('rerank_metadata', {}).get('score_improvement', 0.0),
-                    "full_text": doc.get('text', ''),  # TOÀN BỘ TEXT, không giới hạn
-                    "text_limit": "UNLIMITED"
-                }
-                search_details["chunks_info"].append(chunk_info)
+        speculation = query_info.pop("speculative_search", None)
+        if speculation is not None:
+            search_results, query_embedding = self._search_with_speculation(enhanced_query, speculation, deadline)
+        else:
+            search_results, query_embedding = self._search_single_query(enhanced_query, deadline)
+        # Embedding của enhanced query dùng lại cho semantic answer cache ở bước 3
+        query_info["query_embedding"] = query_embedding
+        
+        if show_details:
+            search_details["chunks_info"] = self._build_chunks_info(search_results)
         
         return search_results, search_details
     
-    def _search_single_query(self, query: str) -> List[Dict[str, Any]]:
-        """Tìm kiếm với settings từ env"""
+    def _build_chunks_info(self, search_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Tạo thông tin chi tiết về chunks - KHÔNG GIỚI HẠN TEXT"""
+        chunks_info = []
+        for i, doc in enumerate(search_results[:10]):  # Top 10 chunks
+            metadata = doc.get('metadata', {})
+            chunk_info = {
+                "rank": i + 1,
+                "product_id": metadata.get('product_id'),
+                "product_name": metadata.get('name'),
+                "brand": metadata.get('brand'),
+                "category": metadata.get('category_name'),
+                "chunk_type": metadata.get('type'),
+                "chunk_length": len(doc.get('text', '')),
+                "vector_score": doc.get('vector_score', doc.get('score', 0.0)),
+                "rerank_score": doc.get('rerank_score'),
+                "score_improvement": doc.get('rerank_metadata', {}).get('score_improvement', 0.0),
+                "full_text": doc.get('text', ''),  # TOÀN BỘ TEXT, không giới hạn
+                "text_limit": "UNLIMITED"
+            }
+            chunks_info.append(chunk_info)
+        return chunks_info
+    
+    def _search_single_query(self, query: str,
+                             deadline: Optional[RequestDeadline] = None) -> Tuple[List[Dict[str, Any]], Any]:
+        """Tìm kiếm, các query trùng nhau đang chạy đồng thời dùng chung một lần search + rerank
+        
+        Trả về (kết quả, embedding của query).
+        """
+        search_limit, rerank_candidates = self._plan_search(deadline)
+        use_rerank = bool(self.use_rerank and self.rerank_service) and rerank_candidates != 0
+        key = (clean_query(query), search_limit, settings.RERANK_TOP_K, use_rerank, rerank_candidates)
+        
+        (search_results, query_embedding), shared = self.search_singleflight.do(
+            key, self._search_and_rerank, query, search_limit, rerank_candidates
+        )
+        if shared:
+            print(f"Dùng chung kết quả tìm kiếm đang chạy cho: {query}")
+        
+        # Kết quả dùng chung -> thời gian encode/search/rerank nằm trong trace của request chạy trước
+        trace = current_trace()
+        if trace is not None:
+            trace.set_flag("search_shared", shared)
+        
+        return list(search_results), query_embedding
+    
+    def _search_with_speculation(self, query: str, speculation: SpeculativeSearch,
+                                 deadline: Optional[RequestDeadline] = None) -> Tuple[List[Dict[str, Any]], Any]:
+        """Tìm kiếm dùng lại kết quả speculative (nếu enhanced query gần giống query gốc) rồi rerank"""
+        search_limit, rerank_candidates = self._plan_search(deadline)
+        search_results, query_embedding = self.speculative_retriever.resolve(speculation, query, search_limit)
+        print(f"Semantic search: {len(search_results)} documents")
+        return self._rerank_results(query, search_results, rerank_candidates), query_embedding
+    
+    def _plan_search(self, deadline: Optional[RequestDeadline]) -> Tuple[int, Optional[int]]:
+        """Chọn số kết quả search và số ứng viên rerank theo thời gian còn lại
+        
+        Trả về (search_limit, rerank_candidates): rerank_candidates None = rerank toàn bộ, 0 = bỏ qua rerank.
+        """
+        search_limit = settings.SEMANTIC_SEARCH_LIMIT
+        rerank_candidates = None
+        if deadline is None:
+            return search_limit, rerank_candidates
+        
+        if deadline.should_degrade(DEGRADE_SHRINK_SEARCH):
+            search_limit = min(search_limit, settings.DEGRADED_SEARCH_LIMIT)
+        if deadline.should_degrade(DEGRADE_SKIP_RERANK):
+            rerank_candidates = 0
+        elif deadline.should_degrade(DEGRADE_SHORTEN_RERANK):
+            rerank_candidates = settings.DEGRADED_RERANK_CANDIDATES
+        
+        return search_limit, rerank_candidates
+    
+    def _llm_timeout(self, deadline: Optional[RequestDeadline]) -> float:
+        """Timeout của lời gọi LLM: LLM_TIMEOUT, rút ngắn theo thời gian còn lại của request"""
+        if deadline is None:
+            return settings.LLM_TIMEOUT
+        return deadline.call_timeout(settings.LLM_TIMEOUT)
+    
+    def _plan_context_top_k(self, deadline: Optional[RequestDeadline]) -> int:
+        """Số documents đưa vào context theo thời gian còn lại"""
+        if deadline is not None and deadline.should_degrade(DEGRADE_TRIM_CONTEXT):
+            return min(settings.CONTEXT_TOP_K, settings.DEGRADED_CONTEXT_TOP_K)
+        return settings.CONTEXT_TOP_K
+    
+    def _search_and_rerank(self, query: str, search_limit: int = None,
+                           rerank_candidates: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Any]:
+        """Tìm kiếm với settings từ env (hoặc giới hạn đã giảm theo deadline), trả về kèm embedding của query"""
         print(f"Tìm kiếm: {query}")
         
         # Semantic search với limit từ settings
-        search_results = self.qdrant_service.search_similar(
-            query=query,
-            limit=settings.SEMANTIC_SEARCH_LIMIT,
-            filters=None
-        )
+        with self.stage_limiter.acquire("encoder"):
+            search_results, query_embedding = self.qdrant_service.search_similar_with_embedding(
+                query,
+                limit=search_limit or settings.SEMANTIC_SEARCH_LIMIT
+            )
         
         print(f"Semantic search: {len(search_results)} documents")
         
-        # Rerank với top_k từ settings
-        if self.use_rerank and self.rerank_service and search_results:
+        return self._rerank_results(query, search_results, rerank_candidates), query_embedding
+    
+    def _rerank_results(self, query: str, search_results: List[Dict[str, Any]],
+                        rerank_candidates: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Rerank kết quả search với top_k từ settings"""
+        if self.use_rerank and self.rerank_service and search_results and rerank_candidates != 0:
             print(f"Áp dụng reranking...")
             
+            # Deadline sắp hết -> chỉ rerank các kết quả đầu
+            candidates = search_results if rerank_candidates is None else search_results[:rerank_candidates]
+            
             try:
-                reranked_results = self.rerank_service.enhance_search_results(
-                    query=query,
-                    search_results=search_results,
-                    top_k=settings.RERANK_TOP_K,
-                    use_batch=True
-                )
+                with self.stage_limiter.acquire("reranker"), metrics.time_stage("rerank"):
+                    reranked_results = self.rerank_service.enhance_search_results(
+                        query=query,
+                        search_results=candidates,
+                        top_k=settings.RERANK_TOP_K,
+                        use_batch=True
+                    )
                 
                 print(f"Reranking hoàn thành: {len(reranked_results)} documents")
                 return reranked_results
+            except StageSaturated:
+                raise
             except Exception as e:
                 print(f"Lỗi reranking: {e}")
+                metrics.record_error("rerank")
+                metrics.record_fallback("rerank_skipped")
                 return search_results[:settings.RERANK_TOP_K]
         
         # Không có reranker - trả về theo RERANK_TOP_K
         return search_results[:settings.RERANK_TOP_K]
     
-    def _step3_generate_response(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]]) -> str:
-        """Bước 3: Tạo response - KHÔNG GIỚI HẠN TEXT"""
-        print("=== BƯỚC 3: TẠO RESPONSE (UNLIMITED TEXT) ===")
-        
+    def _prepare_generation_inputs(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                                   memory: ConversationMemoryManager, context_top_k: int = None) -> tuple:
+        """Chuẩn bị context và lịch sử hội thoại cho bước tạo response"""
+        context_top_k = context_top_k or settings.CONTEXT_TOP_K
         route = query_info.get("route", "QUESTION")
         
         # Tạo context
         if route == "GREETING":
-            context = ""
-        else:
-            # QUESTION - Tạo context từ search results với CONTEXT_TOP_K từ settings
-            context = ContextBuilder.build_context_smart(search_results[:settings.CONTEXT_TOP_K], "QUESTION")
+            # Lịch sử từ buffer window - KHÔNG GIỚI HẠN
+            return "", memory.get_formatted_history()
+        
+        # QUESTION - Tạo context từ search results với CONTEXT_TOP_K từ settings
+        with metrics.time_stage("context_build"):
+            context_parts = ContextBuilder.build_product_parts(search_results[:context_top_k])
+        history_turns = memory.get_history_turns()
+        
+        # Cắt context / lịch sử cho vừa token budget của prompt
+        with metrics.time_stage("prompt_budget"):
+            context_parts, history_turns, budget_report = self.prompt_budgeter.fit(
+                query_info.get("enhanced_query", ""), context_parts, history_turns
+            )
+        self._record_prompt_budget(query_info, budget_report)
+        
+        return ContextBuilder.join_product_parts(context_parts), format_history_turns(history_turns)
+    
+    def _record_prompt_budget(self, query_info: Dict[str, Any], budget_report: Dict[str, Any]):
+        """Lưu số token của prompt vào query_info (context_info), trace và metrics"""
+        query_info["prompt_budget"] = budget_report
+        metrics.record_prompt_budget("question", budget_report)
+        if budget_report["truncated"]:
+            print(f"Prompt vượt token budget - dùng {budget_report['documents_used']} documents, "
+                  f"{budget_report['history_turns_used']} lượt lịch sử ({budget_report['total']} tokens)")
         
-        # Lịch sử từ buffer window - KHÔNG GIỚI HẠN
-        chat_history = self.memory_manager.get_formatted_history()
+        trace = current_trace()
+        if trace is not None:
+            trace.set_flag("prompt_tokens", budget_report["total"])
+            trace.set_flag("prompt_truncated", budget_report["truncated"])
+    
+    def _search_batch_queries(self, queries: List[str]) -> List[List[Dict[str, Any]]]:
+        """Tìm kiếm cho nhiều query: encode chung, Qdrant search_batch và rerank trong batch dùng chung"""
+        print(f"Tìm kiếm batch: {len(queries)} queries")
+        
+        with self.stage_limiter.acquire("encoder"):
+            search_results_list = self.qdrant_service.search_similar_batch(
+                queries=queries,
+                limit=settings.SEMANTIC_SEARCH_LIMIT
+            )
+        
+        if self.use_rerank and self.rerank_service and any(search_results_list):
+            try:
+                with self.stage_limiter.acquire("reranker"), metrics.time_stage("rerank_batch"):
+                    return self.rerank_service.enhance_search_results_batch(
+                        queries=queries,
+                        search_results_list=search_results_list,
+                        top_k=settings.RERANK_TOP_K
+                    )
+            except StageSaturated:
+                raise
+            except Exception as e:
+                print(f"Lỗi reranking batch: {e}")
+                metrics.record_error("rerank_batch")
+                metrics.record_fallback("rerank_skipped")
+        
+        return [search_results[:settings.RERANK_TOP_K] for search_results in search_results_list]
+    
+    def _step3_generate_response(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                                 memory: ConversationMemoryManager) -> str:
+        """Bước 3: Tạo response - KHÔNG GIỚI HẠN TEXT"""
+        print("=== BƯỚC 3: TẠO RESPONSE (UNLIMITED TEXT) ===")
+        
+        if query_info.get("fast_path"):
+            return self._answer_fast_path(query_info, memory)
+        
+        route = query_info.get("route", "QUESTION")
+        context, chat_history = self._prepare_generation_inputs(query_info, search_results, memory)
         print(f"Chat history length: {len(chat_history)} characters (UNLIMITED)")
         print(f"Context length: {len(context)} characters (UNLIMITED)")
         
         # Generate response
         try:
-            response = self.response_chain.generate_response(
-                query_info, 
-                context, 
-                chat_history, 
-                route
-            )
+            with self.stage_limiter.acquire("llm"):
+                response = self.response_chain.generate_response(
+                    query_info, 
+                    context, 
+                    chat_history, 
+                    route
+                )
             
             print("Response generated successfully")
             
             # Lưu vào memory
             try:
                 original_query = query_info.get("enhanced_query", "")
-                self.memory_manager.add_conversation_turn(original_query, response)
+                memory.add_conversation_turn(original_query, response, served_product_name(search_results))
             except Exception as e:
                 print(f"Lỗi lưu memory: {e}")
+                metrics.record_error("memory_save")
             
             return response
             
+        except StageSaturated:
+            raise
         except Exception as e:
             print(f"Lỗi generate response: {e}")
+            metrics.record_error("step3_generate_response")
+            metrics.record_fallback("step3_fallback_response")
             # Fallback response
-            if route == "GREETING":
-                return "Xin chào! Tôi có thể giúp gì cho bạn về mỹ phẩm?"
-            else:
-                return "Xin lỗi, tôi không thể trả lời câu hỏi này. Bạn có thể hỏi khác không?"
+            return fallback_response_for(route)
     
-    def _step3_generate_response_with_details(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]], show_details: bool) -> tuple:
-        """Bước 3: Tạo response với thông tin chi ti��t - KHÔNG GIỚI HẠN TEXT"""
+    def _step3_generate_response_with_details(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                                              show_details: bool, memory: ConversationMemoryManager,
+                                              deadline: Optional[RequestDeadline] = None) -> tuple:
+        """Bước 3: Tạo response với thông tin chi tiết - KHÔNG GIỚI HẠN TEXT"""
         print("=== BƯỚC 3: TẠO RESPONSE (WITH DETAILS - UNLIMITED TEXT) ===")
         
+        local_response = self._step3_answer_locally(query_info, search_results, show_details, memory)
+        if local_response is not None:
+            return local_response
+        
         route = query_info.get("route", "QUESTION")
-        context_details = {}
+        context, chat_history, context_details = self._step3_prepare_context(
+            query_info, search_results, show_details, memory, deadline
+        )
         
-        # Tạo context
-        if route == "GREETING":
-            context = ""
-        else:
-            # QUESTION - Tạo context từ search results với CONTEXT_TOP_K từ settings
-            context = ContextBuilder.build_context_smart(search_results[:settings.CONTEXT_TOP_K], "QUESTION")
+        # Generate response
+        try:
+            with self.stage_limiter.acquire("llm"):
+                response = self.response_chain.generate_response(
+                    query_info, 
+                    context, 
+                    chat_history, 
+                    route,
+                    self._llm_timeout(deadline)
+                )
+            
+            self._step3_save_response(query_info, search_results, route, response, memory, deadline)
+            return response, context_details
+            
+        except StageSaturated:
+            raise
+        except Exception as e:
+            return self._step3_fallback_response(route, e, show_details, context_details)
+    
+    async def _astep3_generate_response_with_details(self, query_info: Dict[str, Any],
+                                                     search_results: List[Dict[str, Any]],
+                                                     show_details: bool, memory: ConversationMemoryManager,
+                                                     deadline: Optional[RequestDeadline] = None) -> tuple:
+        """Bản async của bước 3: phần CPU chạy trong executor, chờ Gemini trên event loop"""
+        print("=== BƯỚC 3: TẠO RESPONSE (ASYNC) ===")
+        
+        local_response = await self._run_blocking(
+            self._step3_answer_locally, query_info, search_results, show_details, memory
+        )
+        if local_response is not None:
+            return local_response
+        
+        route = query_info.get("route", "QUESTION")
+        context, chat_history, context_details = await self._run_blocking(
+            self._step3_prepare_context, query_info, search_results, show_details, memory, deadline
+        )
         
-        # Lịch sử từ buffer window - KHÔNG GIỚI HẠN
-        chat_history = self.memory_manager.get_formatted_history()
+        try:
+            async with self.stage_limiter.aacquire("llm"):
+                response = await self.response_chain.agenerate_response(
+                    query_info, context, chat_history, route, self._llm_timeout(deadline)
+                )
+            
+            await self._run_blocking(
+                self._step3_save_response, query_info, search_results, route, response, memory, deadline
+            )
+            return response, context_details
+            
+        except StageSaturated:
+            raise
+        except Exception as e:
+            return self._step3_fallback_response(route, e, show_details, context_details)
+    
+    def _step3_answer_locally(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                              show_details: bool, memory: ConversationMemoryManager) -> Optional[tuple]:
+        """Trả lời không cần LLM (template fast path / semantic cache), None nếu phải gọi LLM"""
+        route = query_info.get("route", "QUESTION")
+        if query_info.get("fast_path"):
+            response = self._answer_fast_path(query_info, memory)
+            context_details = {}
+            if show_details:
+                context_details = {
+                    "route": route,
+                    "answer_source": "template",
+                    "fast_path_intent": query_info["fast_path"]
+                }
+            return response, context_details
+        
+        # Câu hỏi tra cứu giá / link / đánh giá / phiên bản của sản phẩm top -> trả lời từ metadata
+        structured_answer = self._lookup_structured_answer(query_info, search_results, route)
+        if structured_answer is not None:
+            response = self._answer_structured(query_info, structured_answer, memory)
+            context_details = {}
+            if show_details:
+                context_details = {
+                    "route": route,
+                    "answer_source": "structured",
+                    "lookups": structured_answer["lookups"],
+                    "product_id": structured_answer["product_id"],
+                    "name_coverage": structured_answer["name_coverage"]
+                }
+            return response, context_details
+        
+        # Câu hỏi gần giống câu đã trả lời, cùng sản phẩm top -> dùng lại câu trả lời, không gọi LLM
+        cached_answer = self._lookup_cached_answer(query_info, search_results, route, memory)
+        if cached_answer is not None:
+            response = self._answer_from_cache(query_info, cached_answer, search_results, memory)
+            context_details = {}
+            if show_details:
+                context_details = {
+                    "route": route,
+                    "answer_source": "semantic_cache",
+                    "cached_query": cached_answer["query"],
+                    "cache_similarity": cached_answer["similarity"]
+                }
+            return response, context_details
+        
+        return None
+    
+    def _step3_prepare_context(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                               show_details: bool, memory: ConversationMemoryManager,
+                               deadline: Optional[RequestDeadline]) -> Tuple[str, str, Dict[str, Any]]:
+        """Chuẩn bị context, chat history và thông tin chi tiết cho lời gọi LLM của bước 3"""
+        route = query_info.get("route", "QUESTION")
+        context_details = {}
+        context_top_k = self._plan_context_top_k(deadline)
+        context, chat_history = self._prepare_generation_inputs(query_info, search_results, memory, context_top_k)
         
         # Thông tin chi tiết về context - KHÔNG GIỚI HẠN TEXT
         if show_details:
             context_details = {
                 "context_length": len(context),
                 "chat_history_length": len(chat_history),
-                "documents_used_for_context": min(len(search_results), settings.CONTEXT_TOP_K),
+                "documents_used_for_context": query_info.get("prompt_budget", {}).get(
+                    "documents_used", min(len(search_results), context_top_k)
+                ),
                 "context_full": context,  # TOÀN BỘ CONTEXT, không giới hạn
                 "chat_history_full": chat_history,  # TOÀN BỘ CHAT HISTORY, không giới hạn
                 "route": route,
-                "llm_model": "gemini-2.5-flash",
+                "llm_model": settings.LLM_MODEL,
                 "llm_temperature": settings.LLM_TEMPERATURE,
                 "llm_timeout": settings.LLM_TIMEOUT,
-                "text_limit": "UNLIMITED"
+                "text_limit": f"{settings.PROMPT_TOKEN_BUDGET} tokens" if self.prompt_budgeter.enabled else "UNLIMITED",
+                "prompt_budget": query_info.get("prompt_budget")
             }
         
         print(f"Chat history length: {len(chat_history)} characters (UNLIMITED)")
         print(f"Context length: {len(context)} characters (UNLIMITED)")
+        return context, chat_history, context_details
+    
+    def _step3_save_response(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                             route: str, response: str, memory: ConversationMemoryManager,
+                             deadline: Optional[RequestDeadline]):
+        """Lưu câu trả lời của LLM vào answer cache và memory"""
+        print("Response generated successfully")
+        self._store_cached_answer(query_info, search_results, route, response, memory, deadline)
+        
+        # Lưu vào memory
+        try:
+            original_query = query_info.get("enhanced_query", "")
+            memory.add_conversation_turn(original_query, response, served_product_name(search_results))
+        except Exception as e:
+            print(f"Lỗi lưu memory: {e}")
+            metrics.record_error("memory_save")
+    
+    def _step3_fallback_response(self, route: str, error: Exception, show_details: bool,
+                                 context_details: Dict[str, Any]) -> tuple:
+        """Câu trả lời mặc định khi gọi LLM ở bước 3 bị lỗi hoặc hết thời gian (TimeoutError)"""
+        print(f"Lỗi generate response: {error!r}")
+        metrics.record_error("step3_generate_response")
+        metrics.record_fallback("step3_fallback_response")
+        # Fallback response
+        fallback_response = fallback_response_for(route)
+        
+        if show_details:
+            context_details["error"] = str(error) or type(error).__name__
+            context_details["timeout"] = isinstance(error, TimeoutError)
+            context_details["fallback_used"] = True
+        
+        return fallback_response, context_details
+    
+    def _render_fast_path_response(self, query_info: Dict[str, Any], memory: ConversationMemoryManager) -> str:
+        """Chọn câu mẫu cho intent của fast path, cá nhân hóa theo entities trong memory"""
+        with metrics.time_stage("greeting_fast_path"):
+            response = self.template_responder.render(query_info["fast_path"], memory.get_memory_entities())
+        metrics.record_fast_path(query_info["fast_path"])
+        return response
+    
+    def _answer_fast_path(self, query_info: Dict[str, Any], memory: ConversationMemoryManager) -> str:
+        """Bước 3 của fast path: trả lời bằng template và lưu lượt hội thoại vào memory"""
+        response = self._render_fast_path_response(query_info, memory)
         
-        # Generate response
         try:
-            response = self.response_chain.generate_response(
-                query_info, 
-                context, 
-                chat_history, 
-                route
+            memory.add_conversation_turn(query_info.get("enhanced_query", ""), response)
+        except Exception as e:
+            print(f"Lỗi lưu memory: {e}")
+            metrics.record_error("memory_save")
+        
+        return response
+    
+    def _lookup_structured_answer(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                                  route: str) -> Optional[Dict[str, Any]]:
+        """Câu trả lời dựng từ metadata của sản phẩm top cho câu hỏi tra cứu, None nếu cần LLM"""
+        if not settings.STRUCTURED_ANSWER_ENABLED or route != "QUESTION":
+            return None
+        
+        with metrics.time_stage("structured_answer"):
+            structured_answer = self.structured_answerer.answer(
+                query_info.get("enhanced_query") or query_info.get("original_query", ""), search_results
+            )
+        
+        trace = current_trace()
+        if trace is not None:
+            trace.set_flag("structured_answer", "hit" if structured_answer else "miss")
+        return structured_answer
+    
+    def _answer_structured(self, query_info: Dict[str, Any], structured_answer: Dict[str, Any],
+                           memory: ConversationMemoryManager) -> str:
+        """Bước 3 của câu hỏi tra cứu: trả lời từ metadata và lưu lượt hội thoại vào memory"""
+        print(f"Trả lời tra cứu {structured_answer['lookups']} từ metadata của: {structured_answer['product_name']}")
+        for lookup in structured_answer["lookups"]:
+            metrics.record_fast_path(lookup)
+        response = structured_answer["answer"]
+        
+        try:
+            memory.add_conversation_turn(
+                query_info.get("enhanced_query", ""), response, structured_answer["product_name"]
             )
-            
-            print("Response generated successfully")
-            
-            # Lưu vào memory
-            try:
-                original_query = query_info.get("enhanced_query", "")
-                self.memory_manager.add_conversation_turn(original_query, response)
-            except Exception as e:
-                print(f"Lỗi lưu memory: {e}")
-            
-            return response, context_details
-            
         except Exception as e:
-            print(f"Lỗi generate response: {e}")
-            # Fallback response
-            if route == "GREETING":
-                fallback_response = "Xin chào! Tôi có thể giúp gì cho bạn về mỹ phẩm?"
-            else:
-                fallback_response = "Xin lỗi, tôi không thể trả lời câu hỏi này. Bạn có thể hỏi khác không?"
-            
-            if show_details:
-                context_details["error"] = str(e)
-                context_details["fallback_used"] = True
-            
-            return fallback_response, context_details
+            print(f"Lỗi lưu memory: {e}")
+            metrics.record_error("memory_save")
+        
+        return response
+    
+    def _answer_cacheable(self, query_info: Dict[str, Any], route: str, memory: ConversationMemoryManager) -> bool:
+        """Câu trả lời chỉ phụ thuộc câu hỏi và sản phẩm top - dùng chung được giữa các session
+        
+        Câu trả lời của lượt đã có lịch sử được tạo kèm chat_history riêng của session (và câu có
+        đại từ trỏ về lượt trước), nên không lưu / không dùng lại cho session khác.
+        """
+        if not self.answer_cache.enabled_for(route):
+            return False
+        if memory.has_history():
+            return False
+        return not has_context_pronoun(query_info.get("original_query") or query_info.get("enhanced_query", ""))
+    
+    def _lookup_cached_answer(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                              route: str, memory: ConversationMemoryManager) -> Optional[Dict[str, Any]]:
+        """Tìm câu trả lời đã cache theo embedding của enhanced query và sản phẩm top (chỉ lượt đầu)"""
+        if not self._answer_cacheable(query_info, route, memory):
+            return None
+        
+        with metrics.time_stage("answer_cache_lookup"):
+            cached_answer = self.answer_cache.lookup(query_info.get("query_embedding"), search_results, route)
+        
+        trace = current_trace()
+        if trace is not None:
+            trace.set_flag("answer_cache", "hit" if cached_answer else "miss")
+        return cached_answer
+    
+    def _store_cached_answer(self, query_info: Dict[str, Any], search_results: List[Dict[str, Any]],
+                             route: str, response: str, memory: ConversationMemoryManager,
+                             deadline: Optional[RequestDeadline] = None):
+        """Lưu câu trả lời của LLM vào cache (bỏ qua câu trả lời tạo với context đã giảm theo deadline)
+        
+        Chỉ gọi với câu trả lời LLM tạo trọn vẹn - lỗi / timeout của response chain được raise và
+        đi qua fallback, không tới đây. Phải gọi trước khi lượt này được lưu vào memory.
+        """
+        if deadline is not None and deadline.degradations:
+            return
+        if not self._answer_cacheable(query_info, route, memory):
+            return
+        self.answer_cache.store(
+            query_info.get("enhanced_query", ""), query_info.get("query_embedding"), search_results, route, response
+        )
     
-    def get_conversation_summary(self) -> str:
-        """Lấy tóm tắt cuộc hội thoại"""
-        return self.memory_manager.get_conversation_summary()
+    def _answer_from_cache(self, query_info: Dict[str, Any], cached_answer: Dict[str, Any],
+                           search_results: List[Dict[str, Any]], memory: ConversationMemoryManager) -> str:
+        """Bước 3 khi trúng cache: dùng lại câu trả lời và lưu lượt hội thoại vào memory"""
+        print(f"Dùng lại câu trả lời đã cache của: {cached_answer['query']} (similarity {cached_answer['similarity']})")
+        response = cached_answer["answer"]
+        
+        try:
+            memory.add_conversation_turn(
+                query_info.get("enhanced_query", ""), response, served_product_name(search_results)
+            )
+        except Exception as e:
+            print(f"Lỗi lưu memory: {e}")
+            metrics.record_error("memory_save")
+        
+        return response
+    
+    def invalidate_answer_cache(self) -> int:
+        """Xóa semantic answer cache (vd. ngay sau khi index lại catalog)"""
+        return self.answer_cache.invalidate("manual")
+    
+    def get_conversation_summary(self, session_id: str = "default") -> str:
+        """Lấy tóm tắt cuộc hội thoại của session"""
+        memory = self.memory_store.peek(session_id)
+        if memory is None:
+            return NO_HISTORY_SUMMARY
+        return memory.get_conversation_summary()
+    
+    def clear_memory(self, session_id: str = "default"):
+        """Xóa memory của session"""
+        self.memory_store.clear(session_id)
+    
+    def get_memory_stats(self, session_id: str = "default") -> Dict[str, Any]:
+        """Lấy thống kê về memory của session"""
+        memory = self.memory_store.peek(session_id)
+        if memory is None:
+            return {
+                "total_messages": 0,
+                "total_characters": 0,
+                "window_size": settings.CONVERSATION_MEMORY_K,
+                "memory_type": "ConversationBufferWindowMemory"
+            }
+        return memory.get_memory_stats()
     
-    def clear_memory(self):
-        """Xóa memory"""
-        self.memory_manager.clear_memory()
+    def get_session_store_stats(self) -> Dict[str, Any]:
+        """Lấy thống kê của session memory store"""
+        return self.memory_store.get_stats()
     
-    def get_memory_stats(self) -> Dict[str, Any]:
-        """Lấy thống kê về memory"""
-        return self.memory_manager.get_memory_stats()
\ No newline at end of file
+    def get_runtime_stats(self) -> Dict[str, Any]:
+        """Lấy thống kê runtime của các thành phần trong pipeline"""
+        return {
+            "sessions": self.memory_store.get_stats(),
+            "search_singleflight": self.search_singleflight.get_stats(),
+            "embedding_cache": self.qdrant_service.embedding_cache.get_stats(),
+            "unified_cache": self.unified_processor.get_cache_stats(),
+            "answer_cache": self.answer_cache.get_stats(),
+            "llm_keys": self.llm_backend.get_stats(),
+            "llm_hedge": {chain: llm.get_stats() for chain, llm in self.hedged_llms.items()},
+            "stages": self.stage_limiter.get_stats()
+        }
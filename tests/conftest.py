@@ -0,0 +1,58 @@
+"""Cấu hình chung cho test: chạy offline với LLM giả và model stub
+
+Test không gọi Gemini, Qdrant hay tải model thật: LLM_BACKEND=fake, latency 0. Nếu máy chạy
+test chưa cài sentence_transformers / torch / transformers thì dùng module stub để import được
+các service; test nào cần encoder tự gán encoder giả.
+"""
+
+import importlib
+import os
+import sys
+import types
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+# Phải đặt trước khi import config.settings
+os.environ["LLM_BACKEND"] = "fake"
+os.environ["FAKE_LLM_LATENCY_MS"] = "0"
+os.environ["FAKE_LLM_LATENCY_DISTRIBUTION"] = "fixed"
+os.environ["FAKE_LLM_TOKENS_PER_SECOND"] = "0"
+
+
+def _is_installed(module_name: str) -> bool:
+    try:
+        importlib.import_module(module_name)
+        return True
+    except ImportError:
+        return False
+
+
+def _install_model_stubs():
+    """Module stub cho các thư viện model nặng khi chưa cài - không bao giờ load weights trong test"""
+    if not _is_installed("sentence_transformers"):
+        sentence_transformers = types.ModuleType("sentence_transformers")
+
+        class SentenceTransformer:
+            def __init__(self, model_name, **kwargs):
+                raise RuntimeError("Test không được load embedding model thật")
+
+        sentence_transformers.SentenceTransformer = SentenceTransformer
+        sys.modules["sentence_transformers"] = sentence_transformers
+
+    if not _is_installed("torch"):
+        torch = types.ModuleType("torch")
+        torch.cuda = types.SimpleNamespace(is_available=lambda: False)
+        torch.device = lambda name: name
+        torch.set_num_threads = lambda num_threads: None
+        sys.modules["torch"] = torch
+
+    if not _is_installed("transformers"):
+        transformers = types.ModuleType("transformers")
+        transformers.AutoTokenizer = None
+        transformers.AutoModelForSequenceClassification = None
+        sys.modules["transformers"] = transformers
+
+
+_install_model_stubs()
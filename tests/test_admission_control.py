@@ -0,0 +1,133 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+from services.admission_control import AdmissionController, AdmissionRejected, StageLimiter, StageSaturated
+
+
+def _controller(max_concurrent=1, max_queue=1, queue_timeout=0.1):
+    return AdmissionController(max_concurrent=max_concurrent, max_queue=max_queue,
+                               queue_timeout=queue_timeout, retry_after=3)
+
+
+def test_full_queue_is_rejected_immediately_with_429():
+    async def scenario():
+        admission = _controller(max_concurrent=1, max_queue=1, queue_timeout=5)
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire()
+
+        admission.release()
+        await waiter
+        admission.release()
+        return admission, rejected.value
+
+    admission, error = asyncio.run(scenario())
+
+    assert error.status_code == 429
+    assert error.retry_after == 3
+    stats = admission.get_stats()
+    assert stats["rejected_queue_full"] == 1
+    assert stats["admitted"] == 2
+    assert stats["in_flight"] == 0
+
+
+def test_queued_request_past_queue_timeout_is_rejected_with_503():
+    async def scenario():
+        admission = _controller(max_concurrent=1, max_queue=4, queue_timeout=0.05)
+        await admission.acquire()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire()
+        return admission, rejected.value
+
+    admission, error = asyncio.run(scenario())
+
+    assert error.status_code == 503
+    assert error.retry_after == 3
+    stats = admission.get_stats()
+    assert stats["rejected_deadline"] == 1
+    assert stats["queue_depth"] == 0
+
+
+def test_queued_request_runs_when_slot_is_released():
+    async def scenario():
+        admission = _controller(max_concurrent=1, max_queue=1, queue_timeout=1)
+        order = []
+
+        async def handle(name, hold):
+            async with admission.slot():
+                order.append(name)
+                await asyncio.sleep(hold)
+
+        await asyncio.gather(handle("first", 0.05), handle("second", 0))
+        return admission, order
+
+    admission, order = asyncio.run(scenario())
+
+    assert order == ["first", "second"]
+    assert admission.get_stats()["in_flight"] == 0
+
+
+def test_stage_limiter_rejects_with_503_when_stage_is_saturated():
+    limiter = StageLimiter({"reranker": 1}, acquire_timeout=0.05, retry_after=2)
+    holding = threading.Event()
+    done = threading.Event()
+
+    def hold_slot():
+        with limiter.acquire("reranker"):
+            holding.set()
+            done.wait(timeout=5)
+
+    thread = threading.Thread(target=hold_slot)
+    thread.start()
+    holding.wait(timeout=5)
+    try:
+        with pytest.raises(StageSaturated) as rejected:
+            with limiter.acquire("reranker"):
+                pass
+    finally:
+        done.set()
+        thread.join(timeout=5)
+
+    assert rejected.value.status_code == 503
+    assert rejected.value.stage == "reranker"
+    assert limiter.get_stats()["reranker"] == {"limit": 1, "active": 0, "waiting": 0, "rejected": 1}
+
+
+def test_async_stage_limiter_rejects_with_503_when_stage_is_saturated():
+    async def scenario():
+        limiter = StageLimiter({"llm": 1}, acquire_timeout=0.05, retry_after=2)
+        async with limiter.aacquire("llm"):
+            with pytest.raises(StageSaturated) as rejected:
+                async with limiter.aacquire("llm"):
+                    pass
+        return rejected.value
+
+    assert asyncio.run(scenario()).status_code == 503
+
+
+@pytest.mark.parametrize("status_code", [429, 503])
+def test_api_maps_rejection_to_status_with_retry_after(monkeypatch, status_code):
+    import api_modular
+
+    class RejectingAdmission:
+        @asynccontextmanager
+        async def slot(self):
+            raise AdmissionRejected(status_code, "Quá tải", 7)
+            yield
+
+    monkeypatch.setattr(api_modular, "rag_service", object())
+    monkeypatch.setattr(api_modular, "admission", RejectingAdmission())
+
+    # Không dùng "with TestClient(...)" để bỏ qua lifespan (không khởi tạo service thật)
+    response = TestClient(api_modular.app).post("/chat", json={"message": "kem chống nắng"})
+
+    assert response.status_code == status_code
+    assert response.headers["Retry-After"] == "7"
+    assert response.json() == {"success": False, "detail": "Quá tải"}
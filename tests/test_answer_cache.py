@@ -0,0 +1,91 @@
+import numpy as np
+
+from services.answer_cache import SemanticAnswerCache
+from services.fake_llm import FakeChatModel, LatencyModel
+from services.langchain.memory.conversation_memory import ConversationMemoryManager
+from services.unified_rag_service import QUESTION_FALLBACK_RESPONSE, UnifiedRAGService
+
+SEARCH_RESULTS = [{"metadata": {"product_id": "1", "name": "Kem Chống Nắng Anessa"}},
+                  {"metadata": {"product_id": "2", "name": "Kem Chống Nắng Biore"}}]
+EMBEDDING = np.array([1.0, 0.0, 0.0])
+
+
+def _cache():
+    return SemanticAnswerCache(max_entries=10, ttl_seconds=60, similarity_threshold=0.9, product_match_top_k=2,
+                               excluded_answers=[QUESTION_FALLBACK_RESPONSE])
+
+
+def _memory():
+    latency = LatencyModel(distribution="fixed", median_ms=0, tokens_per_second=0)
+    return ConversationMemoryManager(FakeChatModel(latency=latency))
+
+
+def _service():
+    # Chỉ dùng phần answer cache của service - không khởi tạo Qdrant / model / LLM
+    service = UnifiedRAGService.__new__(UnifiedRAGService)
+    service.answer_cache = _cache()
+    return service
+
+
+def _query_info(query):
+    return {"original_query": query, "enhanced_query": query, "route": "QUESTION", "query_embedding": EMBEDDING}
+
+
+def test_similar_query_with_same_top_products_reuses_answer():
+    cache = _cache()
+    cache.store("kem chống nắng cho da dầu", EMBEDDING, SEARCH_RESULTS, "QUESTION", "Bạn thử Anessa nhé")
+
+    hit = cache.lookup(np.array([0.98, 0.1, 0.0]), SEARCH_RESULTS, "QUESTION")
+
+    assert hit["answer"] == "Bạn thử Anessa nhé"
+    assert cache.lookup(np.array([0.5, 0.8, 0.0]), SEARCH_RESULTS, "QUESTION") is None
+    assert cache.lookup(EMBEDDING, SEARCH_RESULTS[::-1][:1], "QUESTION") is None
+
+
+def test_fallback_answer_is_never_stored():
+    cache = _cache()
+
+    cache.store("kem", EMBEDDING, SEARCH_RESULTS, "QUESTION", QUESTION_FALLBACK_RESPONSE)
+
+    assert cache.get_stats()["size"] == 0
+
+
+def test_first_turn_answer_is_stored_and_served_to_other_sessions():
+    service = _service()
+    query_info = _query_info("kem chống nắng cho da dầu")
+
+    service._store_cached_answer(query_info, SEARCH_RESULTS, "QUESTION", "Bạn thử Anessa nhé", _memory())
+    hit = service._lookup_cached_answer(query_info, SEARCH_RESULTS, "QUESTION", _memory())
+
+    assert hit["answer"] == "Bạn thử Anessa nhé"
+
+
+def test_answer_generated_with_history_is_not_stored():
+    service = _service()
+    memory = _memory()
+    memory.add_conversation_turn("da mình là da dầu mụn", "Bạn nên chọn sản phẩm kiềm dầu")
+
+    service._store_cached_answer(_query_info("kem chống nắng nào tốt"), SEARCH_RESULTS, "QUESTION",
+                                 "Với da dầu mụn của bạn, Anessa phù hợp", memory)
+
+    assert service.answer_cache.get_stats()["size"] == 0
+
+
+def test_session_with_history_does_not_reuse_shared_answers():
+    service = _service()
+    query_info = _query_info("kem chống nắng nào tốt")
+    service._store_cached_answer(query_info, SEARCH_RESULTS, "QUESTION", "Bạn thử Anessa nhé", _memory())
+    memory = _memory()
+    memory.add_conversation_turn("da mình là da khô", "Bạn nên chọn sản phẩm dưỡng ẩm")
+
+    assert service._lookup_cached_answer(query_info, SEARCH_RESULTS, "QUESTION", memory) is None
+
+
+def test_query_with_context_pronoun_bypasses_cache():
+    service = _service()
+    query_info = _query_info("sản phẩm này có tốt không")
+
+    service._store_cached_answer(query_info, SEARCH_RESULTS, "QUESTION", "Anessa rất tốt", _memory())
+
+    assert service.answer_cache.get_stats()["size"] == 0
+    assert service._lookup_cached_answer(query_info, SEARCH_RESULTS, "QUESTION", _memory()) is None
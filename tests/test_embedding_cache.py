@@ -0,0 +1,104 @@
+from typing import List
+
+import numpy as np
+import pytest
+
+from services.embedding_cache import EmbeddingCache
+from services.qdrant_service import QdrantService
+
+
+class FakeEncoder:
+    """Encoder giả: vector theo hash của text, ghi lại các text đã encode"""
+
+    def __init__(self):
+        self.encoded: List[str] = []
+
+    def encode(self, texts, **kwargs):
+        self.encoded.extend(texts)
+        return np.array([np.random.default_rng(abs(hash(text)) % (2 ** 32)).standard_normal(8) for text in texts])
+
+
+def _qdrant_service(max_entries=100):
+    # Không kết nối Qdrant / load model: chỉ dùng phần encode của service
+    service = QdrantService.__new__(QdrantService)
+    service.embedding_model = FakeEncoder()
+    service.embedding_cache = EmbeddingCache(max_entries=max_entries)
+    return service
+
+
+def test_least_recently_used_embedding_is_evicted():
+    cache = EmbeddingCache(max_entries=2)
+    cache.set("a", np.ones(4))
+    cache.set("b", np.ones(4))
+    cache.get("a")
+
+    cache.set("c", np.ones(4))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    stats = cache.get_stats()
+    assert stats["size"] == 2
+    assert stats["evicted_lru"] == 1
+    assert stats["bytes"] == 2 * 4 * 4
+
+
+def test_stored_embedding_is_read_only_float32_copy():
+    cache = EmbeddingCache(max_entries=2)
+    original = np.ones(4, dtype=np.float64)
+
+    stored = cache.set("a", original)
+    original[0] = 5
+
+    assert stored.dtype == np.float32
+    assert stored[0] == 1
+    with pytest.raises(ValueError):
+        stored[0] = 2
+
+
+def test_disabled_cache_never_stores():
+    cache = EmbeddingCache(max_entries=0)
+
+    cache.set("a", np.ones(4))
+
+    assert cache.get("a") is None
+    assert cache.get_stats()["size"] == 0
+
+
+def test_whitespace_variants_share_one_encoding():
+    service = _qdrant_service()
+
+    first = service.encode_query("Kem  chống nắng Anessa")
+    second = service.encode_query(" Kem chống nắng Anessa ")
+
+    assert service.embedding_model.encoded == ["Kem chống nắng Anessa"]
+    assert np.array_equal(first, second)
+
+
+def test_encoder_receives_case_and_punctuation_preserved_text():
+    service = _qdrant_service()
+
+    service.encode_query("Serum CeraVe?")
+    service.encode_query("serum cerave")
+
+    assert service.embedding_model.encoded == ["Serum CeraVe?", "serum cerave"]
+
+
+def test_encoder_receives_query_text_when_cache_is_disabled():
+    service = _qdrant_service(max_entries=0)
+
+    service.encode_query("Kem La Roche-Posay!")
+    service.encode_query("Kem La Roche-Posay!")
+
+    assert service.embedding_model.encoded == ["Kem La Roche-Posay!", "Kem La Roche-Posay!"]
+
+
+def test_batch_encoding_only_encodes_missing_queries_once():
+    service = _qdrant_service()
+    service.encode_query("Sữa rửa mặt")
+
+    embeddings = service.encode_queries(["Sữa rửa mặt", "Toner", "Toner ", "Kem dưỡng"])
+
+    assert service.embedding_model.encoded == ["Sữa rửa mặt", "Toner", "Kem dưỡng"]
+    assert embeddings.shape == (4, 8)
+    assert np.array_equal(embeddings[1], embeddings[2])
+    assert np.array_equal(embeddings[0], service.encode_query("Sữa rửa mặt"))
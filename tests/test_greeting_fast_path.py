@@ -0,0 +1,106 @@
+import pytest
+
+from services.fake_llm import FakeChatModel, LatencyModel
+from services.greeting_fast_path import (
+    INTENT_GOODBYE, INTENT_GREETING, INTENT_THANKS, LocalIntentClassifier, TemplateResponder
+)
+from services.langchain.memory.conversation_memory import ConversationMemoryManager
+from services.unified_rag_service import served_product_name
+
+PRODUCT_NAME = "Sữa Chống Nắng Anessa Dưỡng Da Kiềm Dầu 60ml"
+
+# Câu trả lời thật của bot: nhiều dòng có thương hiệu + giá -> recent_products giữ nguyên văn các dòng này
+PRODUCT_ANSWER = (
+    "Dạ, với da dầu bạn có thể tham khảo:\n"
+    f"1. **{PRODUCT_NAME}** - Giá: 450.000 VND, kiềm dầu tốt và chống nước.\n"
+    "Anessa phù hợp khi đi biển, bạn nhớ thoa lại sau 2 giờ nhé!\n"
+    "👉 [Xem chi tiết](https://hasaki.vn/san-pham/anessa-60ml.html)"
+)
+
+
+def _memory():
+    latency = LatencyModel(distribution="fixed", median_ms=0, tokens_per_second=0)
+    return ConversationMemoryManager(FakeChatModel(latency=latency))
+
+
+def _responder():
+    return TemplateResponder({
+        INTENT_GREETING: ["Chào bạn! {suggestion}"],
+        INTENT_THANKS: ["Không có gì ạ! {suggestion}"],
+        INTENT_GOODBYE: ["Tạm biệt bạn!"]
+    })
+
+
+@pytest.mark.parametrize("query, intent", [
+    ("Xin chào shop", INTENT_GREETING),
+    ("cảm ơn bạn nhiều nhé!", INTENT_THANKS),
+    ("bye", INTENT_GOODBYE),
+])
+def test_obvious_greetings_are_classified_locally(query, intent):
+    assert LocalIntentClassifier().classify(query)["intent"] == intent
+
+
+@pytest.mark.parametrize("query", [
+    "chào shop, kem chống nắng nào tốt cho da dầu?",
+    "history của sản phẩm",
+    "hiện tại shop có serum không",
+])
+def test_greeting_mixed_with_content_or_substrings_is_left_to_llm(query):
+    assert LocalIntentClassifier().classify(query) is None
+
+
+def test_template_after_product_turn_uses_clean_product_name():
+    memory = _memory()
+    search_results = [{"metadata": {"name": PRODUCT_NAME, "brand": "Anessa"}}]
+    memory.add_conversation_turn("kem chống nắng cho da dầu", PRODUCT_ANSWER, served_product_name(search_results))
+
+    response = _responder().render(INTENT_THANKS, memory.get_memory_entities())
+
+    assert response == f"Không có gì ạ! Bạn có muốn tìm hiểu thêm về {PRODUCT_NAME} không?"
+    # Dòng nguyên văn của câu trả lời vẫn nằm trong recent_products nhưng không được chèn vào câu mẫu
+    assert memory.get_memory_entities()["recent_products"]
+    assert "**" not in response and "VND" not in response
+
+
+def test_latest_served_product_wins():
+    memory = _memory()
+    memory.add_conversation_turn("kem chống nắng", PRODUCT_ANSWER, PRODUCT_NAME)
+    memory.add_conversation_turn("sữa rửa mặt", "Bạn thử Cetaphil nhé", "Sữa Rửa Mặt Cetaphil 500ml")
+
+    response = _responder().render(INTENT_GREETING, memory.get_memory_entities())
+
+    assert response == "Chào bạn! Bạn có muốn tìm hiểu thêm về Sữa Rửa Mặt Cetaphil 500ml không?"
+
+
+def test_template_falls_back_to_brand_then_category_without_served_product():
+    memory = _memory()
+    memory.add_conversation_turn("kem chống nắng Anessa", PRODUCT_ANSWER)
+
+    response = _responder().render(INTENT_GREETING, memory.get_memory_entities())
+    assert response == "Chào bạn! Bạn có muốn xem thêm sản phẩm của Anessa không?"
+
+    memory = _memory()
+    memory.add_conversation_turn("tư vấn serum", "Bạn cho mình biết loại da nhé")
+    response = _responder().render(INTENT_GREETING, memory.get_memory_entities())
+    assert response == "Chào bạn! Bạn có muốn mình tư vấn thêm về serum không?"
+
+
+def test_template_without_history_uses_generic_suggestion():
+    response = _responder().render(INTENT_GREETING, _memory().get_memory_entities())
+
+    assert response == "Chào bạn! Mình có thể giúp gì cho bạn về mỹ phẩm hôm nay?"
+
+
+def test_clear_memory_forgets_served_products():
+    memory = _memory()
+    memory.add_conversation_turn("kem chống nắng", PRODUCT_ANSWER, PRODUCT_NAME)
+
+    memory.clear_memory()
+
+    assert memory.get_memory_entities()["served_products"] == []
+
+
+def test_served_product_name_reads_top_hit_metadata():
+    assert served_product_name([{"metadata": {"name": PRODUCT_NAME}}, {"metadata": {"name": "khác"}}]) == PRODUCT_NAME
+    assert served_product_name([]) is None
+    assert served_product_name([{"metadata": {}}]) is None
@@ -0,0 +1,175 @@
+import asyncio
+from typing import List
+
+import pytest
+from google.api_core.exceptions import ResourceExhausted
+from langchain_core.messages import HumanMessage
+
+import services.llm_pool as llm_pool_module
+from services.fake_llm import FakeChatModel, LatencyModel
+from services.llm_pool import GeminiKeyPool, LLMPoolExhausted, PooledChatModel, is_rate_limit_error
+
+
+class KeyChatModel(FakeChatModel):
+    """FakeChatModel của một API key; rate_limited=True thì luôn trả 429"""
+
+    api_key: str = ""
+    rate_limited: bool = False
+    calls: List[str] = []
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(self.api_key)
+        if self.rate_limited:
+            raise ResourceExhausted("429 Resource has been exhausted (e.g. check quota).")
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(self.api_key)
+        if self.rate_limited:
+            raise ResourceExhausted("429 Resource has been exhausted (e.g. check quota).")
+        return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _pool(rate_limited_keys=(), **kwargs):
+    latency = LatencyModel(distribution="fixed", median_ms=0, tokens_per_second=0)
+    clients = {}
+
+    def client_factory(api_key):
+        clients[api_key] = KeyChatModel(api_key=api_key, rate_limited=api_key in rate_limited_keys,
+                                        latency=latency, output_tokens=10)
+        return clients[api_key]
+
+    kwargs.setdefault("max_wait", 0.05)
+    return GeminiKeyPool(["k1", "k2"], client_factory, **kwargs), clients
+
+
+MESSAGES = [HumanMessage(content="Kem chống nắng nào tốt?")]
+
+
+def test_rate_limited_call_is_retried_on_another_key():
+    pool, clients = _pool(rate_limited_keys={"k1"})
+    llm = PooledChatModel(pool=pool)
+
+    answer = llm.invoke(MESSAGES)
+
+    assert answer.content
+    assert clients["k1"].calls == ["k1"]
+    assert clients["k2"].calls == ["k2"]
+    stats = pool.get_stats()
+    assert stats["key_1"]["rate_limited"] == 1
+    assert stats["key_1"]["cooldown_seconds"] > 0
+    assert stats["key_2"]["rate_limited"] == 0
+
+
+def test_async_rate_limited_call_is_retried_on_another_key():
+    pool, clients = _pool(rate_limited_keys={"k1"})
+    llm = PooledChatModel(pool=pool)
+
+    answer = asyncio.run(llm.ainvoke(MESSAGES))
+
+    assert answer.content
+    assert clients["k1"].calls == ["k1"]
+    assert clients["k2"].calls == ["k2"]
+
+
+def test_key_in_backoff_is_skipped_until_cooldown_ends(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_pool_module.time, "monotonic", clock)
+    pool, _ = _pool(backoff_base=2, backoff_max=60)
+    first = pool.acquire(100)
+    pool.release(first, 100, 100, ResourceExhausted("quota"))
+
+    # key_2 đang bận vẫn được chọn vì key_1 còn backoff
+    busy = pool.acquire(100)
+    assert busy is not first
+    assert pool.acquire(100) is busy
+
+    clock.now += 2.01
+    assert pool.acquire(100) is first
+
+
+def test_backoff_doubles_up_to_max_and_resets_on_success(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_pool_module.time, "monotonic", clock)
+    pool, _ = _pool(backoff_base=2, backoff_max=5)
+    slot = pool.slots[0]
+
+    backoffs = []
+    for _ in range(3):
+        slot.in_flight += 1
+        pool.release(slot, 100, None, ResourceExhausted("quota"))
+        backoffs.append(slot.backoff)
+    assert backoffs == [2, 4, 5]
+    assert slot.cooldown_until == pytest.approx(clock.now + 5)
+
+    slot.in_flight += 1
+    pool.release(slot, 100, 100)
+    assert slot.backoff == 0
+
+
+def test_retry_after_hint_extends_cooldown(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_pool_module.time, "monotonic", clock)
+    pool, _ = _pool(backoff_base=2)
+    error = ResourceExhausted("quota")
+    error.retry_after = 30
+    slot = pool.slots[0]
+    slot.in_flight += 1
+
+    pool.release(slot, 100, None, error)
+
+    assert slot.cooldown_until == pytest.approx(clock.now + 30)
+
+
+def test_pool_exhausted_when_every_key_is_rate_limited():
+    pool, clients = _pool(rate_limited_keys={"k1", "k2"})
+    llm = PooledChatModel(pool=pool)
+
+    with pytest.raises(ResourceExhausted):
+        llm.invoke(MESSAGES)
+    assert len(clients["k1"].calls) + len(clients["k2"].calls) == pool.max_attempts
+
+    # Cả hai key đang backoff -> không chờ quá max_wait
+    with pytest.raises(LLMPoolExhausted):
+        llm.invoke(MESSAGES)
+
+
+def test_non_rate_limit_errors_do_not_trigger_backoff():
+    pool, _ = _pool()
+    slot = pool.acquire(100)
+
+    pool.release(slot, 100, None, ValueError("bad request"))
+
+    assert slot.backoff == 0
+    assert slot.cooldown_until == 0
+    assert pool.get_stats()[slot.label]["errors"] == 1
+
+
+def test_rate_limit_errors_are_detected_when_wrapped():
+    assert is_rate_limit_error(ResourceExhausted("quota"))
+    assert is_rate_limit_error(RuntimeError("Error calling model: 429 RESOURCE_EXHAUSTED"))
+    assert not is_rate_limit_error(RuntimeError("500 internal error"))
+
+
+def test_request_budget_spreads_calls_across_keys(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(llm_pool_module.time, "monotonic", clock)
+    pool, _ = _pool(requests_per_minute=1)
+
+    first = pool.acquire(100)
+    second = pool.acquire(100)
+    assert {first.label, second.label} == {"key_1", "key_2"}
+    pool.release(first, 100, 100)
+    pool.release(second, 100, 100)
+
+    # Hết budget ở cả hai key: chờ lâu hơn max_wait -> raise ngay
+    with pytest.raises(LLMPoolExhausted):
+        pool.acquire(100)
@@ -0,0 +1,109 @@
+from services.prompt_budget import PromptBudgeter, count_tokens, truncate_to_tokens
+
+
+def _document(index, words=100):
+    return " ".join(f"sp{index}" for _ in range(words))
+
+
+def test_count_tokens_splits_long_words_and_punctuation():
+    assert count_tokens("") == 0
+    assert count_tokens("kem chống nắng") == 3
+    assert count_tokens("giá?") == 2
+    # 12 ký tự -> 1 + (12 - 1) // 5 = 3 token
+    assert count_tokens("abcdefghijkl") == 3
+
+
+def test_truncate_to_tokens_keeps_head_and_marks_cut():
+    text = "một hai ba bốn năm sáu bảy"
+
+    truncated = truncate_to_tokens(text, 4)
+
+    assert truncated == "một hai ba…"
+    assert count_tokens(truncated) <= 4
+    assert truncate_to_tokens(text, 100) == text
+    assert truncate_to_tokens(text, 1) == ""
+
+
+def test_everything_fits_within_budget():
+    budgeter = PromptBudgeter("hướng dẫn", max_tokens=1000)
+    documents = [_document(1, 50), _document(2, 50)]
+    history = [("xin chào", "chào bạn")]
+
+    kept_documents, kept_turns, report = budgeter.fit("kem nào tốt", documents, history)
+
+    assert kept_documents == documents
+    assert kept_turns == history
+    assert report["truncated"] is False
+    assert report["total"] <= 1000
+
+
+def test_documents_are_kept_in_rank_order_and_last_one_is_truncated():
+    budgeter = PromptBudgeter("hướng dẫn", max_tokens=260, min_partial_tokens=10)
+    documents = [_document(1), _document(2), _document(3)]
+
+    kept_documents, _, report = budgeter.fit("kem", documents, [])
+
+    assert kept_documents[:2] == documents[:2]
+    assert len(kept_documents) == 3
+    assert kept_documents[2].endswith("…")
+    assert report["truncated"] is True
+    assert report["total"] <= 260
+    assert report["documents_dropped"] == 0
+
+
+def test_too_small_remainder_drops_remaining_documents():
+    budgeter = PromptBudgeter("hướng dẫn", max_tokens=150, min_partial_tokens=64)
+    documents = [_document(1), _document(2)]
+
+    kept_documents, _, report = budgeter.fit("kem", documents, [])
+
+    assert kept_documents == documents[:1]
+    assert report["documents_dropped"] == 1
+    assert report["truncated"] is True
+
+
+def test_most_relevant_document_is_always_partially_kept():
+    budgeter = PromptBudgeter("hướng dẫn", max_tokens=40, min_partial_tokens=64)
+
+    kept_documents, _, report = budgeter.fit("kem", [_document(1)], [])
+
+    assert len(kept_documents) == 1
+    assert kept_documents[0].endswith("…")
+    assert report["total"] <= 40
+
+
+def test_history_keeps_most_recent_turns_within_its_share():
+    budgeter = PromptBudgeter("hướng dẫn", max_tokens=400, history_share=0.3, min_partial_tokens=1000)
+    documents = [_document(1, 300)]
+    history = [(f"câu hỏi {index}", _document(index, 30)) for index in range(10)]
+
+    kept_documents, kept_turns, report = budgeter.fit("kem", documents, history)
+
+    assert kept_turns == history[-len(kept_turns):]
+    assert 0 < len(kept_turns) < len(history)
+    assert report["history"] <= int((400 - report["instructions"] - report["query"]) * 0.3)
+    assert report["history_turns_dropped"] == len(history) - len(kept_turns)
+    assert report["total"] <= 400
+
+
+def test_unused_history_budget_goes_to_context():
+    budgeter = PromptBudgeter("hướng dẫn", max_tokens=300, history_share=0.5)
+    documents = [_document(1, 250)]
+
+    kept_documents, _, report = budgeter.fit("kem", documents, [])
+
+    assert kept_documents == documents
+    assert report["truncated"] is False
+
+
+def test_disabled_budget_keeps_everything():
+    budgeter = PromptBudgeter("hướng dẫn", max_tokens=0)
+    documents = [_document(index) for index in range(20)]
+    history = [("a", _document(1))] * 5
+
+    kept_documents, kept_turns, report = budgeter.fit("kem", documents, history)
+
+    assert kept_documents == documents
+    assert kept_turns == history
+    assert report["budget"] is None
+    assert report["truncated"] is False
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from services.fake_llm import FakeChatModel, LatencyModel
+from services.langchain.chains.response_chain import ResponseChain
+
+QUERY_INFO = {"enhanced_query": "Kem chống nắng nào tốt?", "route": "QUESTION"}
+
+
+def _response_chain(latency_ms=0):
+    latency = LatencyModel(distribution="fixed", median_ms=latency_ms, tokens_per_second=0)
+    return ResponseChain(FakeChatModel(latency=latency, output_tokens=20))
+
+
+def test_sync_generation_returns_answer():
+    answer = _response_chain().generate_response(QUERY_INFO, "Anessa 450.000đ", "", "QUESTION")
+
+    assert answer
+
+
+def test_sync_generation_with_expired_budget_raises_builtin_timeout():
+    with pytest.raises(TimeoutError):
+        _response_chain().generate_response(QUERY_INFO, "", "", "QUESTION", timeout=0)
+
+
+def test_async_generation_past_timeout_raises_builtin_timeout():
+    chain = _response_chain(latency_ms=500)
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(chain.agenerate_response(QUERY_INFO, "", "", "QUESTION", timeout=0.05))
+
+
+def test_stream_with_expired_budget_raises_builtin_timeout():
+    async def consume():
+        async for _ in _response_chain().astream_response(QUERY_INFO, "", "", "QUESTION", timeout=0):
+            pass
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(consume())
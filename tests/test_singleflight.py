@@ -0,0 +1,100 @@
+import threading
+import time
+
+from services.singleflight import SingleFlight
+
+
+def _run_concurrently(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def test_concurrent_calls_with_same_key_share_one_computation():
+    flight = SingleFlight()
+    calls = []
+    results = []
+    started = threading.Event()
+
+    def compute():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return "kết quả"
+
+    def worker():
+        results.append(flight.do("kem chống nắng", compute))
+
+    leader = threading.Thread(target=worker)
+    leader.start()
+    started.wait(timeout=5)
+    _run_concurrently(4, worker)
+    leader.join(timeout=5)
+
+    assert len(calls) == 1
+    assert [value for value, _ in results] == ["kết quả"] * 5
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    stats = flight.get_stats()
+    assert stats["hits"] == 4
+    assert stats["misses"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_different_keys_are_not_coalesced():
+    flight = SingleFlight()
+
+    assert flight.do("a", lambda: 1) == (1, False)
+    assert flight.do("b", lambda: 2) == (2, False)
+    assert flight.get_stats()["hits"] == 0
+
+
+def test_key_is_released_after_call_so_next_call_recomputes():
+    flight = SingleFlight()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert flight.do("q", compute) == (1, False)
+    assert flight.do("q", compute) == (2, False)
+    assert flight.get_stats()["in_flight"] == 0
+
+
+def test_error_is_propagated_to_leader_and_waiters():
+    flight = SingleFlight()
+    started = threading.Event()
+    errors = []
+
+    def compute():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError("qdrant lỗi")
+
+    def worker():
+        try:
+            flight.do("q", compute)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=worker)
+    leader.start()
+    started.wait(timeout=5)
+    _run_concurrently(3, worker)
+    leader.join(timeout=5)
+
+    assert len(errors) == 4
+    assert all(str(error) == "qdrant lỗi" for error in errors)
+    assert flight.get_stats()["in_flight"] == 0
+
+    # Lỗi không bị giữ lại: lần gọi sau tính lại bình thường
+    assert flight.do("q", lambda: "ok") == ("ok", False)
+
+
+def test_arguments_are_passed_to_func():
+    flight = SingleFlight()
+
+    assert flight.do(("search", 5), lambda query, limit: f"{query}:{limit}", "serum", 5) == ("serum:5", False)
+
@@ -0,0 +1,119 @@
+import pytest
+
+from services.structured_answers import (
+    LOOKUP_LINK, LOOKUP_PRICE, LOOKUP_RATING, StructuredAnswerer, format_price
+)
+
+CERAVE_OILY = {
+    "product_id": "101",
+    "name": "Sữa Rửa Mặt CeraVe Sạch Sâu Cho Da Thường Đến Da Dầu 473ml",
+    "english_name": "CeraVe Foaming Facial Cleanser 473ml",
+    "brand": "CeraVe",
+    "price": 385000,
+    "url": "https://hasaki.vn/san-pham/cerave-foaming-473ml.html",
+    "average_rating": 4.8,
+    "total_rating": 1200
+}
+CERAVE_DRY = {
+    "product_id": "102",
+    "name": "Sữa Rửa Mặt CeraVe Cho Da Thường Đến Da Khô 236ml",
+    "english_name": "CeraVe Hydrating Facial Cleanser 236ml",
+    "brand": "CeraVe",
+    "price": 310000,
+    "url": "https://hasaki.vn/san-pham/cerave-hydrating-236ml.html"
+}
+ANESSA = {
+    "product_id": "201",
+    "name": "Sữa Chống Nắng Anessa Dưỡng Da Kiềm Dầu 60ml",
+    "brand": "Anessa",
+    "price": "450000",
+    "url": "https://hasaki.vn/san-pham/anessa-60ml.html",
+    "average_rating": 4.9,
+    "total_rating": 0,
+    "options": [{"name": "Sữa Chống Nắng Anessa Dưỡng Da Kiềm Dầu 90ml", "price": 650000}]
+}
+
+
+def _results(*products):
+    return [{"metadata": product, "score": 1.0 - index * 0.1} for index, product in enumerate(products)]
+
+
+@pytest.mark.parametrize("query", [
+    # Câu hỏi nhiều ý / đánh giá - cần LLM tư vấn, không chỉ báo giá
+    "sữa rửa mặt cerave có tốt không, giá bao nhiêu",
+    "sữa rửa mặt cerave giá rẻ không",
+    "sữa rửa mặt cerave sạch sâu cho da dầu giá bao nhiêu",
+    # Tên chung chung - không đủ để chọn một SKU
+    "giá sữa rửa mặt cerave",
+    "cerave giá bao nhiêu",
+    # Từ không có trong tên sản phẩm
+    "giá sữa rửa mặt cerave sạch sâu 473ml mua tặng mẹ",
+])
+def test_questions_that_need_llm_are_not_answered_from_metadata(query):
+    answerer = StructuredAnswerer()
+
+    assert answerer.answer(query, _results(CERAVE_OILY, CERAVE_DRY)) is None
+
+
+def test_specific_price_question_is_answered_from_metadata():
+    answer = StructuredAnswerer().answer(
+        "Sữa rửa mặt CeraVe sạch sâu thường đến 473ml giá bao nhiêu?", _results(CERAVE_OILY, CERAVE_DRY)
+    )
+
+    assert answer["lookups"] == [LOOKUP_PRICE]
+    assert answer["product_id"] == "101"
+    assert answer["product_name"] == CERAVE_OILY["name"]
+    assert answer["name_coverage"] >= 0.6
+    assert "385.000đ" in answer["answer"]
+    assert CERAVE_OILY["url"] in answer["answer"]
+
+
+def test_english_name_can_identify_the_product():
+    answer = StructuredAnswerer().answer("link mua cerave foaming facial cleanser 473ml",
+                                         _results(CERAVE_OILY, CERAVE_DRY))
+
+    assert answer["lookups"] == [LOOKUP_LINK]
+    assert CERAVE_OILY["url"] in answer["answer"]
+
+
+def test_several_lookups_are_answered_together():
+    answer = StructuredAnswerer().answer("sữa rửa mặt cerave sạch sâu thường 473ml giá và đánh giá",
+                                         _results(CERAVE_OILY))
+
+    assert answer["lookups"] == [LOOKUP_PRICE, LOOKUP_RATING]
+    assert "4.8/5 sao từ 1200 lượt" in answer["answer"]
+
+
+def test_question_matching_another_candidate_equally_is_ambiguous():
+    twin = dict(CERAVE_OILY, product_id="103", url="https://hasaki.vn/san-pham/cerave-foaming-88ml.html")
+
+    assert StructuredAnswerer().answer("giá sữa rửa mặt cerave sạch sâu thường 473ml",
+                                       _results(CERAVE_OILY, twin)) is None
+
+
+def test_question_without_size_lists_all_variants():
+    answer = StructuredAnswerer().answer("giá sữa chống nắng anessa dưỡng kiềm", _results(ANESSA))
+
+    assert "có 2 phiên bản" in answer["answer"]
+    assert "450.000đ" in answer["answer"]
+    assert "650.000đ" in answer["answer"]
+
+
+def test_missing_metadata_falls_back_to_llm():
+    product = dict(CERAVE_OILY, price=None)
+
+    assert StructuredAnswerer().answer("giá sữa rửa mặt cerave sạch sâu thường 473ml", _results(product)) is None
+
+
+def test_min_name_coverage_is_configurable():
+    query = "giá sữa rửa mặt cerave"
+
+    assert StructuredAnswerer(min_name_coverage=0.3).answer(query, _results(CERAVE_OILY)) is not None
+    assert StructuredAnswerer(min_name_coverage=0.6).answer(query, _results(CERAVE_OILY)) is None
+
+
+@pytest.mark.parametrize("price, expected", [
+    (350000, "350.000đ"), ("350000", "350.000đ"), (350000.0, "350.000đ"), ("liên hệ", "liên hệ"), (0, None), (None, None)
+])
+def test_format_price(price, expected):
+    assert format_price(price) == expected
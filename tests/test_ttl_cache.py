@@ -0,0 +1,125 @@
+from typing import List
+
+import services.ttl_cache as ttl_cache_module
+from services.fake_llm import FakeChatModel, LatencyModel
+from services.langchain.chains.unified_processing_chain import UnifiedProcessingChain
+from services.langchain.memory.conversation_memory import NO_HISTORY_SUMMARY
+from services.ttl_cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = TTLCache(max_entries=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == (True, 1)
+
+    cache.set("c", 3)
+
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+    assert cache.get_stats()["evicted_lru"] == 1
+
+
+def test_overwriting_key_refreshes_value_without_eviction():
+    cache = TTLCache(max_entries=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("a", 10)
+
+    assert cache.get("a") == (True, 10)
+    assert cache.get("b") == (True, 2)
+    assert cache.get_stats()["evicted_lru"] == 0
+
+
+def test_entry_expires_after_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ttl_cache_module.time, "monotonic", clock)
+    cache = TTLCache(max_entries=10, ttl_seconds=30)
+    cache.set("q", {"intent": "QUESTION"})
+
+    clock.now += 29
+    assert cache.get("q") == (True, {"intent": "QUESTION"})
+
+    clock.now += 2
+    assert cache.get("q") == (False, None)
+    stats = cache.get_stats()
+    assert stats["evicted_ttl"] == 1
+    assert stats["size"] == 0
+
+
+def test_cache_hit_does_not_extend_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ttl_cache_module.time, "monotonic", clock)
+    cache = TTLCache(max_entries=10, ttl_seconds=30)
+    cache.set("q", 1)
+
+    clock.now += 20
+    assert cache.get("q") == (True, 1)
+    clock.now += 20
+    assert cache.get("q") == (False, None)
+
+
+def test_disabled_cache_never_stores():
+    for cache in (TTLCache(max_entries=0, ttl_seconds=60), TTLCache(max_entries=10, ttl_seconds=0)):
+        cache.set("q", 1)
+        assert cache.get("q") == (False, None)
+        assert cache.get_stats()["size"] == 0
+
+
+def test_stats_report_hit_rate():
+    cache = TTLCache(max_entries=10, ttl_seconds=60)
+    cache.set("q", 1)
+    cache.get("q")
+    cache.get("q")
+    cache.get("missing")
+
+    stats = cache.get_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == round(2 / 3, 4)
+
+
+class CountingChatModel(FakeChatModel):
+    """FakeChatModel đếm số lần gọi"""
+
+    calls: List[str] = []
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append(str(messages[-1].content))
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+def _unified_chain():
+    llm = CountingChatModel(latency=LatencyModel(distribution="fixed", median_ms=0, tokens_per_second=0))
+    return UnifiedProcessingChain(llm, cache=TTLCache(max_entries=10, ttl_seconds=60)), llm
+
+
+def test_unified_chain_caches_first_turn_queries_by_normalized_text():
+    chain, llm = _unified_chain()
+
+    first = chain.process_query_unified("Kem chống nắng cho da dầu?", NO_HISTORY_SUMMARY)
+    second = chain.process_query_unified("kem chống nắng  cho da dầu", NO_HISTORY_SUMMARY)
+
+    assert len(llm.calls) == 1
+    assert second["enhanced_query"] == first["enhanced_query"]
+    assert chain.get_cache_stats()["hits"] == 1
+
+
+def test_unified_chain_does_not_cache_follow_up_turns():
+    chain, llm = _unified_chain()
+    summary = "Người dùng: Kem chống nắng Anessa\nBot: Anessa giá 450.000đ"
+
+    chain.process_query_unified("giá bao nhiêu", summary)
+    chain.process_query_unified("giá bao nhiêu", summary)
+
+    assert len(llm.calls) == 2
+    assert chain.get_cache_stats()["size"] == 0